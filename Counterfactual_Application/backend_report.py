@@ -0,0 +1,138 @@
+__author__ = "Kaya Arkin"
+__copyright__ = "Copyright Kaya Arkin, Swansea University"
+__email__ = "2105361@swansea.ac.uk, karkin2002@gmail.com"
+
+"""
+--- Description
+This file manages the inference backends of the fine-tuned T5 model:
+    export      Exports the model to ONNX ahead of time.
+    parity      Checks every backend gives the same outputs, likelihood scores
+                and matches as the eager PyTorch backend. Exits with status 1
+                if any backend disagrees.
+    benchmark   Times every backend over the reports and names the fastest on
+                this host, which can then be passed to cli.py --backend or set
+                as MainUI.BACKEND.
+
+Example:
+    python backend_report.py parity --model <model folder> --input ../LLM_Training/airline_incidents_small.csv --limit 50
+"""
+
+import argparse, os, sys, time
+from scripts.utility.logger import Logger
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from custom.scripts.prediction_cache import PredictionCache
+from cli import read_reports, LOG_FOLDER_PATH
+
+SCORE_TOLERANCE = 1e-3
+
+
+def load_llm(model_folder_path: str, backend: str, batch_size: int) -> PreTrainedLLM:
+
+    ## An empty cache stops one backend's outputs being served to another.
+    llm = PreTrainedLLM(prediction_cache=PredictionCache(max_size=0), backend=backend)
+    llm.batch_size = batch_size
+    llm.set_model_folder_path(model_folder_path)
+
+    return llm
+
+
+def export(arguments: argparse.Namespace):
+
+    load_llm(arguments.model, PreTrainedLLM.ONNX_BACKEND, arguments.batch_size)
+
+
+def parity(arguments: argparse.Namespace, reports: list[str], part_failures: list[str]) -> bool:
+
+    eager_llm = load_llm(arguments.model, PreTrainedLLM.EAGER_BACKEND, arguments.batch_size)
+    eager_outputs = eager_llm.get_outputs(reports)
+    target = part_failures[0] if part_failures[0] is not None else eager_outputs[0]
+    eager_scores = eager_llm.get_scores_and_matches(reports, target)
+    eager_matches = eager_llm.get_matches(reports, target)
+
+    passed = True
+
+    for backend in PreTrainedLLM.BACKENDS:
+        if backend == PreTrainedLLM.EAGER_BACKEND:
+            continue
+
+        llm = load_llm(arguments.model, backend, arguments.batch_size)
+        outputs = llm.get_outputs(reports)
+        scores = llm.get_scores_and_matches(reports, target)
+        matches = llm.get_matches(reports, target)
+
+        num_of_output_mismatches = sum(output != eager_output for output, eager_output in zip(outputs, eager_outputs))
+        num_of_match_mismatches = sum(match != eager_match for match, eager_match in zip(matches, eager_matches))
+        max_score_difference = max(abs(score - eager_score) for (score, _), (eager_score, _) in zip(scores, eager_scores))
+
+        backend_passed = num_of_output_mismatches == 0 and num_of_match_mismatches == 0 and max_score_difference <= SCORE_TOLERANCE
+        passed = passed and backend_passed
+
+        log = Logger.log_info if backend_passed else Logger.log_error
+        log(f"{backend}: {num_of_output_mismatches} output and {num_of_match_mismatches} match mismatches, "
+            f"max score difference {max_score_difference:.2e} ({'passed' if backend_passed else 'FAILED'}).")
+
+    return passed
+
+
+def benchmark(arguments: argparse.Namespace, reports: list[str]):
+
+    seconds = {}
+
+    for backend in PreTrainedLLM.BACKENDS:
+        llm = load_llm(arguments.model, backend, arguments.batch_size)
+
+        ## The first batch pays for compilation and session warm up.
+        llm.get_outputs(reports[:arguments.batch_size])
+
+        start_time = time.perf_counter()
+        llm.get_outputs(reports)
+        seconds[backend] = time.perf_counter() - start_time
+
+        Logger.log_info(f"{backend}: {len(reports) / seconds[backend]:.2f} reports/s.")
+
+    Logger.log_info(f"Fastest backend on this host: {min(seconds, key=seconds.get)}")
+
+
+def get_arguments() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(description="Export, check and time the inference backends.")
+    parser.add_argument("command", choices=["export", "parity", "benchmark"])
+    parser.add_argument("--model", required=True, help="Folder of the fine-tuned T5 model.")
+    parser.add_argument("--input", default=None, help="CSV file with 'report' and 'part failure' columns.")
+    parser.add_argument("--batch-size", type=int, default=PreTrainedLLM.DEFAULT_BATCH_SIZE, help="Reports per model batch.")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N reports.")
+
+    return parser.parse_args()
+
+
+def main():
+
+    arguments = get_arguments()
+
+    os.makedirs(LOG_FOLDER_PATH, exist_ok=True)
+    Logger(os.path.join(LOG_FOLDER_PATH, "Backend_Report"))
+
+    if arguments.command == "export":
+        export(arguments)
+        return
+
+    if arguments.input is None:
+        Logger.raise_exception(f"The {arguments.command} command needs an --input CSV file.")
+
+    rows = read_reports(arguments.input, arguments.limit)
+    reports = [report for _, report, _ in rows]
+    part_failures = [part_failure for _, _, part_failure in rows]
+
+    if len(reports) == 0:
+        Logger.raise_exception(f"CSV file '{arguments.input}' has no reports.")
+
+    if arguments.command == "parity":
+        if not parity(arguments, reports, part_failures):
+            sys.exit(1)
+
+    else:
+        benchmark(arguments, reports)
+
+
+if __name__ == "__main__":
+    main()
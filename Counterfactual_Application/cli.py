@@ -0,0 +1,342 @@
+__author__ = "Kaya Arkin"
+__copyright__ = "Copyright Kaya Arkin, Swansea University"
+__email__ = "2105361@swansea.ac.uk, karkin2002@gmail.com"
+
+"""
+--- Description
+This file is a headless command-line entry point for the counterfactual
+pipeline. It reads a CSV of incident reports (columns "report" and
+"part failure"), runs the counterfactual generator over each report without a
+pygame window and streams one JSON object per report to a JSONL file.
+
+Example:
+    python cli.py --model <model folder> --input ../LLM_Training/airline_incidents_small.csv --output results.jsonl --workers 4 --resume
+"""
+
+import argparse, csv, json, os, time, torch, traceback
+from multiprocessing import Pool
+from scripts.utility.logger import Logger
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from custom.scripts.model_registry import ModelRegistry
+from custom.scripts.sharded_llm import ShardedLLM
+from custom.scripts.counterfactual_generator import CounterfactualGenerator
+from custom.scripts.counterfactual_budget import CounterfactualBudget
+from custom.scripts.result_store import ResultStore
+
+REPORT_COLUMN = "report"
+PART_FAILURE_COLUMN = "part failure"
+LOG_FOLDER_PATH = r"logs"
+PARTIAL_LINE_CHUNK_BYTES = 64 * 1024
+
+MODEL_TYPES = {
+    "t5": PreTrainedLLM.BERT,
+    "classifier": PreTrainedLLM.CLASSIFIER
+}
+
+DECODING_MODES = {
+    "full": CounterfactualGenerator.FULL_DECODING,
+    "match": CounterfactualGenerator.MATCH_ONLY_DECODING,
+    "score": CounterfactualGenerator.LIKELIHOOD_SCORING
+}
+
+worker_llm: PreTrainedLLM | ShardedLLM = None
+worker_include_analysis = False
+worker_max_seconds = None
+worker_max_inferences = None
+worker_result_store: ResultStore = None
+
+
+def init_worker(model_folder_path: str,
+                batch_size: int,
+                decoding_mode: int,
+                analysis_model_folder_path: str,
+                max_seconds: float = None,
+                max_inferences: int = None,
+                quantization: str = None,
+                backend: str = PreTrainedLLM.EAGER_BACKEND,
+                num_of_shards: int = 1,
+                label_vocabulary_path: str = None,
+                model_type: int = PreTrainedLLM.BERT,
+                result_store_path: str = None,
+                flip_search: bool = False,
+                candidate_source: str = CounterfactualGenerator.WORDNET_SOURCE,
+                num_of_workers: int = 1):
+
+    global worker_llm, worker_include_analysis, worker_max_seconds, worker_max_inferences, worker_result_store
+
+    CounterfactualGenerator.DECODING_MODE = decoding_mode
+    CounterfactualGenerator.FLIP_SEARCH = flip_search
+    CounterfactualGenerator.CANDIDATE_SOURCE = candidate_source
+
+    if analysis_model_folder_path is not None:
+        CounterfactualGenerator.ANALYSIS_MODEL_FOLDER_PATH = analysis_model_folder_path
+        worker_include_analysis = True
+
+    worker_max_seconds = max_seconds
+    worker_max_inferences = max_inferences
+
+    ## Each worker would otherwise start one thread per core and oversubscribe
+    ## the CPU, so the cores are split between them as the shards do.
+    if num_of_workers > 1:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_of_workers))
+
+    worker_llm = ModelRegistry.get_model(model_folder_path, model_type, quantization=quantization, backend=backend, pin=True)
+    worker_llm.batch_size = batch_size
+    worker_llm.set_label_vocabulary(label_vocabulary_path)
+
+    if num_of_shards > 1:
+        worker_llm = ShardedLLM(worker_llm, num_of_shards)
+
+    if result_store_path is not None:
+        worker_result_store = ResultStore(result_store_path)
+
+
+def analyse_report(item: tuple[int, str, str]) -> dict:
+
+    start_time = time.perf_counter()
+
+    ## One bad report must not stop the whole run, so its error is written in
+    ## its place and --resume can skip it or, with --retry-failed, rerun it.
+    try:
+        return get_report_result(item)
+
+    except Exception as exception:
+        Logger.log_error(f"Report {item[0]} failed: {exception}\n{traceback.format_exc()}")
+
+        return {
+            "index": item[0],
+            "error": f"{type(exception).__name__}: {exception}",
+            "seconds": time.perf_counter() - start_time
+        }
+
+
+def get_report_result(item: tuple[int, str, str]) -> dict:
+
+    index, report, part_failure = item
+    start_time = time.perf_counter()
+
+    prediction = worker_llm.get_outputs([report])[0]
+    prediction_time = time.perf_counter() - start_time
+
+    budget = CounterfactualBudget(worker_max_seconds, worker_max_inferences)
+    summary, analysis, views, cost_report = CounterfactualGenerator.get_output(
+        report,
+        prediction,
+        worker_llm,
+        include_analysis=worker_include_analysis,
+        budget=budget,
+        result_store=worker_result_store)
+
+    return {
+        "index": index,
+        "report": report,
+        "part_failure": part_failure,
+        "prediction": prediction,
+        "prediction_correct": prediction == part_failure,
+        "summary": summary,
+        "analysis": analysis if worker_include_analysis else None,
+        "counterfactuals": CounterfactualGenerator.get_rows(views.results),
+        "minimal_flips": views.results.minimal_flips,
+        "planned_inferences": budget.num_of_planned,
+        "evaluated_inferences": budget.num_of_evaluated,
+        "prediction_seconds": prediction_time,
+        "cost": cost_report.to_dict(),
+        "seconds": time.perf_counter() - start_time
+    }
+
+
+def read_reports(csv_path: str, limit: int = None) -> list[tuple[int, str, str]]:
+
+    reports = []
+
+    with open(csv_path, "r", encoding="utf-8", newline="") as file:
+        reader = csv.DictReader(file)
+
+        if REPORT_COLUMN not in reader.fieldnames:
+            Logger.raise_exception(f"CSV file '{csv_path}' has no '{REPORT_COLUMN}' column.")
+
+        for index, row in enumerate(reader):
+            if limit is not None and index >= limit:
+                break
+
+            reports.append((index, row[REPORT_COLUMN], row.get(PART_FAILURE_COLUMN)))
+
+    return reports
+
+
+def get_percentile(values: list[float], percentile: float) -> float:
+
+    if len(values) == 0:
+        return None
+
+    ## Linear interpolation between the closest ranks, so every report's
+    ## latency figures are computed the same way.
+    values = sorted(values)
+    rank = (len(values) - 1) * percentile / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def read_completed_indexes(output_path: str, retry_failed: bool = False) -> set[int]:
+
+    completed_indexes = set()
+
+    if not os.path.exists(output_path):
+        return completed_indexes
+
+    with open(output_path, "r", encoding="utf-8") as file:
+        for line in file:
+
+            ## A run that was killed mid-write can leave a partial last line.
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            if "index" not in result or (retry_failed and "error" in result):
+                continue
+
+            completed_indexes.add(result["index"])
+
+    return completed_indexes
+
+
+def remove_partial_line(output_path: str):
+
+    if not os.path.exists(output_path):
+        return
+
+    with open(output_path, "rb+") as file:
+        end = file.seek(0, os.SEEK_END)
+        position = end
+
+        if end == 0:
+            return
+
+        ## Appending after a partial line would merge it with the next record,
+        ## so everything after the last newline is cut. Only the end is read.
+        while position > 0:
+            chunk_start = max(position - PARTIAL_LINE_CHUNK_BYTES, 0)
+            file.seek(chunk_start)
+            chunk = file.read(position - chunk_start)
+
+            if position == end and chunk.endswith(b"\n"):
+                return
+
+            newline_index = chunk.rfind(b"\n")
+
+            if newline_index != -1:
+                file.truncate(chunk_start + newline_index + 1)
+                break
+
+            position = chunk_start
+
+        if position == 0:
+            file.truncate(0)
+
+    Logger.log_warning(f"Removed a partially written last line from '{output_path}'.")
+
+
+def get_arguments() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(description="Run the counterfactual pipeline over a CSV of reports without the UI.")
+    parser.add_argument("--model", required=True, help="Folder of the fine-tuned T5 model.")
+    parser.add_argument("--model-type", choices=list(MODEL_TYPES), default="t5", help="A classifier predicts in one forward pass; pass --labels for its label names.")
+    parser.add_argument("--input", required=True, help="CSV file with 'report' and 'part failure' columns.")
+    parser.add_argument("--output", required=True, help="JSONL file the results are streamed to.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, each with its own model.")
+    parser.add_argument("--resume", action="store_true", help="Skip reports already present in the output file.")
+    parser.add_argument("--retry-failed", action="store_true", help="With --resume, rerun reports whose earlier attempt wrote an error.")
+    parser.add_argument("--batch-size", type=int, default=PreTrainedLLM.DEFAULT_BATCH_SIZE, help="Candidates per model batch.")
+    parser.add_argument("--decoding", choices=list(DECODING_MODES), default="full", help="How candidate outputs are decoded.")
+    parser.add_argument("--analysis-model", default=None, help="Folder of the analysis LLM. Analysis is skipped if omitted.")
+    parser.add_argument("--max-seconds", type=float, default=None, help="Time budget per report; the most sensitive words are evaluated first.")
+    parser.add_argument("--max-inferences", type=int, default=None, help="Inference budget per report; the most sensitive words are evaluated first.")
+    parser.add_argument("--quantization", choices=PreTrainedLLM.QUANTIZATIONS, default=None, help="Quantize the model's linear layers for faster CPU inference.")
+    parser.add_argument("--backend", choices=PreTrainedLLM.BACKENDS, default=PreTrainedLLM.EAGER_BACKEND, help="Inference runtime; see backend_report.py to pick the fastest.")
+    parser.add_argument("--shards", type=int, default=1, help="Split each report's candidates across this many processes; see scaling_benchmark.py.")
+    parser.add_argument("--labels", default=None, help="Label vocabulary file; decoding is constrained to these part failures. Build it with 'python -m custom.scripts.label_trie'.")
+    parser.add_argument("--flip-search", action="store_true", help="Also search for the fewest word substitutions that change the prediction.")
+    parser.add_argument("--candidates", choices=CounterfactualGenerator.CANDIDATE_SOURCES, default=CounterfactualGenerator.WORDNET_SOURCE, help="Synonym source; 'embedding' uses the nearest words in the model's own embedding table.")
+    parser.add_argument("--result-store", default=None, help="SQLite file finished reports are stored in and reused from on later runs.")
+    parser.add_argument("--limit", type=int, default=None, help="Only process the first N reports.")
+
+    return parser.parse_args()
+
+
+def main():
+
+    arguments = get_arguments()
+
+    os.makedirs(LOG_FOLDER_PATH, exist_ok=True)
+    Logger(os.path.join(LOG_FOLDER_PATH, "Counterfactual_CLI"))
+
+    if arguments.workers < 1:
+        Logger.raise_exception("Number of workers must be at least 1.")
+
+    ## Pool workers are daemonic and cannot start shard processes of their own.
+    if arguments.workers > 1 and arguments.shards > 1:
+        Logger.raise_exception("Use either --workers or --shards, not both.")
+
+    reports = read_reports(arguments.input, arguments.limit)
+
+    if arguments.resume:
+        remove_partial_line(arguments.output)
+        completed_indexes = read_completed_indexes(arguments.output, arguments.retry_failed)
+        reports = [report for report in reports if report[0] not in completed_indexes]
+        Logger.log_info(f"Resuming, {len(completed_indexes)} reports already completed.")
+
+    Logger.log_info(f"Analysing {len(reports)} reports with {arguments.workers} worker(s).")
+
+    worker_args = (
+        arguments.model,
+        arguments.batch_size,
+        DECODING_MODES[arguments.decoding],
+        arguments.analysis_model,
+        arguments.max_seconds,
+        arguments.max_inferences,
+        arguments.quantization,
+        arguments.backend,
+        arguments.shards,
+        arguments.labels,
+        MODEL_TYPES[arguments.model_type],
+        arguments.result_store,
+        arguments.flip_search,
+        arguments.candidates,
+        arguments.workers)
+
+    start_time = time.perf_counter()
+
+    with open(arguments.output, "a" if arguments.resume else "w", encoding="utf-8") as file:
+
+        def write_result(result: dict):
+            file.write(json.dumps(result) + "\n")
+            file.flush()
+
+            if "error" not in result:
+                Logger.log_info(f"Report {result['index']} completed in {result['seconds']:.2f}s.")
+
+        if arguments.workers == 1:
+            init_worker(*worker_args)
+
+            for report in reports:
+                write_result(analyse_report(report))
+
+            if isinstance(worker_llm, ShardedLLM):
+                worker_llm.close()
+
+            if worker_result_store is not None:
+                worker_result_store.close()
+
+        else:
+            with Pool(arguments.workers, initializer=init_worker, initargs=worker_args) as pool:
+                for result in pool.imap_unordered(analyse_report, reports):
+                    write_result(result)
+
+    Logger.log_info(f"Finished {len(reports)} reports in {time.perf_counter() - start_time:.2f}s.")
+
+
+if __name__ == "__main__":
+    main()
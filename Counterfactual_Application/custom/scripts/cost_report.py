@@ -0,0 +1,134 @@
+import threading, time
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+
+class CostReport:
+    """Where the time of one counterfactual run went. Model stages are read
+    from the LLM's running totals as the change since `start`, the other
+    stages are added by the generator and the UI as they happen. The UI adds
+    its render time from its own thread, so stage times change under a lock.
+    """
+
+    WORDNET_STAGE = "wordnet_lookup"
+    STRING_BUILDING_STAGE = "string_building"
+    TOKENISATION_STAGE = PreTrainedLLM.TOKENISATION_STAGE
+    GENERATION_STAGE = PreTrainedLLM.GENERATION_STAGE
+    DECODING_STAGE = PreTrainedLLM.DECODING_STAGE
+    UI_STAGE = "ui_updates"
+    ANALYSIS_STAGE = "analysis_llm"
+
+    STAGES = (WORDNET_STAGE, STRING_BUILDING_STAGE, TOKENISATION_STAGE, GENERATION_STAGE, DECODING_STAGE, UI_STAGE, ANALYSIS_STAGE)
+
+    STAGE_NAMES = {
+        WORDNET_STAGE: "WordNet Lookup",
+        STRING_BUILDING_STAGE: "String Building",
+        TOKENISATION_STAGE: "Tokenisation",
+        GENERATION_STAGE: "Generation",
+        DECODING_STAGE: "Decoding",
+        UI_STAGE: "UI Updates",
+        ANALYSIS_STAGE: "Analysis LLM"
+    }
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__reset()
+
+
+    def __reset(self):
+
+        self.stage_seconds: dict[str, float] = dict.fromkeys(self.STAGES, 0.0)
+        self.num_of_input_tokens = 0
+        self.num_of_output_tokens = 0
+        self.num_of_candidates = 0
+        self.num_of_inferences = 0
+        self.num_of_reused = 0
+        self.num_of_cache_hits = 0
+        self.wall_seconds = 0.0
+        self.from_result_store = False
+
+        self.__start_time = None
+        self.__llm_start = None
+
+
+    def __get_llm_totals(llm: PreTrainedLLM) -> dict:
+
+        cache_stats = llm.get_cache_stats()
+
+        return {
+            "stage_seconds": dict(llm.stage_seconds),
+            "num_of_input_tokens": llm.num_of_input_tokens,
+            "num_of_output_tokens": llm.num_of_output_tokens,
+            "num_of_cache_hits": cache_stats.get("memory_hits", 0) + cache_stats.get("disk_hits", 0)
+        }
+
+
+    def start(self, llm: PreTrainedLLM):
+
+        llm_start = CostReport.__get_llm_totals(llm)
+
+        with self.__lock:
+            self.__reset()
+            self.__start_time = time.perf_counter()
+            self.__llm_start = llm_start
+
+
+    def add_seconds(self, stage: str, seconds: float):
+
+        with self.__lock:
+            self.stage_seconds[stage] += seconds
+
+
+    def update(self, llm: PreTrainedLLM):
+
+        if self.__start_time is None:
+            return
+
+        llm_totals = CostReport.__get_llm_totals(llm)
+
+        with self.__lock:
+            for stage in PreTrainedLLM.STAGES:
+                self.stage_seconds[stage] = llm_totals["stage_seconds"][stage] - self.__llm_start["stage_seconds"][stage]
+
+        self.num_of_input_tokens = llm_totals["num_of_input_tokens"] - self.__llm_start["num_of_input_tokens"]
+        self.num_of_output_tokens = llm_totals["num_of_output_tokens"] - self.__llm_start["num_of_output_tokens"]
+        self.num_of_cache_hits = llm_totals["num_of_cache_hits"] - self.__llm_start["num_of_cache_hits"]
+        self.wall_seconds = time.perf_counter() - self.__start_time
+
+
+    def get_other_seconds(self) -> float:
+
+        ## Sharded stage times are summed over processes and can exceed the wall time.
+        return max(self.wall_seconds - sum(self.stage_seconds.values()), 0.0)
+
+
+    def to_dict(self) -> dict:
+
+        return {
+            "wall_seconds": self.wall_seconds,
+            "from_result_store": self.from_result_store,
+            "stage_seconds": {**self.stage_seconds, "other": self.get_other_seconds()},
+            "input_tokens": self.num_of_input_tokens,
+            "output_tokens": self.num_of_output_tokens,
+            "candidates": self.num_of_candidates,
+            "inferences": self.num_of_inferences,
+            "reused_inferences": self.num_of_reused,
+            "cache_hits": self.num_of_cache_hits
+        }
+
+
+    def get_summary_text(self) -> str:
+
+        summary = f"Run Time: {self.wall_seconds:.2f}s"
+
+        if self.from_result_store:
+            summary += " (Loaded From Result Store)"
+
+        for stage in self.STAGES:
+            if self.stage_seconds[stage] > 0:
+                summary += f"\n{self.STAGE_NAMES[stage]}: {self.stage_seconds[stage]:.2f}s ({self.stage_seconds[stage] / max(self.wall_seconds, 1e-9) * 100:.1f}%)"
+
+        summary += f"\nOther: {self.get_other_seconds():.2f}s"
+        summary += f"\n\nTokens Processed: {self.num_of_input_tokens + self.num_of_output_tokens} ({self.num_of_input_tokens} In, {self.num_of_output_tokens} Out)"
+        summary += f"\nCandidates Evaluated: {self.num_of_candidates} ({self.num_of_inferences} Inferences, {self.num_of_reused} Reused)"
+        summary += f"\nCache Hits: {self.num_of_cache_hits}"
+
+        return summary
@@ -0,0 +1,71 @@
+import time
+from scripts.utility.logger import Logger
+
+class CounterfactualBudget:
+
+    __BUDGET_TEXT = "Budget Reached: Evaluated {num_of_evaluated} of {num_of_planned} Planned Inferences"
+
+    def __init__(self, max_seconds: float = None, max_inferences: int = None):
+
+        if max_seconds is not None and max_seconds <= 0:
+            Logger.raise_exception("Budget time limit must be positive.")
+
+        if max_inferences is not None and max_inferences < 0:
+            Logger.raise_exception("Budget inference limit must not be negative.")
+
+        self.max_seconds = max_seconds
+        self.max_inferences = max_inferences
+
+        self.num_of_planned = 0
+        self.num_of_evaluated = 0
+        self.__start_time = None
+
+
+    def start(self):
+
+        self.num_of_planned = 0
+        self.num_of_evaluated = 0
+        self.__start_time = time.perf_counter()
+
+
+    def elapsed_time(self) -> float:
+
+        if self.__start_time is None:
+            return 0.0
+
+        return time.perf_counter() - self.__start_time
+
+
+    def get_remaining_inferences(self) -> int:
+
+        if self.max_inferences is None:
+            return None
+
+        return max(self.max_inferences - self.num_of_evaluated, 0)
+
+
+    def is_out_of_time(self) -> bool:
+
+        return self.max_seconds is not None and self.elapsed_time() >= self.max_seconds
+
+
+    def is_exhausted(self) -> bool:
+
+        return self.is_out_of_time() or self.get_remaining_inferences() == 0
+
+
+    def is_limited(self) -> bool:
+
+        return self.max_seconds is not None or self.max_inferences is not None
+
+
+    def is_complete(self) -> bool:
+
+        return self.num_of_evaluated >= self.num_of_planned
+
+
+    def get_summary_text(self) -> str:
+
+        return self.__BUDGET_TEXT.format(
+            num_of_evaluated = self.num_of_evaluated,
+            num_of_planned = self.num_of_planned)
@@ -1,175 +1,503 @@
 from custom.scripts.pre_treained_llm import PreTrainedLLM
 from scripts.utility.logger import Logger
-import re
-from nltk.corpus import wordnet
+from custom.scripts.wordnet_index import WordNetIndex
+from custom.scripts.model_registry import ModelRegistry
+from custom.scripts.counterfactual_budget import CounterfactualBudget
+from custom.scripts.counterfactual_results import CounterfactualResults
+from custom.scripts.cost_report import CostReport
+from custom.scripts.result_store import ResultStore
+from custom.scripts.flip_search import FlipSearch
+from custom.scripts.embedding_neighbours import EmbeddingNeighbours
+from custom.scripts.sharded_llm import ShardedLLM
+from custom.scripts.perturbation_planner import PerturbationPlanner, PerturbationPlan, PerturbationCandidate
+import os, time, bisect
 
 class CounterfactualGenerator:
     
     MIN_WORD_LEN = 3
     INCLUDE_MULTI_WORD_SYNONYMS = False
-    SYNONYM = 0
-    ANTONYM = 1
+    SYNONYM = CounterfactualResults.SYNONYM
+    ANTONYM = CounterfactualResults.ANTONYM
     
-    def __get_clean_string(value: str) -> str:
-        return re.sub(r'[^A-Za-z ]', '', value)
+    FULL_DECODING = 0
+    MATCH_ONLY_DECODING = 1
+    LIKELIHOOD_SCORING = 2
+    DECODING_MODE = FULL_DECODING
+    DIVERGED_OUTPUT = "[Differs from original output]"
     
-    def __get_words(value: str) -> list[str]:
-        return CounterfactualGenerator.__get_clean_string(value).split(" ")
+    ANALYSIS_MODEL_FOLDER_PATH = r"C:\Users\karki\Qwen2.5-7B"
+    ANALYSIS_DISABLED_TEXT = "Independent LLM analysis disabled."
+    MODE_NAMES = {SYNONYM: "synonym", ANTONYM: "antonym"}
+    
+    WORDNET_INDEX_PATH = WordNetIndex.DEFAULT_INDEX_PATH
+    
+    ## Where synonym substitutions come from. Embedding neighbours are the
+    ## words closest to each report word in the model's own input embedding
+    ## table, so they include the model's domain vocabulary that WordNet
+    ## lacks. Antonyms always come from WordNet.
+    WORDNET_SOURCE = "wordnet"
+    EMBEDDING_SOURCE = "embedding"
+    CANDIDATE_SOURCES = (WORDNET_SOURCE, EMBEDDING_SOURCE)
+    CANDIDATE_SOURCE = WORDNET_SOURCE
+    NUM_OF_NEIGHBOURS = EmbeddingNeighbours.DEFAULT_NUM_OF_NEIGHBOURS
+    NEIGHBOUR_CORPUS_PATH = EmbeddingNeighbours.DEFAULT_CORPUS_PATH
+    
+    ## When an edited report is re-run, rows for words further than this many
+    ## words from every edit are reused from the previous run. The model reads
+    ## the whole report, so a larger window trades speed for fidelity.
+    REUSE_CONTEXT_WORDS = 5
+    
+    ## Also search for the fewest substitutions that change the prediction, 
+    ## see FlipSearch. Needs a model type that supports likelihood scoring.
+    FLIP_SEARCH = False
+    FLIP_BEAM_WIDTH = FlipSearch.DEFAULT_BEAM_WIDTH
+    FLIP_MAX_EDITS = FlipSearch.DEFAULT_MAX_EDITS
+    FLIP_POOL_SIZE = FlipSearch.DEFAULT_POOL_SIZE
+    FLIP_MAX_INFERENCES = FlipSearch.DEFAULT_MAX_INFERENCES
+    
+    __FLIP_TEXT = "\n\nMinimal Flip ({num_of_edits} Word{plural}): {edits}\n└──>New Output: \"{output}\""
+    __NO_FLIP_TEXT = "\n\nNo Minimal Flip Found Within {max_edits} Words"
+    __wordnet_index = None
+    __embedding_neighbours = None
+    
+    def __get_wordnet_index() -> WordNetIndex:
+        
+        if CounterfactualGenerator.__wordnet_index is None:
+            
+            if os.path.exists(CounterfactualGenerator.WORDNET_INDEX_PATH):
+                CounterfactualGenerator.__wordnet_index = WordNetIndex(CounterfactualGenerator.WORDNET_INDEX_PATH)
+            
+            else:
+                Logger.log_warning(f"WordNet index not found at '{CounterfactualGenerator.WORDNET_INDEX_PATH}'. Using live WordNet lookups.")
+                CounterfactualGenerator.__wordnet_index = False
+                
+        return CounterfactualGenerator.__wordnet_index
     
     def __get_synonyms(word: str) -> list[str]:
-        synonyms = set()
+        wordnet_index = CounterfactualGenerator.__get_wordnet_index()
         
-        for synset in wordnet.synsets(word):
-            for lemma in synset.lemmas():
-                synonym = lemma.name().replace("_", " ")  # Replace underscores with spaces
-                if synonym.lower() != word.lower():  # Exclude the original word
-                    synonyms.add(synonym)
-                    
-        return list(synonyms)
+        if wordnet_index:
+            return wordnet_index.get_synonyms(word)
+        
+        return WordNetIndex.get_live_synonyms(word)
+    
+    def __get_embedding_neighbours(llm: PreTrainedLLM) -> EmbeddingNeighbours:
+        
+        if llm is None:
+            Logger.raise_exception("Embedding neighbour candidates need the model.")
+        
+        ## Shards share the weights, so the table is built from the local copy.
+        if isinstance(llm, ShardedLLM):
+            llm = llm.llm
+        
+        embedding_neighbours = CounterfactualGenerator.__embedding_neighbours
+        
+        if (embedding_neighbours is None 
+            or embedding_neighbours.key != llm.get_weights_hash() 
+            or embedding_neighbours.num_of_neighbours != CounterfactualGenerator.NUM_OF_NEIGHBOURS
+            or embedding_neighbours.min_word_len != CounterfactualGenerator.MIN_WORD_LEN
+            or embedding_neighbours.corpus_path != CounterfactualGenerator.NEIGHBOUR_CORPUS_PATH):
+            
+            CounterfactualGenerator.__embedding_neighbours = EmbeddingNeighbours(
+                llm, 
+                CounterfactualGenerator.NUM_OF_NEIGHBOURS,
+                CounterfactualGenerator.MIN_WORD_LEN,
+                CounterfactualGenerator.NEIGHBOUR_CORPUS_PATH)
+            
+        return CounterfactualGenerator.__embedding_neighbours
     
     def __get_antonyms(word: str) -> list[str]:
-        antonyms = set()
+        wordnet_index = CounterfactualGenerator.__get_wordnet_index()
         
-        for syn in wordnet.synsets(word):
-            for lemma in syn.lemmas():
-                if lemma.antonyms():  # Check if antonyms exist
-                    for antonym in lemma.antonyms():
-                        antonyms.add(antonym.name().replace("_", " "))  # Replace underscores with spaces
-                        
-        return list(antonyms)
+        if wordnet_index:
+            return wordnet_index.get_antonyms(word)
         
+        return WordNetIndex.get_live_antonyms(word)
         
-    def __get_counterfactual_outputs(window,
-                                     input: str, 
-                                     llm: PreTrainedLLM, 
-                                     mode = SYNONYM) -> dict[str, list[tuple[str, str]]]:
         
-        counterfactuals: dict[str, list[tuple[str, str]]] = {}
+    def __get_candidate_outputs(input_texts: list[str], 
+                                original_output: str, 
+                                original_score: float,
+                                llm: PreTrainedLLM) -> list[tuple[str, float]]:
         
-        input_word_list = CounterfactualGenerator.__get_words(input)
+        if CounterfactualGenerator.DECODING_MODE == CounterfactualGenerator.MATCH_ONLY_DECODING:
+            return [(original_output if match else CounterfactualGenerator.DIVERGED_OUTPUT, None) 
+                    for match in llm.get_matches(input_texts, original_output)]
+            
+        elif CounterfactualGenerator.DECODING_MODE == CounterfactualGenerator.LIKELIHOOD_SCORING:
+            return [(original_output if match else CounterfactualGenerator.DIVERGED_OUTPUT, original_score - score) 
+                    for score, match in llm.get_scores_and_matches(input_texts, original_output)]
         
-        num_of_items = len(input_word_list)
-        completed_num_items = 0
+        return [(new_output, None) for new_output in llm.get_outputs(input_texts)]
         
-        for word in input_word_list:
-            counterfactuals[word] = []
+        
+    def __get_replacements(word: str, mode: int) -> list[str]:
+        
+        if mode == CounterfactualGenerator.SYNONYM:
+            new_words = CounterfactualGenerator.__get_synonyms(word)
+        elif mode == CounterfactualGenerator.ANTONYM:
+            new_words = CounterfactualGenerator.__get_antonyms(word)
+        else:
+            Logger.raise_exception("Invalid mode. Use SYNONYM or ANTONYM.")
+        
+        return [new_word for new_word in new_words 
+                if CounterfactualGenerator.INCLUDE_MULTI_WORD_SYNONYMS or " " not in new_word]
+    
+    
+    def __get_word_label(candidate: PerturbationCandidate) -> str:
+        
+        if candidate.occurrence == 1:
+            return candidate.word
+        
+        return f"{candidate.word} (occurrence {candidate.occurrence})"
+    
+    
+    def get_plan(input: str, cost_report: CostReport = None, llm: PreTrainedLLM = None) -> PerturbationPlan:
+        
+        lookup_seconds = 0.0
+        start_time = time.perf_counter()
+        get_replacements = CounterfactualGenerator.__get_replacements
+        
+        if CounterfactualGenerator.CANDIDATE_SOURCE == CounterfactualGenerator.EMBEDDING_SOURCE:
+            embedding_neighbours = CounterfactualGenerator.__get_embedding_neighbours(llm)
             
-            if len(word) > 3:
+            ## Every word of the report is looked up in one batch up front.
+            embedding_neighbours.prefetch([word for word, _, _ in PerturbationPlanner.get_word_spans(input) 
+                                           if len(word) > CounterfactualGenerator.MIN_WORD_LEN])
+            
+            def get_replacements(word: str, mode: int) -> list[str]:
                 
                 if mode == CounterfactualGenerator.SYNONYM:
-                    new_words = CounterfactualGenerator.__get_synonyms(word)
-                elif mode == CounterfactualGenerator.ANTONYM:
-                    new_words = CounterfactualGenerator.__get_antonyms(word)
-                else:
-                    Logger.raise_exception("Invalid mode. Use SYNONYM or ANTONYM.")
+                    return embedding_neighbours.get_neighbours(word)
                 
-                for new_word in new_words:
-                    if " " not in new_word:
-                        
-                        new_input = input.replace(word, new_word)
-                        
-                        llm.set_input_text(new_input)
-                        
-                        counterfactuals[word].append((new_word, llm.get_output()))
+                return CounterfactualGenerator.__get_replacements(word, mode)
             
-            completed_num_items += 1
-            percentage = int((completed_num_items / num_of_items) * 100)
-              
-            if mode == CounterfactualGenerator.SYNONYM:
-                window.get_elem("LOADING_BAR_TEXT").update_text(window.win_dim, f"Generating Synonym Counterfactuals: {percentage}%")
-                
-            elif mode == CounterfactualGenerator.ANTONYM:
-                window.get_elem("LOADING_BAR_TEXT").update_text(window.win_dim, f"Generating Antonym Counterfactuals: {percentage}%")
+            lookup_seconds += time.perf_counter() - start_time
+        
+        if cost_report is None:
+            return PerturbationPlanner.plan(
+                input,
+                [CounterfactualGenerator.SYNONYM, CounterfactualGenerator.ANTONYM],
+                get_replacements,
+                CounterfactualGenerator.MIN_WORD_LEN)
+        
+        def get_timed_replacements(word: str, mode: int) -> list[str]:
+            nonlocal lookup_seconds
             
-            window.events()
-            window.draw()
-                        
-        return counterfactuals
+            lookup_start_time = time.perf_counter()
+            replacements = get_replacements(word, mode)
+            lookup_seconds += time.perf_counter() - lookup_start_time
+            
+            return replacements
+        
+        plan = PerturbationPlanner.plan(
+            input,
+            [CounterfactualGenerator.SYNONYM, CounterfactualGenerator.ANTONYM],
+            get_timed_replacements,
+            CounterfactualGenerator.MIN_WORD_LEN)
+        
+        ## Everything in planning that is not a candidate lookup builds strings.
+        cost_report.add_seconds(CostReport.WORDNET_STAGE, lookup_seconds)
+        cost_report.add_seconds(CostReport.STRING_BUILDING_STAGE, time.perf_counter() - start_time - lookup_seconds)
+        
+        return plan
+        
+        
+    def __get_text_order(plan: PerturbationPlan, 
+                         input: str, 
+                         output: str, 
+                         llm: PreTrainedLLM) -> list[int]:
+        
+        if llm.model_type == PreTrainedLLM.QWEN:
+            Logger.log_warning("Sensitivity ranking is not supported for the QWEN model type. Using input order.")
+            return list(range(plan.get_num_of_inferences()))
+        
+        if llm.is_quantized():
+            Logger.log_warning("Sensitivity ranking needs gradients, which quantized models do not support. Using input order.")
+            return list(range(plan.get_num_of_inferences()))
+        
+        token_saliency = llm.get_token_saliency(input, output)
+        text_sensitivity = [0.0] * plan.get_num_of_inferences()
+        
+        for candidate in plan.candidates:
+            word_sensitivity = max(
+                [saliency for start, end, saliency in token_saliency if start < candidate.end and end > candidate.start], 
+                default=0.0)
+            
+            text_sensitivity[candidate.text_index] = max(text_sensitivity[candidate.text_index], word_sensitivity)
+        
+        return sorted(range(plan.get_num_of_inferences()), key=lambda text_index: -text_sensitivity[text_index])
+        
+        
+    def __get_reused_outputs(plan: PerturbationPlan, 
+                             output: str, 
+                             original_score: float, 
+                             previous_results: CounterfactualResults) -> dict[int, tuple[str, float]]:
+        
+        if (previous_results is None or 
+            previous_results.input is None or
+            previous_results.original_output != output or
+            previous_results.decoding_mode != CounterfactualGenerator.DECODING_MODE):
+            return {}
+        
+        previous_outputs = {
+            (int(previous_results.position[row]), previous_results.replacement[row]): 
+            (previous_results.get_output(row), previous_results.get_confidence_drop(row)) 
+            for row in range(len(previous_results))}
+        
+        ## Drops are relative to the original's score, which the edit changed.
+        score_shift = 0.0
+        if original_score is not None and previous_results.original_score is not None:
+            score_shift = original_score - previous_results.original_score
+        
+        unchanged_spans = PerturbationPlanner.get_unchanged_spans(previous_results.input, plan.input, CounterfactualGenerator.REUSE_CONTEXT_WORDS)
+        unchanged_starts = [start for start, _, _ in unchanged_spans]
+        reused_outputs = {}
+        
+        for text_index, candidates in enumerate(plan.text_candidates):
+            candidate = candidates[0]
+            span_index = bisect.bisect_right(unchanged_starts, candidate.start) - 1
+            
+            if span_index < 0 or candidate.end > unchanged_spans[span_index][1]:
+                continue
+            
+            start, _, previous_start = unchanged_spans[span_index]
+            previous_output = previous_outputs.get((candidate.start - start + previous_start, candidate.replacement))
+            
+            if previous_output is not None:
+                new_output, confidence_drop = previous_output
+                reused_outputs[text_index] = (new_output, None if confidence_drop is None else confidence_drop + score_shift)
+        
+        return reused_outputs
     
     
-    def get_output_str(original_output: str,
-                       counterfactual_data: dict[str, list[tuple[str, str]]],
-                       include_correct: bool = True,
-                       include_incorrect: bool = True) -> str:
+    def __send_partial_rows(plan: PerturbationPlan, 
+                            text_indexes: list[int], 
+                            text_outputs: list[tuple[str, float]], 
+                            partial_callback):
         
-        output = ""
+        batch_rows: dict[int, list[tuple[str, tuple[str, str, float]]]] = {}
         
-        for word in counterfactual_data:
+        for text_index in text_indexes:
+            new_output, confidence_drop = text_outputs[text_index]
             
-            correct = False
-            incorrect = False
+            for candidate in plan.text_candidates[text_index]:
+                batch_rows.setdefault(candidate.mode, []).append(
+                    (CounterfactualGenerator.__get_word_label(candidate), 
+                     (candidate.replacement, new_output, confidence_drop)))
+        
+        for mode in batch_rows:
+            partial_callback(mode, batch_rows[mode])
+    
+    
+    def __get_counterfactual_outputs(plan: PerturbationPlan, 
+                                     output: str,
+                                     original_score: float,
+                                     llm: PreTrainedLLM, 
+                                     progress_callback = None,
+                                     partial_callback = None,
+                                     budget: CounterfactualBudget = None,
+                                     cost_report: CostReport = None,
+                                     reused_outputs: dict[int, tuple[str, float]] = None) -> CounterfactualResults:
+        
+        num_of_items = plan.get_num_of_inferences()
+        completed_num_items = 0
+        text_outputs: list[tuple[str, float]] = [None] * num_of_items
+        
+        reused_outputs = reused_outputs or {}
+        for text_index, reused_output in reused_outputs.items():
+            text_outputs[text_index] = reused_output
+        
+        if len(reused_outputs) > 0 and partial_callback is not None:
+            CounterfactualGenerator.__send_partial_rows(plan, sorted(reused_outputs), text_outputs, partial_callback)
+        
+        ## With a budget the most sensitive words are evaluated first, so 
+        ## stopping early still leaves the most informative results.
+        if budget is not None and budget.is_limited() and len(reused_outputs) < num_of_items:
+            text_order = CounterfactualGenerator.__get_text_order(plan, plan.input, output, llm)
+        else:
+            text_order = list(range(num_of_items))
+        
+        text_order = [text_index for text_index in text_order if text_index not in reused_outputs]
+        num_of_inferences = len(text_order)
+        
+        while completed_num_items < num_of_inferences:
+            batch_size = llm.batch_size
             
-            word_output = ""
-            if counterfactual_data[word] != []:
-                
-                word_output += f"\n\nOriginal Word: {word}"
+            if budget is not None:
+                if budget.is_exhausted():
+                    Logger.log_info(f"Counterfactual budget reached after {completed_num_items} of {num_of_inferences} inferences.")
+                    break
                 
-                for i in counterfactual_data[word]:
-                    
-                    replacement_text = f"\nReplaced with: \"{i[0]}\" \n└──>New Output: \"{i[1]}\""
-                    
-                    if i[1] == original_output:
-                        if include_correct:
-                            word_output += replacement_text
-                            
-                        correct = True
-                        
-                    else:
-                        if include_incorrect:
-                            word_output += replacement_text
-                            
-                        incorrect = True
-                        
+                if budget.get_remaining_inferences() is not None:
+                    batch_size = min(batch_size, budget.get_remaining_inferences())
             
-            if (correct and include_correct) or (incorrect and include_incorrect):
-                output += word_output
-                
-        return output[2:] if output != "" else "None."
+            batch_text_indexes = text_order[completed_num_items:completed_num_items + batch_size]
+            
+            batch_outputs = CounterfactualGenerator.__get_candidate_outputs(
+                [plan.texts[text_index] for text_index in batch_text_indexes], 
+                output, 
+                original_score,
+                llm)
+            
+            for text_index, batch_output in zip(batch_text_indexes, batch_outputs):
+                text_outputs[text_index] = batch_output
+            
+            completed_num_items += len(batch_text_indexes)
+            num_of_done_items = completed_num_items + len(reused_outputs)
+            percentage = int((num_of_done_items / num_of_items) * 100)
+            
+            if budget is not None:
+                budget.num_of_evaluated = completed_num_items
+            
+            ui_start_time = time.perf_counter()
+            
+            if partial_callback is not None:
+                CounterfactualGenerator.__send_partial_rows(plan, batch_text_indexes, text_outputs, partial_callback)
+            
+            if progress_callback is not None:
+                progress_callback(f"Generating Counterfactuals: {num_of_done_items}/{num_of_items} ({percentage}%)")
+            
+            if cost_report is not None:
+                cost_report.add_seconds(CostReport.UI_STAGE, time.perf_counter() - ui_start_time)
+        
+        evaluated_candidates = [candidate for candidate in plan.candidates if text_outputs[candidate.text_index] is not None]
+        
+        if cost_report is not None:
+            cost_report.num_of_candidates = len(evaluated_candidates)
+            cost_report.num_of_inferences = completed_num_items
+            cost_report.num_of_reused = len(reused_outputs)
+                        
+        return CounterfactualResults(
+            output,
+            [candidate.word for candidate in evaluated_candidates],
+            [candidate.occurrence for candidate in evaluated_candidates],
+            [candidate.start for candidate in evaluated_candidates],
+            [candidate.replacement for candidate in evaluated_candidates],
+            [candidate.mode for candidate in evaluated_candidates],
+            [text_outputs[candidate.text_index][0] for candidate in evaluated_candidates],
+            [text_outputs[candidate.text_index][1] for candidate in evaluated_candidates],
+            plan.input,
+            original_score,
+            CounterfactualGenerator.DECODING_MODE)
     
     
-    def get_output(window, input: str, output: str, llm: PreTrainedLLM):
+    def get_counterfactuals(input: str, 
+                            output: str, 
+                            llm: PreTrainedLLM, 
+                            progress_callback = None, 
+                            partial_callback = None,
+                            budget: CounterfactualBudget = None,
+                            cost_report: CostReport = None,
+                            previous_results: CounterfactualResults = None) -> CounterfactualResults:
         
         Logger.log_info(f"Generating Counterfactuals for: {input} \n\nOutput: {output}")
+        
+        if budget is not None:
+            budget.start()
+        
+        if cost_report is not None:
+            cost_report.start(llm)
+        
+        ## Candidates differ from the report by one word, so their token ids
+        ## are spliced from the report's rather than tokenised from scratch.
+        llm.set_splice_source(input)
+        
+        original_score = None
+        if CounterfactualGenerator.DECODING_MODE == CounterfactualGenerator.LIKELIHOOD_SCORING:
+            original_score = llm.score([input], output)[0]
 
-        synonsyms = CounterfactualGenerator.__get_counterfactual_outputs(
-            window,
-            input,
+        plan = CounterfactualGenerator.get_plan(input, cost_report, llm)
+        
+        Logger.log_info(f"Planned {plan.get_num_of_candidates()} counterfactuals needing {plan.get_num_of_inferences()} inferences.")
+        
+        reused_outputs = CounterfactualGenerator.__get_reused_outputs(plan, output, original_score, previous_results)
+        
+        if len(reused_outputs) > 0:
+            Logger.log_info(f"Reusing {len(reused_outputs)} inferences from the previous run of an edited report.")
+        
+        if budget is not None:
+            budget.num_of_planned = plan.get_num_of_inferences() - len(reused_outputs)
+
+        results = CounterfactualGenerator.__get_counterfactual_outputs(
+            plan,
+            output,
+            original_score,
             llm,
-            CounterfactualGenerator.SYNONYM
+            progress_callback,
+            partial_callback,
+            budget,
+            cost_report,
+            reused_outputs
         )
         
-        antonyms = CounterfactualGenerator.__get_counterfactual_outputs(
-            window,
-            input,
+        Logger.log_info(f"Prediction cache stats: {llm.get_cache_stats()}")
+        
+        if cost_report is not None:
+            cost_report.update(llm)
+        
+        return results
+    
+    
+    def get_minimal_flips(input: str, 
+                          output: str, 
+                          llm: PreTrainedLLM, 
+                          progress_callback = None, 
+                          budget: CounterfactualBudget = None) -> list[dict]:
+        
+        Logger.log_info(f"Searching for minimal flips of: {output}")
+        
+        llm.set_splice_source(input)
+        
+        return FlipSearch.search(
+            CounterfactualGenerator.get_plan(input, llm=llm),
+            output,
             llm,
-            CounterfactualGenerator.ANTONYM
-        )
+            CounterfactualGenerator.FLIP_BEAM_WIDTH,
+            CounterfactualGenerator.FLIP_MAX_EDITS,
+            CounterfactualGenerator.FLIP_POOL_SIZE,
+            CounterfactualGenerator.FLIP_MAX_INFERENCES,
+            budget=budget,
+            progress_callback=progress_callback)
+    
+    
+    def get_flip_summary(minimal_flips: list[dict]) -> str:
         
-        num_of_items = 0
-        num_of_matching_predictions = 0
+        if len(minimal_flips) == 0:
+            return CounterfactualGenerator.__NO_FLIP_TEXT.format(max_edits=CounterfactualGenerator.FLIP_MAX_EDITS)
         
-        for word in synonsyms:
-            num_of_items += len(synonsyms[word])
-            
-            for i in synonsyms[word]:
-                if i[1] == output:
-                    num_of_matching_predictions += 1
-                    
-        for word in antonyms:
-            num_of_items += len(antonyms[word])
-            
-            for i in antonyms[word]:
-                if i[1] == output:
-                    num_of_matching_predictions += 1
+        return "".join(CounterfactualGenerator.__FLIP_TEXT.format(
+            num_of_edits=len(flip["edits"]),
+            plural="" if len(flip["edits"]) == 1 else "s",
+            edits=", ".join(f"\"{edit['word']}\" -> \"{edit['replacement']}\"" for edit in flip["edits"]),
+            output=flip["output"]) for flip in minimal_flips)
+    
+    
+    def get_rows(results: CounterfactualResults) -> list[dict]:
+        
+        return [{
+            "word": results.word[row],
+            "position": int(results.position[row]),
+            "mode": CounterfactualGenerator.MODE_NAMES[int(results.mode[row])],
+            "replacement": results.replacement[row],
+            "output": results.get_output(row),
+            "matched": bool(results.matched[row]),
+            "confidence_drop": results.get_confidence_drop(row)
+        } for row in range(len(results))]
+    
+    
+    def get_summary(results: CounterfactualResults, budget: CounterfactualBudget = None) -> str:
         
-        synonyms_text = CounterfactualGenerator.get_output_str(output, synonsyms, True, True)
-        correct_synonyms = CounterfactualGenerator.get_output_str(output, synonsyms, True, False)
-        incorrect_synonyms = CounterfactualGenerator.get_output_str(output, synonsyms, False, True)
-           
-        antonyms_text = CounterfactualGenerator.get_output_str(output, antonyms, True, True)
-        correct_antonyms = CounterfactualGenerator.get_output_str(output, antonyms, True, False)
-        incorrect_antonyms = CounterfactualGenerator.get_output_str(output, antonyms, False, True)
+        num_of_items = results.get_num_of_rows()
+        num_of_matching_predictions = results.get_num_of_matching()
+        confidence_drops = results.get_confidence_drops()
         
+        budget_text = ""
+        if budget is not None and not budget.is_complete():
+            budget_text = "\n\n" + budget.get_summary_text()
+        
+        if num_of_items == 0:
+            return "Number of Counterfactuals: 0" + budget_text
                     
         summary = f"Number of Counterfactuals: {num_of_items}"
         summary += f"\nNumber of Matching Predictions: {num_of_matching_predictions}"
@@ -177,13 +505,20 @@ class CounterfactualGenerator:
         summary += f"\n\nNumber of Non-matching Predictions: {num_of_items - num_of_matching_predictions}"
         summary += f"\nPercentage of Non-matching Predictions: {(num_of_items - num_of_matching_predictions) / num_of_items * 100:.2f}%"
         
+        if len(confidence_drops) > 0:
+            summary += f"\n\nMean Confidence Drop: {confidence_drops.mean():.3f}"
+            summary += f"\nMax Confidence Drop: {confidence_drops.max():.3f}"
+            
+        return summary + budget_text
+    
+    
+    def __get_analysis_llm(input: str, 
+                           output: str, 
+                           summary: str, 
+                           incorrect_synonyms: str, 
+                           incorrect_antonyms: str) -> PreTrainedLLM:
         
-        window.get_elem("LOADING_BAR_TEXT").update_text(window.win_dim, f"Generating Independent LLM Analysis...")
-        window.events()
-        window.draw()
-        
-        analysis_llm = PreTrainedLLM(model_type=PreTrainedLLM.QWEN)
-        analysis_llm.set_model_folder_path(r"C:\Users\karki\Qwen2.5-7B")
+        analysis_llm = ModelRegistry.get_model(CounterfactualGenerator.ANALYSIS_MODEL_FOLDER_PATH, PreTrainedLLM.QWEN)
         analysis_llm.max_input_length = 4000
         analysis_llm.max_output_length = 4000
         information = """
@@ -217,22 +552,198 @@ Antonym Non-Matching Predictions:
 
         analysis_llm.set_input_text(analysis_input)
         
-        # counterfactual_analysis = ""
+        return analysis_llm
+    
+    
+    def get_analysis(input: str, 
+                     output: str, 
+                     summary: str, 
+                     incorrect_synonyms: str, 
+                     incorrect_antonyms: str) -> str:
+        
+        analysis_llm = CounterfactualGenerator.__get_analysis_llm(input, output, summary, incorrect_synonyms, incorrect_antonyms)
         
         counterfactual_analysis = analysis_llm.get_output()
         
         print(counterfactual_analysis)
         
+        return counterfactual_analysis
+    
+    
+    def get_analysis_stream(input: str, 
+                            output: str, 
+                            summary: str, 
+                            incorrect_synonyms: str, 
+                            incorrect_antonyms: str):
+        
+        analysis_llm = CounterfactualGenerator.__get_analysis_llm(input, output, summary, incorrect_synonyms, incorrect_antonyms)
+        
+        return analysis_llm.get_output_stream()
+    
+    
+    def __get_file_identity(file_path: str) -> str:
+        
+        if not os.path.exists(file_path):
+            return None
+        
+        return f"{os.path.abspath(file_path)}:{os.path.getsize(file_path)}:{os.path.getmtime(file_path)}"
+    
+    
+    def get_result_key(input: str, output: str, llm: PreTrainedLLM, include_analysis: bool) -> str:
+        
+        wordnet_identity = CounterfactualGenerator.__get_file_identity(CounterfactualGenerator.WORDNET_INDEX_PATH) or "live"
+        
+        return ResultStore.get_key(
+            llm.get_result_identity(),
+            CounterfactualGenerator.DECODING_MODE,
+            CounterfactualGenerator.MIN_WORD_LEN,
+            CounterfactualGenerator.INCLUDE_MULTI_WORD_SYNONYMS,
+            wordnet_identity,
+            (CounterfactualGenerator.CANDIDATE_SOURCE, 
+             CounterfactualGenerator.NUM_OF_NEIGHBOURS,
+             CounterfactualGenerator.__get_file_identity(CounterfactualGenerator.NEIGHBOUR_CORPUS_PATH)) if CounterfactualGenerator.CANDIDATE_SOURCE == CounterfactualGenerator.EMBEDDING_SOURCE else None,
+            CounterfactualGenerator.ANALYSIS_MODEL_FOLDER_PATH if include_analysis else None,
+            (CounterfactualGenerator.FLIP_BEAM_WIDTH, 
+             CounterfactualGenerator.FLIP_MAX_EDITS, 
+             CounterfactualGenerator.FLIP_POOL_SIZE, 
+             CounterfactualGenerator.FLIP_MAX_INFERENCES) if CounterfactualGenerator.FLIP_SEARCH else None,
+            input,
+            output)
+    
+    
+    def __get_stored_output(stored_result: dict, 
+                            llm: PreTrainedLLM,
+                            progress_callback = None,
+                            budget: CounterfactualBudget = None,
+                            summary_callback = None,
+                            analysis_callback = None,
+                            cost_report: CostReport = None):
+        
+        Logger.log_info("Counterfactual results loaded from the result store.")
+        
+        cost_report.start(llm)
+        cost_report.from_result_store = True
+        
+        results = CounterfactualResults.from_columns(stored_result["results"])
+        summary = stored_result["summary"]
+        counterfactual_analysis = stored_result["analysis"]
+        
+        if budget is not None:
+            budget.num_of_planned = stored_result["num_of_inferences"]
+            budget.num_of_evaluated = stored_result["num_of_inferences"]
+        
+        cost_report.num_of_candidates = len(results)
+        cost_report.num_of_inferences = stored_result["num_of_inferences"]
+        
+        if progress_callback is not None:
+            progress_callback("Loaded From Result Store")
+        
+        if summary_callback is not None:
+            summary_callback(summary, results.views)
+        
+        if analysis_callback is not None:
+            analysis_callback(counterfactual_analysis)
+        
+        cost_report.update(llm)
+        
+        return summary, counterfactual_analysis, results.views, cost_report
+    
+    
+    def get_output(input: str, 
+                   output: str, 
+                   llm: PreTrainedLLM, 
+                   progress_callback = None, 
+                   partial_callback = None,
+                   include_analysis: bool = True,
+                   budget: CounterfactualBudget = None,
+                   summary_callback = None,
+                   analysis_callback = None,
+                   cost_report: CostReport = None,
+                   result_store: ResultStore = None,
+                   previous_results: CounterfactualResults = None):
+        
+        if cost_report is None:
+            cost_report = CostReport()
+        
+        if result_store is not None:
+            result_key = CounterfactualGenerator.get_result_key(input, output, llm, include_analysis)
+            stored_result = result_store.get(result_key)
+            
+            if stored_result is not None:
+                return CounterfactualGenerator.__get_stored_output(
+                    stored_result, 
+                    llm, 
+                    progress_callback, 
+                    budget, 
+                    summary_callback, 
+                    analysis_callback, 
+                    cost_report)
+        
+        results = CounterfactualGenerator.get_counterfactuals(
+            input,
+            output,
+            llm,
+            progress_callback,
+            partial_callback,
+            budget,
+            cost_report,
+            previous_results
+        )
+        
+        summary = CounterfactualGenerator.get_summary(results, budget)
+        
+        if CounterfactualGenerator.FLIP_SEARCH:
+            results.minimal_flips = CounterfactualGenerator.get_minimal_flips(input, output, llm, progress_callback, budget)
+            summary += CounterfactualGenerator.get_flip_summary(results.minimal_flips)
+        
+        if summary_callback is not None:
+            summary_callback(summary, results.views)
+        
+        if include_analysis:
+            if progress_callback is not None:
+                progress_callback("Generating Independent LLM Analysis...")
+            
+            analysis_args = (
+                input, 
+                output, 
+                summary, 
+                results.views[CounterfactualResults.DISPLAY_INCORRECT_SYNONYMS], 
+                results.views[CounterfactualResults.DISPLAY_INCORRECT_ANTONYMS])
+            
+            analysis_start_time = time.perf_counter()
+            ui_seconds = 0.0
+            
+            if analysis_callback is None:
+                counterfactual_analysis = CounterfactualGenerator.get_analysis(*analysis_args)
+            
+            ## Streamed so the first tokens can be shown while the rest generate.
+            else:
+                counterfactual_analysis = ""
+                
+                for delta in CounterfactualGenerator.get_analysis_stream(*analysis_args):
+                    counterfactual_analysis += delta
+                    
+                    ui_start_time = time.perf_counter()
+                    analysis_callback(delta)
+                    ui_seconds += time.perf_counter() - ui_start_time
+            
+            cost_report.add_seconds(CostReport.ANALYSIS_STAGE, time.perf_counter() - analysis_start_time - ui_seconds)
+            cost_report.add_seconds(CostReport.UI_STAGE, ui_seconds)
+            
+        else:
+            counterfactual_analysis = CounterfactualGenerator.ANALYSIS_DISABLED_TEXT
+        
+        cost_report.update(llm)
         
-        all_outputs = {
-        "DISPLAY_ALL": synonyms_text + antonyms_text,
-        "DISPLAY_SYNONYMS": synonyms_text,
-        "DISPLAY_CORRECT_SYNONYMS": correct_synonyms,
-        "DISPLAY_INCORRECT_SYNONYMS": incorrect_synonyms,
-        "DISPLAY_ANTONYMS": antonyms_text,
-        "DISPLAY_CORRECT_ANTONYMS": correct_antonyms,
-        "DISPLAY_INCORRECT_ANTONYMS": incorrect_antonyms
-        }
+        ## Runs cut short by a budget or partly reused from an earlier report 
+        ## are not the full result for this key.
+        if result_store is not None and (budget is None or budget.is_complete()) and cost_report.num_of_reused == 0:
+            result_store.put(result_key, {
+                "summary": summary,
+                "analysis": counterfactual_analysis,
+                "num_of_inferences": cost_report.num_of_inferences,
+                "results": results.to_columns()
+            })
         
-        return summary, counterfactual_analysis, all_outputs
-            
\ No newline at end of file
+        ## Views are rendered lazily the first time the UI asks for them.
+        return summary, counterfactual_analysis, results.views, cost_report
@@ -0,0 +1,201 @@
+import numpy as np
+from collections.abc import Mapping
+
+class CounterfactualResults:
+
+    SYNONYM = 0
+    ANTONYM = 1
+
+    DISPLAY_ALL = "DISPLAY_ALL"
+    DISPLAY_SYNONYMS = "DISPLAY_SYNONYMS"
+    DISPLAY_CORRECT_SYNONYMS = "DISPLAY_CORRECT_SYNONYMS"
+    DISPLAY_INCORRECT_SYNONYMS = "DISPLAY_INCORRECT_SYNONYMS"
+    DISPLAY_ANTONYMS = "DISPLAY_ANTONYMS"
+    DISPLAY_CORRECT_ANTONYMS = "DISPLAY_CORRECT_ANTONYMS"
+    DISPLAY_INCORRECT_ANTONYMS = "DISPLAY_INCORRECT_ANTONYMS"
+
+    ## View name -> (modes, include correct, include incorrect).
+    VIEWS = {
+        DISPLAY_ALL: ((SYNONYM, ANTONYM), True, True),
+        DISPLAY_SYNONYMS: ((SYNONYM,), True, True),
+        DISPLAY_CORRECT_SYNONYMS: ((SYNONYM,), True, False),
+        DISPLAY_INCORRECT_SYNONYMS: ((SYNONYM,), False, True),
+        DISPLAY_ANTONYMS: ((ANTONYM,), True, True),
+        DISPLAY_CORRECT_ANTONYMS: ((ANTONYM,), True, False),
+        DISPLAY_INCORRECT_ANTONYMS: ((ANTONYM,), False, True)
+    }
+
+    __NO_RESULTS_TEXT = "None."
+    __WORD_TEXT = "Original Word: {word}"
+    __REPEATED_WORD_TEXT = "Original Word: {word} (occurrence {occurrence})"
+    __REPLACEMENT_TEXT = "\nReplaced with: \"{replacement}\" \n└──>New Output: \"{output}\""
+    __CONFIDENCE_DROP_TEXT = " (Confidence Drop: {confidence_drop:.3f})"
+
+    def __init__(self,
+                 original_output: str,
+                 words: list[str],
+                 occurrences: list[int],
+                 positions: list[int],
+                 replacements: list[str],
+                 modes: list[int],
+                 outputs: list[str],
+                 confidence_drops: list[float],
+                 input: str = None,
+                 original_score: float = None,
+                 decoding_mode: int = None,
+                 minimal_flips: list[dict] = None):
+
+        self.original_output = original_output
+
+        ## What the rows were generated from, so an edited report can reuse them.
+        self.input = input
+        self.original_score = original_score
+        self.decoding_mode = decoding_mode
+        self.minimal_flips = minimal_flips
+
+        output_ids: dict[str, int] = {}
+        self.outputs: list[str] = []
+
+        for output in outputs:
+            if output not in output_ids:
+                output_ids[output] = len(self.outputs)
+                self.outputs.append(output)
+
+        self.word = np.array(words, dtype=object)
+        self.occurrence = np.array(occurrences, dtype=np.int32)
+        self.position = np.array(positions, dtype=np.int64)
+        self.replacement = np.array(replacements, dtype=object)
+        self.mode = np.array(modes, dtype=np.int8)
+        self.output_id = np.array([output_ids[output] for output in outputs], dtype=np.int32)
+        self.score = np.array([np.nan if drop is None else drop for drop in confidence_drops], dtype=np.float32)
+
+        original_output_id = output_ids.get(original_output, -1)
+        self.matched = self.output_id == original_output_id
+
+        self.__mode_indexes = {mode: np.flatnonzero(self.mode == mode) for mode in (self.SYNONYM, self.ANTONYM)}
+        self.__matched_index = np.flatnonzero(self.matched)
+        self.__unmatched_index = np.flatnonzero(~self.matched)
+
+        self.__views: dict[str, str] = {}
+        self.views = CounterfactualViews(self)
+
+
+    def __len__(self) -> int:
+        return len(self.word)
+
+
+    def to_columns(self) -> dict[str, list]:
+
+        return {
+            "original_output": self.original_output,
+            "words": self.word.tolist(),
+            "occurrences": self.occurrence.tolist(),
+            "positions": self.position.tolist(),
+            "replacements": self.replacement.tolist(),
+            "modes": self.mode.tolist(),
+            "outputs": [self.get_output(row) for row in range(len(self))],
+            "confidence_drops": [self.get_confidence_drop(row) for row in range(len(self))],
+            "input": self.input,
+            "original_score": self.original_score,
+            "decoding_mode": self.decoding_mode,
+            "minimal_flips": self.minimal_flips
+        }
+
+
+    def from_columns(columns: dict[str, list]) -> "CounterfactualResults":
+        return CounterfactualResults(**columns)
+
+
+    def get_output(self, row: int) -> str:
+        return self.outputs[self.output_id[row]]
+
+
+    def get_confidence_drop(self, row: int) -> float:
+        return None if np.isnan(self.score[row]) else float(self.score[row])
+
+
+    def get_rows(self, modes: tuple[int] = None, include_correct: bool = True, include_incorrect: bool = True) -> np.ndarray:
+
+        if modes is None:
+            rows = np.arange(len(self))
+        else:
+            rows = np.concatenate([self.__mode_indexes.get(mode, np.empty(0, dtype=np.int64)) for mode in modes])
+
+        if not include_correct:
+            rows = np.intersect1d(rows, self.__unmatched_index, assume_unique=True)
+
+        if not include_incorrect:
+            rows = np.intersect1d(rows, self.__matched_index, assume_unique=True)
+
+        return np.sort(rows)
+
+
+    def get_num_of_rows(self) -> int:
+        return len(self)
+
+
+    def get_num_of_matching(self) -> int:
+        return len(self.__matched_index)
+
+
+    def get_confidence_drops(self) -> np.ndarray:
+        return self.score[~np.isnan(self.score)]
+
+
+    def __get_mode_text(self, mode: int, include_correct: bool, include_incorrect: bool) -> str:
+
+        rows = self.get_rows((mode,), include_correct, include_incorrect)
+
+        ## Rows follow the plan, so each occurrence of a word is contiguous.
+        group_starts = np.flatnonzero(np.diff(self.position[rows], prepend=-1) != 0)
+        group_texts = []
+
+        for group_start, group_end in zip(group_starts, np.append(group_starts[1:], len(rows))):
+            first_row = rows[group_start]
+
+            if self.occurrence[first_row] == 1:
+                group_text = self.__WORD_TEXT.format(word=self.word[first_row])
+            else:
+                group_text = self.__REPEATED_WORD_TEXT.format(word=self.word[first_row], occurrence=self.occurrence[first_row])
+
+            for row in rows[group_start:group_end]:
+                group_text += self.__REPLACEMENT_TEXT.format(replacement=self.replacement[row], output=self.get_output(row))
+
+                if not np.isnan(self.score[row]):
+                    group_text += self.__CONFIDENCE_DROP_TEXT.format(confidence_drop=self.score[row])
+
+            group_texts.append(group_text)
+
+        return "\n\n".join(group_texts)
+
+
+    def get_output_str(self, modes: tuple[int], include_correct: bool = True, include_incorrect: bool = True) -> str:
+
+        mode_texts = [self.__get_mode_text(mode, include_correct, include_incorrect) for mode in modes]
+        output = "\n\n".join(mode_text for mode_text in mode_texts if mode_text != "")
+
+        return output if output != "" else self.__NO_RESULTS_TEXT
+
+
+    def get_view(self, view_name: str) -> str:
+
+        if view_name not in self.__views:
+            modes, include_correct, include_incorrect = self.VIEWS[view_name]
+            self.__views[view_name] = self.get_output_str(modes, include_correct, include_incorrect)
+
+        return self.__views[view_name]
+
+
+class CounterfactualViews(Mapping):
+
+    def __init__(self, results: CounterfactualResults):
+        self.results = results
+
+    def __getitem__(self, view_name: str) -> str:
+        return self.results.get_view(view_name)
+
+    def __iter__(self):
+        return iter(CounterfactualResults.VIEWS)
+
+    def __len__(self) -> int:
+        return len(CounterfactualResults.VIEWS)
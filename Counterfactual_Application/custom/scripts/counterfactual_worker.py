@@ -0,0 +1,88 @@
+import queue, threading
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from custom.scripts.counterfactual_generator import CounterfactualGenerator
+from custom.scripts.counterfactual_budget import CounterfactualBudget
+from custom.scripts.cost_report import CostReport
+from custom.scripts.result_store import ResultStore
+from custom.scripts.counterfactual_results import CounterfactualResults
+from scripts.utility.logger import Logger
+
+class CounterfactualWorker:
+
+    PROGRESS = 0
+    PARTIAL = 1
+    RESULT = 2
+    ERROR = 3
+    SUMMARY = 4
+    ANALYSIS = 5
+
+    def __init__(self):
+        self.__queue = queue.Queue()
+        self.__thread = None
+
+
+    def __run(self, 
+              input: str, 
+              output: str, 
+              llm: PreTrainedLLM, 
+              budget: CounterfactualBudget, 
+              cost_report: CostReport, 
+              result_store: ResultStore,
+              previous_results: CounterfactualResults):
+
+        try:
+            result = CounterfactualGenerator.get_output(
+                input,
+                output,
+                llm,
+                progress_callback = lambda text: self.__queue.put((self.PROGRESS, text)),
+                partial_callback = lambda mode, rows: self.__queue.put((self.PARTIAL, (mode, rows))),
+                budget = budget,
+                summary_callback = lambda summary, views: self.__queue.put((self.SUMMARY, (summary, views))),
+                analysis_callback = lambda delta: self.__queue.put((self.ANALYSIS, delta)),
+                cost_report = cost_report,
+                result_store = result_store,
+                previous_results = previous_results
+            )
+
+            self.__queue.put((self.RESULT, result))
+
+        except Exception as error:
+            Logger.log_error(f"Counterfactual generation failed: {error}")
+            self.__queue.put((self.ERROR, str(error)))
+
+
+    def start(self, 
+              input: str, 
+              output: str, 
+              llm: PreTrainedLLM, 
+              budget: CounterfactualBudget = None, 
+              cost_report: CostReport = None, 
+              result_store: ResultStore = None,
+              previous_results: CounterfactualResults = None):
+
+        if self.is_running():
+            Logger.raise_exception("Counterfactual generation is already running.")
+
+        self.__thread = threading.Thread(
+            target = self.__run,
+            args = (input, output, llm, budget, cost_report, result_store, previous_results),
+            daemon = True)
+
+        self.__thread.start()
+
+
+    def is_running(self) -> bool:
+
+        return self.__thread is not None and self.__thread.is_alive()
+
+
+    def poll(self) -> list[tuple[int, any]]:
+
+        messages = []
+
+        while True:
+            try:
+                messages.append(self.__queue.get_nowait())
+            except queue.Empty:
+                return messages
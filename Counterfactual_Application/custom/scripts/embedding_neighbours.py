@@ -0,0 +1,209 @@
+import csv, os, numpy as np
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from scripts.utility.logger import Logger
+
+class EmbeddingNeighbours:
+    """Nearest whole-word neighbours of a word in the model's own input
+    embedding table, by cosine similarity. The normalised table is computed
+    once per checkpoint and cached, and the neighbours of every word in a
+    report are found with one matrix product and a partial sort.
+
+    A vocabulary piece that starts a word can still be a fragment of longer
+    words, so only pieces seen as a complete word in a corpus of reports are
+    offered as neighbours.
+    """
+
+    DEFAULT_NUM_OF_NEIGHBOURS = 5
+    DEFAULT_CORPUS_PATH = os.path.join("..", "LLM_Training", "airline_incidents_small.csv")
+    CORPUS_COLUMN = "report"
+    CACHE_FOLDER_PATH = os.path.join("cache", "embeddings")
+    MIN_WORD_LEN = 3
+    QUERY_BATCH_SIZE = 256
+
+    ## SentencePiece and byte level BPE mark the start of a word, WordPiece
+    ## marks the continuation instead.
+    __WORD_BOUNDARY_PREFIXES = ("▁", "Ġ")
+    __CONTINUATION_PREFIX = "##"
+
+    __STOPWORDS = frozenset((
+        "a", "about", "above", "after", "again", "against", "all", "also", "am", "an", "and", "any", "are", "as", "at",
+        "be", "because", "been", "before", "being", "below", "between", "both", "but", "by", "can", "could", "did",
+        "do", "does", "doing", "down", "during", "each", "few", "for", "from", "further", "had", "has", "have",
+        "having", "he", "her", "here", "hers", "herself", "him", "himself", "his", "how", "if", "in", "into", "is",
+        "it", "its", "itself", "just", "me", "more", "most", "my", "myself", "no", "nor", "not", "now", "of", "off",
+        "on", "once", "only", "or", "other", "our", "ours", "ourselves", "out", "over", "own", "same", "she",
+        "should", "so", "some", "such", "than", "that", "the", "their", "theirs", "them", "themselves", "then",
+        "there", "these", "they", "this", "those", "through", "to", "too", "under", "until", "up", "upon", "very",
+        "was", "we", "were", "what", "when", "where", "which", "while", "who", "whom", "why", "will", "with",
+        "would", "you", "your", "yours", "yourself", "yourselves"))
+
+    def __init__(self,
+                 llm: PreTrainedLLM,
+                 num_of_neighbours: int = DEFAULT_NUM_OF_NEIGHBOURS,
+                 min_word_len: int = MIN_WORD_LEN,
+                 corpus_path: str = DEFAULT_CORPUS_PATH):
+
+        if num_of_neighbours < 1:
+            Logger.raise_exception("Number of neighbours must be at least 1.")
+
+        self.key = llm.get_weights_hash()
+        self.num_of_neighbours = num_of_neighbours
+        self.min_word_len = min_word_len
+        self.corpus_path = corpus_path
+        self.tokenizer = llm.tokenizer
+
+        cache_path = os.path.join(self.CACHE_FOLDER_PATH, f"{self.key}.npy")
+
+        if os.path.exists(cache_path):
+            Logger.log_info(f"Loading embedding table from cache: '{cache_path}'")
+            self.__matrix = np.load(cache_path)
+        else:
+            self.__matrix = EmbeddingNeighbours.__build(llm)
+
+            os.makedirs(self.CACHE_FOLDER_PATH, exist_ok=True)
+            np.save(cache_path, self.__matrix)
+            Logger.log_info(f"Embedding table cached at: '{cache_path}'")
+
+        self.__pieces = self.tokenizer.convert_ids_to_tokens(list(range(min(len(self.tokenizer), len(self.__matrix)))))
+        self.__uses_word_boundaries = any(piece.startswith(self.__WORD_BOUNDARY_PREFIXES) for piece in self.__pieces)
+
+        candidate_ids = self.__get_candidate_ids()
+
+        self.__candidate_words = [EmbeddingNeighbours.__get_word(self.__pieces[token_id]) for token_id in candidate_ids]
+        self.__candidate_matrix = np.ascontiguousarray(self.__matrix[candidate_ids])
+        self.__neighbours: dict[str, list[str]] = {}
+
+        Logger.log_info(f"{len(candidate_ids)} whole words in the embedding table can be offered as neighbours.")
+
+
+    def __get_word(piece: str) -> str:
+
+        for prefix in EmbeddingNeighbours.__WORD_BOUNDARY_PREFIXES:
+            if piece.startswith(prefix):
+                return piece[len(prefix):]
+
+        return piece
+
+
+    def __build(llm: PreTrainedLLM) -> np.ndarray:
+
+        Logger.log_info("Normalising the model's input embedding table.")
+
+        matrix = llm.model.get_input_embeddings().weight.detach().float().cpu().numpy()
+        matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+        return matrix.astype(np.float32)
+
+
+    def __starts_word(self, piece: str) -> bool:
+
+        if self.__uses_word_boundaries:
+            return piece.startswith(self.__WORD_BOUNDARY_PREFIXES)
+
+        return not piece.startswith(self.__CONTINUATION_PREFIX)
+
+
+    def __continues_word(self, piece: str) -> bool:
+
+        ## Punctuation after a word does not make it a fragment.
+        if self.__starts_word(piece):
+            return False
+
+        return piece.removeprefix(self.__CONTINUATION_PREFIX)[:1].isalnum()
+
+
+    def __get_candidate_ids(self) -> np.ndarray:
+
+        if not os.path.exists(self.corpus_path):
+            Logger.raise_exception(f"Report corpus '{self.corpus_path}' does not exist. Embedding neighbours need it to tell whole words from word pieces.")
+
+        with open(self.corpus_path, "r", encoding="utf-8", newline="") as file:
+            reader = csv.DictReader(file)
+
+            if self.CORPUS_COLUMN not in reader.fieldnames:
+                Logger.raise_exception(f"Report corpus '{self.corpus_path}' has no '{self.CORPUS_COLUMN}' column.")
+
+            reports = [row[self.CORPUS_COLUMN] for row in reader if row[self.CORPUS_COLUMN]]
+
+        ## A piece is a whole word if the piece after it ever starts a new word.
+        whole_word_ids = set()
+
+        for token_ids in self.tokenizer(reports, add_special_tokens=False)["input_ids"]:
+            for index, token_id in enumerate(token_ids):
+                if token_id >= len(self.__pieces) or not self.__starts_word(self.__pieces[token_id]):
+                    continue
+
+                if index + 1 == len(token_ids) or not self.__continues_word(self.__pieces[token_ids[index + 1]]):
+                    whole_word_ids.add(token_id)
+
+        candidate_ids = []
+
+        for token_id in sorted(whole_word_ids):
+            word = EmbeddingNeighbours.__get_word(self.__pieces[token_id])
+
+            ## Words the generator would not perturb are not offered either.
+            if len(word) > self.min_word_len and word.isalpha() and word.lower() not in self.__STOPWORDS:
+                candidate_ids.append(token_id)
+
+        if len(candidate_ids) == 0:
+            Logger.raise_exception("The model's vocabulary has no whole words to use as neighbours.")
+
+        return np.array(candidate_ids, dtype=np.int64)
+
+
+    def __get_query(self, word: str) -> np.ndarray:
+
+        token_ids = self.tokenizer(word, add_special_tokens=False)["input_ids"]
+        pieces = self.tokenizer.convert_ids_to_tokens(token_ids)
+
+        ## A lone word boundary piece carries nothing about the word itself.
+        token_ids = [token_id for token_id, piece in zip(token_ids, pieces) if piece not in self.__WORD_BOUNDARY_PREFIXES] or token_ids
+
+        ## Words split into several pieces are represented by their mean.
+        query = self.__matrix[token_ids].mean(axis=0)
+
+        return query / max(np.linalg.norm(query), 1e-12)
+
+
+    def prefetch(self, words: list[str]):
+
+        words = list(dict.fromkeys(word for word in words if word not in self.__neighbours))
+
+        if len(words) == 0:
+            return
+
+        ## Case variants of a neighbour are dropped, so a few spare are kept.
+        num_of_nearest = min(self.num_of_neighbours * 4 + 1, len(self.__candidate_words))
+
+        for start in range(0, len(words), self.QUERY_BATCH_SIZE):
+            batch_words = words[start:start + self.QUERY_BATCH_SIZE]
+            similarities = np.stack([self.__get_query(word) for word in batch_words]) @ self.__candidate_matrix.T
+
+            nearest = np.argpartition(-similarities, num_of_nearest - 1, axis=1)[:, :num_of_nearest]
+            nearest = np.take_along_axis(nearest, np.argsort(-np.take_along_axis(similarities, nearest, axis=1), axis=1), axis=1)
+
+            for word, row in zip(batch_words, nearest):
+                seen_words = {word.lower()}
+                neighbours = []
+
+                for candidate_index in row:
+                    candidate_word = self.__candidate_words[candidate_index]
+
+                    if candidate_word.lower() in seen_words:
+                        continue
+
+                    seen_words.add(candidate_word.lower())
+                    neighbours.append(candidate_word)
+
+                    if len(neighbours) == self.num_of_neighbours:
+                        break
+
+                self.__neighbours[word] = neighbours
+
+
+    def get_neighbours(self, word: str) -> list[str]:
+
+        if word not in self.__neighbours:
+            self.prefetch([word])
+
+        return self.__neighbours[word]
@@ -0,0 +1,168 @@
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from custom.scripts.perturbation_planner import PerturbationPlan, PerturbationCandidate
+from custom.scripts.counterfactual_budget import CounterfactualBudget
+from scripts.utility.logger import Logger
+
+class FlipSearch:
+    """Beam search for the smallest set of word substitutions that changes
+    the prediction. Every single substitution is scored first. The
+    `pool_size` that most lower the likelihood of the original output are
+    the only edits combined after that, and each level only extends the
+    `beam_width` lowest scoring edit sets, so a level costs at most
+    beam_width * pool_size inferences however long the report is.
+
+    With a budget, every inference is counted against it and the search
+    stops once its time or remaining inferences run out.
+    """
+
+    DEFAULT_BEAM_WIDTH = 8
+    DEFAULT_MAX_EDITS = 3
+    DEFAULT_POOL_SIZE = 32
+    DEFAULT_MAX_INFERENCES = 4000
+    DEFAULT_MAX_RESULTS = 3
+
+    def apply_edits(input: str, edits: list[PerturbationCandidate]) -> str:
+
+        ## Applied from the end so earlier offsets stay valid.
+        for edit in sorted(edits, key=lambda edit: -edit.start):
+            input = input[:edit.start] + edit.replacement + input[edit.end:]
+
+        return input
+
+
+    def __overlaps(edit: PerturbationCandidate, edits: list[PerturbationCandidate]) -> bool:
+        return any(edit.start < other.end and other.start < edit.end for other in edits)
+
+
+    def __evaluate(texts: list[str],
+                   output: str,
+                   llm: PreTrainedLLM,
+                   num_of_evaluated: int,
+                   max_inferences: int,
+                   budget: CounterfactualBudget,
+                   progress_callback) -> list[tuple[float, bool]]:
+
+        scores_and_matches = []
+        texts = texts[:max(max_inferences - num_of_evaluated, 0)]
+
+        ## Planned as well as evaluated, so a search cut short by the budget
+        ## leaves it incomplete and the result is not stored as final.
+        if budget is not None:
+            budget.num_of_planned += len(texts)
+
+        for start in range(0, len(texts), llm.batch_size):
+            if budget is not None and budget.is_exhausted():
+                break
+
+            batch_texts = texts[start:start + llm.batch_size]
+
+            if budget is not None and budget.get_remaining_inferences() is not None:
+                batch_texts = batch_texts[:budget.get_remaining_inferences()]
+
+            scores_and_matches += llm.get_scores_and_matches(batch_texts, output)
+
+            if budget is not None:
+                budget.num_of_evaluated += len(batch_texts)
+
+            if progress_callback is not None:
+                progress_callback(f"Searching For Minimal Flips: {num_of_evaluated + len(scores_and_matches)} Inferences")
+
+        return scores_and_matches
+
+
+    def __get_flips(plan: PerturbationPlan,
+                    llm: PreTrainedLLM,
+                    edit_sets: list[list[PerturbationCandidate]],
+                    scores: list[float],
+                    max_results: int) -> list[dict]:
+
+        ## Most decisive flips first; only these few are fully decoded.
+        best = sorted(range(len(edit_sets)), key=lambda index: scores[index])[:max_results]
+        new_outputs = llm.get_outputs([FlipSearch.apply_edits(plan.input, edit_sets[index]) for index in best])
+
+        return [{
+            "edits": [{
+                "word": edit.word,
+                "position": edit.start,
+                "replacement": edit.replacement,
+                "mode": edit.mode
+            } for edit in sorted(edit_sets[index], key=lambda edit: edit.start)],
+            "output": new_output,
+            "score": scores[index]
+        } for index, new_output in zip(best, new_outputs)]
+
+
+    def search(plan: PerturbationPlan,
+               output: str,
+               llm: PreTrainedLLM,
+               beam_width: int = DEFAULT_BEAM_WIDTH,
+               max_edits: int = DEFAULT_MAX_EDITS,
+               pool_size: int = DEFAULT_POOL_SIZE,
+               max_inferences: int = DEFAULT_MAX_INFERENCES,
+               max_results: int = DEFAULT_MAX_RESULTS,
+               budget: CounterfactualBudget = None,
+               progress_callback = None) -> list[dict]:
+
+        if beam_width < 1 or max_edits < 1 or pool_size < 1:
+            Logger.raise_exception("Beam width, maximum edits and pool size must be at least 1.")
+
+        ## Candidates producing the same text are the same edit.
+        edits = [candidates[0] for candidates in plan.text_candidates]
+        num_of_evaluated = 0
+
+        scores_and_matches = FlipSearch.__evaluate(plan.texts, output, llm, num_of_evaluated, max_inferences, budget, progress_callback)
+        num_of_evaluated += len(scores_and_matches)
+
+        edit_sets = [[edit] for edit in edits[:len(scores_and_matches)]]
+        scores = [score for score, _ in scores_and_matches]
+
+        for num_of_edits in range(1, max_edits + 1):
+            flipped = [index for index, (_, match) in enumerate(scores_and_matches) if not match]
+
+            if len(flipped) > 0:
+                Logger.log_info(f"Found {len(flipped)} flips with {num_of_edits} edit(s) after {num_of_evaluated} inferences.")
+                return FlipSearch.__get_flips(plan, llm, [edit_sets[index] for index in flipped], [scores[index] for index in flipped], max_results)
+
+            if num_of_edits == max_edits or num_of_evaluated >= max_inferences or (budget is not None and budget.is_exhausted()):
+                break
+
+            ## Only the edits that moved the original output furthest on their
+            ## own are combined, and only with the most promising sets.
+            if num_of_edits == 1:
+                pool = [edit_sets[index][0] for index in sorted(range(len(edit_sets)), key=lambda index: scores[index])[:pool_size]]
+
+            beam = [edit_sets[index] for index in sorted(range(len(edit_sets)), key=lambda index: scores[index])[:beam_width]]
+
+            seen_sets = set()
+            edit_sets = []
+
+            for edit_set in beam:
+                for edit in pool:
+                    if FlipSearch.__overlaps(edit, edit_set):
+                        continue
+
+                    key = frozenset((other.start, other.replacement) for other in edit_set + [edit])
+
+                    if key not in seen_sets:
+                        seen_sets.add(key)
+                        edit_sets.append(edit_set + [edit])
+
+            if len(edit_sets) == 0:
+                break
+
+            scores_and_matches = FlipSearch.__evaluate(
+                [FlipSearch.apply_edits(plan.input, edit_set) for edit_set in edit_sets],
+                output,
+                llm,
+                num_of_evaluated,
+                max_inferences,
+                budget,
+                progress_callback)
+
+            num_of_evaluated += len(scores_and_matches)
+            edit_sets = edit_sets[:len(scores_and_matches)]
+            scores = [score for score, _ in scores_and_matches]
+
+        Logger.log_info(f"No flip found within {max_edits} edit(s) after {num_of_evaluated} inferences.")
+
+        return []
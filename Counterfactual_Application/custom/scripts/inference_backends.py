@@ -0,0 +1,348 @@
+import os, torch, numpy as np
+from scripts.utility.logger import Logger
+from custom.scripts.label_trie import LabelTrie
+
+class InferenceBackend:
+    """Runs the forward passes of a loaded model for PreTrainedLLM, so the
+    runtime can be swapped without changing any of its callers.
+    """
+
+    NAME = None
+
+    def __init__(self, model, device: str):
+        self.model = model
+        self.device = device
+
+        self.decoder_start_token_id = getattr(model.config, "decoder_start_token_id", None)
+        self.eos_token_id = model.config.eos_token_id
+        self.pad_token_id = model.config.pad_token_id
+
+
+    def shift_right(self, labels: torch.Tensor) -> torch.Tensor:
+
+        decoder_input_ids = labels.new_full(labels.shape, self.pad_token_id)
+        decoder_input_ids[:, 0] = self.decoder_start_token_id
+        decoder_input_ids[:, 1:] = labels[:, :-1]
+
+        return decoder_input_ids
+
+
+    def get_allowed_tokens(self, label_trie: LabelTrie, decoder_input_ids: list[int]) -> list[int]:
+
+        ## The first decoder input is the start token, which is not in the trie.
+        return label_trie.get_allowed_tokens(decoder_input_ids[1:]) or [self.pad_token_id]
+
+
+    def get_label_mask(self, label_trie: LabelTrie, target_ids: list[int], vocab_size: int) -> torch.Tensor:
+
+        ## Row i masks the tokens constrained decoding could not pick after
+        ## the first i target tokens, so argmax matches what generate does.
+        mask = torch.full((len(target_ids), vocab_size), -float("inf"), device=self.device)
+
+        for step in range(len(target_ids)):
+            mask[step, self.get_allowed_tokens(label_trie, [self.decoder_start_token_id] + target_ids[:step])] = 0
+
+        return mask
+
+
+    def generate(self, 
+                 input_ids: torch.Tensor, 
+                 attention_mask: torch.Tensor, 
+                 max_new_tokens: int, 
+                 label_trie: LabelTrie = None) -> torch.Tensor:
+        Logger.raise_exception(f"Backend '{self.NAME}' does not implement generate.")
+
+
+    def get_logits(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+        Logger.raise_exception(f"Backend '{self.NAME}' does not implement get_logits.")
+
+
+    def get_class_logits(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        Logger.raise_exception(f"Backend '{self.NAME}' does not implement get_class_logits.")
+
+
+    def get_matches(self, 
+                    input_ids: torch.Tensor, 
+                    attention_mask: torch.Tensor, 
+                    target_ids: list[int], 
+                    label_trie: LabelTrie = None) -> list[bool]:
+
+        ## Greedy decoding reproduces the target exactly when the target token
+        ## is the argmax at every teacher-forced step.
+        labels = torch.tensor([target_ids] * len(input_ids), device=self.device)
+        logits = self.get_logits(input_ids, attention_mask, labels)
+
+        if label_trie is not None:
+            logits = logits + self.get_label_mask(label_trie, target_ids, logits.shape[-1])
+
+        return (logits.argmax(dim=-1) == labels).all(dim=-1).tolist()
+
+
+class EagerBackend(InferenceBackend):
+
+    NAME = "eager"
+
+    def generate(self, 
+                 input_ids: torch.Tensor, 
+                 attention_mask: torch.Tensor, 
+                 max_new_tokens: int, 
+                 label_trie: LabelTrie = None) -> torch.Tensor:
+
+        if label_trie is None:
+            prefix_allowed_tokens_fn = None
+        else:
+            prefix_allowed_tokens_fn = lambda batch_id, decoder_input_ids: self.get_allowed_tokens(label_trie, decoder_input_ids.tolist())
+
+        with torch.no_grad():
+            return self.model.generate(
+                input_ids=input_ids, 
+                attention_mask=attention_mask, 
+                max_new_tokens=max_new_tokens, 
+                prefix_allowed_tokens_fn=prefix_allowed_tokens_fn)
+
+
+    def get_logits(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+
+        with torch.no_grad():
+            return self.model(input_ids=input_ids, attention_mask=attention_mask, labels=labels).logits.float()
+
+
+    def get_class_logits(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+
+        with torch.no_grad():
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).logits.float()
+
+
+    def get_matches(self, 
+                    input_ids: torch.Tensor, 
+                    attention_mask: torch.Tensor, 
+                    target_ids: list[int], 
+                    label_trie: LabelTrie = None) -> list[bool]:
+
+        num_of_inputs = len(input_ids)
+        label_mask = None
+
+        with torch.no_grad():
+            encoder_outputs = self.model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask)
+
+            matching = torch.ones(num_of_inputs, dtype=torch.bool, device=self.device)
+            decoder_input_ids = torch.full((num_of_inputs, 1), self.decoder_start_token_id, device=self.device)
+            past_key_values = None
+
+            ## Every still matching row has decoded the same target prefix, so
+            ## the next decoder input is the target token for all of them.
+            for step, target_id in enumerate(target_ids):
+                step_output = self.model(
+                    encoder_outputs=encoder_outputs,
+                    attention_mask=attention_mask,
+                    decoder_input_ids=decoder_input_ids,
+                    past_key_values=past_key_values,
+                    use_cache=True)
+
+                past_key_values = step_output.past_key_values
+                next_logits = step_output.logits[:, -1, :]
+
+                if label_trie is not None:
+                    if label_mask is None:
+                        label_mask = self.get_label_mask(label_trie, target_ids, next_logits.shape[-1])
+
+                    next_logits = next_logits + label_mask[step]
+
+                matching &= next_logits.argmax(dim=-1) == target_id
+
+                if not matching.any():
+                    break
+
+                decoder_input_ids = torch.full((num_of_inputs, 1), target_id, device=self.device)
+
+        return matching.tolist()
+
+
+class CompiledBackend(EagerBackend):
+
+    NAME = "compiled"
+
+    def __init__(self, model, device: str):
+        super().__init__(model, device)
+
+        ## generate calls the encoder separately from the full forward pass, so
+        ## both are compiled. Dynamic shapes stop every new batch or sequence
+        ## length from triggering a recompile.
+        encoder = model.get_encoder()
+        encoder.forward = torch.compile(encoder.forward, dynamic=True)
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+
+class OnnxBackend(InferenceBackend):
+    """Encoder and decoder exported to ONNX and run by ONNX Runtime. The
+    decoder has no key/value cache, so each greedy step re-reads the whole
+    decoded prefix, which is cheap for the short part failure labels.
+    """
+
+    NAME = "onnx"
+
+    ENCODER_FILE_NAME = "encoder.onnx"
+    DECODER_FILE_NAME = "decoder.onnx"
+    OPSET_VERSION = 17
+
+    def __init__(self, model, device: str, export_folder_path: str):
+        super().__init__(model, device)
+
+        try:
+            import onnxruntime
+        except ImportError:
+            Logger.raise_exception("The ONNX backend needs the 'onnxruntime' package.")
+
+        if not OnnxBackend.is_exported(export_folder_path):
+            OnnxBackend.export(model, export_folder_path)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        if device == "cuda" and "CUDAExecutionProvider" in onnxruntime.get_available_providers():
+            providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+        else:
+            providers = ["CPUExecutionProvider"]
+
+        self.__encoder = onnxruntime.InferenceSession(os.path.join(export_folder_path, OnnxBackend.ENCODER_FILE_NAME), options, providers=providers)
+        self.__decoder = onnxruntime.InferenceSession(os.path.join(export_folder_path, OnnxBackend.DECODER_FILE_NAME), options, providers=providers)
+
+
+    def is_exported(export_folder_path: str) -> bool:
+
+        return (os.path.exists(os.path.join(export_folder_path, OnnxBackend.ENCODER_FILE_NAME)) and
+                os.path.exists(os.path.join(export_folder_path, OnnxBackend.DECODER_FILE_NAME)))
+
+
+    def export(model, export_folder_path: str):
+
+        Logger.log_info(f"Exporting model to ONNX at: '{export_folder_path}'")
+
+        os.makedirs(export_folder_path, exist_ok=True)
+
+        model_device = model.device
+        model = model.to("cpu").eval()
+
+        input_ids = torch.ones((2, 8), dtype=torch.long)
+        attention_mask = torch.ones((2, 8), dtype=torch.long)
+        decoder_input_ids = torch.ones((2, 3), dtype=torch.long)
+
+        with torch.no_grad():
+            encoder_hidden_states = model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+            torch.onnx.export(
+                OnnxEncoder(model),
+                (input_ids, attention_mask),
+                os.path.join(export_folder_path, OnnxBackend.ENCODER_FILE_NAME),
+                input_names=["input_ids", "attention_mask"],
+                output_names=["encoder_hidden_states"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "encoder_hidden_states": {0: "batch", 1: "sequence"}},
+                opset_version=OnnxBackend.OPSET_VERSION,
+                dynamo=False)
+
+            torch.onnx.export(
+                OnnxDecoder(model),
+                (decoder_input_ids, encoder_hidden_states, attention_mask),
+                os.path.join(export_folder_path, OnnxBackend.DECODER_FILE_NAME),
+                input_names=["decoder_input_ids", "encoder_hidden_states", "attention_mask"],
+                output_names=["logits"],
+                dynamic_axes={
+                    "decoder_input_ids": {0: "batch", 1: "decoded"},
+                    "encoder_hidden_states": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "logits": {0: "batch", 1: "decoded"}},
+                opset_version=OnnxBackend.OPSET_VERSION,
+                dynamo=False)
+
+        model.to(model_device)
+
+
+    def __encode(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> np.ndarray:
+
+        return self.__encoder.run(None, {
+            "input_ids": input_ids.cpu().numpy(),
+            "attention_mask": attention_mask.cpu().numpy()})[0]
+
+
+    def __decode(self, decoder_input_ids: np.ndarray, encoder_hidden_states: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+
+        return self.__decoder.run(None, {
+            "decoder_input_ids": decoder_input_ids,
+            "encoder_hidden_states": encoder_hidden_states,
+            "attention_mask": attention_mask})[0]
+
+
+    def generate(self, 
+                 input_ids: torch.Tensor, 
+                 attention_mask: torch.Tensor, 
+                 max_new_tokens: int, 
+                 label_trie: LabelTrie = None) -> torch.Tensor:
+
+        encoder_hidden_states = self.__encode(input_ids, attention_mask)
+        attention_mask = attention_mask.cpu().numpy()
+
+        decoder_input_ids = np.full((len(input_ids), 1), self.decoder_start_token_id, dtype=np.int64)
+        finished = np.zeros(len(input_ids), dtype=bool)
+
+        for _ in range(max_new_tokens):
+            next_logits = self.__decode(decoder_input_ids, encoder_hidden_states, attention_mask)[:, -1, :]
+
+            if label_trie is not None:
+                allowed = np.full(next_logits.shape, -np.inf, dtype=next_logits.dtype)
+
+                for row, row_ids in enumerate(decoder_input_ids.tolist()):
+                    allowed[row, self.get_allowed_tokens(label_trie, row_ids)] = 0
+
+                next_logits = next_logits + allowed
+
+            next_ids = next_logits.argmax(axis=-1)
+
+            ## Finished rows are padded, as generate does.
+            next_ids = np.where(finished, self.pad_token_id, next_ids)
+            decoder_input_ids = np.concatenate([decoder_input_ids, next_ids[:, None]], axis=1)
+            finished |= next_ids == self.eos_token_id
+
+            if finished.all():
+                break
+
+        return torch.from_numpy(decoder_input_ids)
+
+
+    def get_logits(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+
+        logits = self.__decode(
+            self.shift_right(labels).cpu().numpy(),
+            self.__encode(input_ids, attention_mask),
+            attention_mask.cpu().numpy())
+
+        return torch.from_numpy(logits).to(self.device).float()
+
+
+class OnnxEncoder(torch.nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+
+class OnnxDecoder(torch.nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, decoder_input_ids: torch.Tensor, encoder_hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self.model(
+            encoder_outputs=(encoder_hidden_states,),
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            use_cache=False).logits
+
+
+BACKENDS = {backend.NAME: backend for backend in (EagerBackend, CompiledBackend, OnnxBackend)}
@@ -0,0 +1,86 @@
+import csv, hashlib, os, sys
+from scripts.utility.logger import Logger
+
+class LabelTrie:
+    """Token trie over every valid part failure label. Each label's token ids
+    end with the end of sequence token, so once decoding reaches a complete
+    label that is not a prefix of a longer one, only the end token is allowed
+    and generation stops.
+
+    Build the label vocabulary from the training CSV with:
+        python -m custom.scripts.label_trie [CSV path] [label path]
+    """
+
+    DEFAULT_LABEL_PATH = os.path.join("cache", "part_failure_labels.txt")
+    DEFAULT_CSV_PATH = os.path.join("..", "LLM_Training", "airline_incidents_small.csv")
+    LABEL_COLUMN = "part failure"
+
+    def __init__(self, labels: list[str], tokenizer):
+
+        if len(labels) == 0:
+            Logger.raise_exception("Label vocabulary is empty.")
+
+        self.labels = labels
+        self.key = LabelTrie.get_key(labels)
+        self.max_length = 0
+
+        self.__root: dict[int, dict] = {}
+
+        for label_ids in tokenizer(labels)["input_ids"]:
+            node = self.__root
+
+            for token_id in label_ids:
+                node = node.setdefault(token_id, {})
+
+            self.max_length = max(self.max_length, len(label_ids))
+
+
+    def get_allowed_tokens(self, prefix_ids: list[int]) -> list[int]:
+
+        node = self.__root
+
+        for token_id in prefix_ids:
+            node = node.get(token_id)
+
+            ## Rows that have finished are padded past the end of their label.
+            if node is None:
+                return []
+
+        return list(node)
+
+
+    def get_key(labels: list[str]) -> str:
+        return hashlib.sha256("\n".join(labels).encode("utf-8")).hexdigest()
+
+
+    def read_labels(label_path: str) -> list[str]:
+
+        if not os.path.exists(label_path):
+            Logger.raise_exception(f"Label vocabulary '{label_path}' does not exist. Build it with 'python -m custom.scripts.label_trie'.")
+
+        with open(label_path, "r", encoding="utf-8") as file:
+            return [line.strip() for line in file if line.strip() != ""]
+
+
+    def build(csv_path: str, label_path: str):
+
+        with open(csv_path, "r", encoding="utf-8", newline="") as file:
+            reader = csv.DictReader(file)
+
+            if LabelTrie.LABEL_COLUMN not in reader.fieldnames:
+                Logger.raise_exception(f"CSV file '{csv_path}' has no '{LabelTrie.LABEL_COLUMN}' column.")
+
+            labels = sorted({row[LabelTrie.LABEL_COLUMN].strip() for row in reader if row[LabelTrie.LABEL_COLUMN].strip() != ""})
+
+        os.makedirs(os.path.dirname(label_path) or ".", exist_ok=True)
+
+        with open(label_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(labels) + "\n")
+
+        Logger.log_info(f"Wrote {len(labels)} labels to '{label_path}'.")
+
+
+if __name__ == "__main__":
+    LabelTrie.build(
+        sys.argv[1] if len(sys.argv) > 1 else LabelTrie.DEFAULT_CSV_PATH,
+        sys.argv[2] if len(sys.argv) > 2 else LabelTrie.DEFAULT_LABEL_PATH)
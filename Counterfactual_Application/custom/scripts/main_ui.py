@@ -6,9 +6,17 @@ import tkinter as tk
 from tkinter import filedialog
 from custom.scripts.text_box import TextBoxUIElem, set_dim_based_on_win_dim
 from custom.scripts.pre_treained_llm import PreTrainedLLM
-from custom.scripts.counterfactual_generator import CounterfactualGenerator
+from custom.scripts.prediction_cache import PredictionCache
+from custom.scripts.model_registry import ModelRegistry
+from custom.scripts.sharded_llm import ShardedLLM
+from custom.scripts.counterfactual_worker import CounterfactualWorker
+from custom.scripts.counterfactual_budget import CounterfactualBudget
+from custom.scripts.counterfactual_results import CounterfactualResults
+from custom.scripts.cost_report import CostReport
+from custom.scripts.result_store import ResultStore
 from scripts.utility.glob import Tag
-import platform, subprocess
+from scripts.utility.timer import Timer
+import platform, subprocess, os, time
 
 
 class MainUI:
@@ -70,6 +78,10 @@ class MainUI:
     __LOADING_BAR_TEXT_OFFSET = (0, 0)
     LOADING_TEXT = "Generating Counterfactuals..."
     __LOADING_TEXT_GENERATING_OUTPUT = "Generating LLM Output..."
+    __LOADING_TEXT_PROGRESS = "{progress_text} ({num_of_counterfactuals} Done)"
+    __LOADING_TEXT_UPDATE_TIME_IN_SEC = 0.2
+    __COUNTERFACTUAL_ERROR_TEXT = "Counterfactual generation failed: {error}"
+    __ANALYSIS_TEXT_UPDATE_TIME_IN_SEC = 0.1
     
     __COUNTERFACTUAL_SUBMIT_BUTTON = "COUNTERFACTUAL_SUBMIT_BUTTON"
     __COUNTERFACTUAL_BUTTON_PRESS = "counterfactual_button_press"
@@ -85,13 +97,13 @@ class MainUI:
     __RED_BUTTON = "red_button"
     __GREEN_BUTTON = "green_button"
     
-    __DISPLAY_ALL = "DISPLAY_ALL"
-    __DISPLAY_SYNONYMS = "DISPLAY_SYNONYMS"
-    __DISPLAY_CORRECT_SYNONYMS = "DISPLAY_CORRECT_SYNONYMS"
-    __DISPLAY_INCORRECT_SYNONYMS = "DISPLAY_INCORRECT_SYNONYMS"
-    __DISPLAY_ANTONYMS = "DISPLAY_ANTONYMS"
-    __DISPLAY_CORRECT_ANTONYMS = "DISPLAY_CORRECT_ANTONYMS"
-    __DISPLAY_INCORRECT_ANTONYMS = "DISPLAY_INCORRECT_ANTONYMS"
+    __DISPLAY_ALL = CounterfactualResults.DISPLAY_ALL
+    __DISPLAY_SYNONYMS = CounterfactualResults.DISPLAY_SYNONYMS
+    __DISPLAY_CORRECT_SYNONYMS = CounterfactualResults.DISPLAY_CORRECT_SYNONYMS
+    __DISPLAY_INCORRECT_SYNONYMS = CounterfactualResults.DISPLAY_INCORRECT_SYNONYMS
+    __DISPLAY_ANTONYMS = CounterfactualResults.DISPLAY_ANTONYMS
+    __DISPLAY_CORRECT_ANTONYMS = CounterfactualResults.DISPLAY_CORRECT_ANTONYMS
+    __DISPLAY_INCORRECT_ANTONYMS = CounterfactualResults.DISPLAY_INCORRECT_ANTONYMS
     SETTING_MENU_TEXTS = {
         __DISPLAY_ALL: "Display Full Results",
         __DISPLAY_SYNONYMS: "Display Only Synonyms",
@@ -103,6 +115,41 @@ class MainUI:
     }
     __OUTPUT_SETTINGS = "OUTPUT_SETTINGS"
     
+    ## Set either limit to return the most sensitive counterfactuals found 
+    ## within a fixed time or number of inferences.
+    COUNTERFACTUAL_MAX_SECONDS = None
+    COUNTERFACTUAL_MAX_INFERENCES = None
+    
+    ## Set to PreTrainedLLM.CLASSIFIER to load a sequence classifier, which 
+    ## predicts in a single forward pass. Its label names are read from 
+    ## LABEL_VOCABULARY_PATH.
+    MODEL_TYPE = PreTrainedLLM.BERT
+    
+    ## Set to PreTrainedLLM.INT8_QUANTIZATION for faster CPU-only inference.
+    QUANTIZATION = None
+    
+    ## Inference runtime, run backend_report.py benchmark to pick one per host.
+    BACKEND = PreTrainedLLM.EAGER_BACKEND
+    
+    ## Processes counterfactual candidates are split across, each with its own
+    ## model copy. Run scaling_benchmark.py to find where this stops scaling.
+    NUM_OF_SHARDS = 1
+    
+    ## Label vocabulary the predicted part failure is constrained to, built 
+    ## with 'python -m custom.scripts.label_trie'. None allows free text.
+    LABEL_VOCABULARY_PATH = None
+    
+    CACHE_FOLDER_PATH = r"cache"
+    PREDICTION_CACHE_PATH = r"cache/predictions.db"
+    
+    ## Finished runs are kept here, so re-submitting a report is instant.
+    RESULT_STORE_PATH = r"cache/results.db"
+    RESULT_STORE_MAX_BYTES = ResultStore.DEFAULT_MAX_BYTES
+    
+    ## Re-running an edited report only recomputes the words near the edits, 
+    ## see CounterfactualGenerator.REUSE_CONTEXT_WORDS.
+    INCREMENTAL_REANALYSIS = True
+    
     def __init__(self, window: WindowUI):
         
         glob.add_colour(self.WHITE, (255, 255, 255))
@@ -148,7 +195,11 @@ class MainUI:
         
         self.pixels_scrolled = 0
         
-        self.llm = PreTrainedLLM()
+        os.makedirs(self.CACHE_FOLDER_PATH, exist_ok=True)
+        self.prediction_cache = PredictionCache(database_path=self.PREDICTION_CACHE_PATH)
+        self.result_store = ResultStore(self.RESULT_STORE_PATH, self.RESULT_STORE_MAX_BYTES)
+        self.llm = PreTrainedLLM(self.MODEL_TYPE, prediction_cache=self.prediction_cache, quantization=self.QUANTIZATION, backend=self.BACKEND)
+        self.counterfactual_llm = self.llm
         self.llm_input = None
         self.llm_output = None
         
@@ -161,6 +212,16 @@ class MainUI:
         
         self.output_format = self.__DISPLAY_ALL
         self.counterfactual_explanations = []
+        
+        self.counterfactual_worker = CounterfactualWorker()
+        self.loading_text_timer = Timer()
+        self.analysis_text_timer = Timer()
+        self.counterfactual_analysis = ""
+        self.analysis_text_changed = False
+        self.progress_text = self.LOADING_TEXT
+        self.num_of_counterfactuals = 0
+        self.cost_report = None
+        self.previous_results = None
     
         
     def select_folder_windows():
@@ -529,6 +590,76 @@ class MainUI:
             glob.get_tag(self.__OUTPUT_SETTINGS).display = False
         
     
+    def __handle_counterfactual_worker(self, window: WindowUI):
+        
+        start_time = time.perf_counter()
+        messages = self.counterfactual_worker.poll()
+        
+        for message_type, data in messages:
+            
+            if message_type == CounterfactualWorker.PROGRESS:
+                self.progress_text = data
+                
+            elif message_type == CounterfactualWorker.PARTIAL:
+                self.num_of_counterfactuals += len(data[1])
+                
+            elif message_type == CounterfactualWorker.SUMMARY:
+                summary, self.counterfactual_explanations = data
+                
+                glob.get_tag(self.__LOADING_BAR).display = False
+                
+                ## Results are shown before the analysis so it can stream in.
+                window.get_elem(self.counterfactual_summary_text_box.text_box_name).update_text(window.win_dim, summary)
+                window.get_elem(self.counterfactual_analysis_text_box.text_box_name).update_text(window.win_dim, "")
+                window.get_elem(self.counterfactual_output_text_box.text_box_name).update_text(window.win_dim, self.counterfactual_explanations[self.output_format])
+                glob.get_tag(self.__COUNTERFACTUAL_OUTPUT).display = True
+                
+                self.analysis_text_timer.start(self.__ANALYSIS_TEXT_UPDATE_TIME_IN_SEC)
+                
+            elif message_type == CounterfactualWorker.ANALYSIS:
+                self.counterfactual_analysis += data
+                self.analysis_text_changed = True
+                
+            elif message_type == CounterfactualWorker.RESULT:
+                summary, self.counterfactual_analysis, self.counterfactual_explanations, self.cost_report = data
+                self.analysis_text_changed = False
+                
+                if self.INCREMENTAL_REANALYSIS:
+                    self.previous_results = self.counterfactual_explanations.results
+                
+                glob.get_tag(self.__LOADING_BAR).display = False
+                
+                window.get_elem(self.counterfactual_summary_text_box.text_box_name).update_text(window.win_dim, summary + "\n\n" + self.cost_report.get_summary_text())
+                window.get_elem(self.counterfactual_analysis_text_box.text_box_name).update_text(window.win_dim, self.counterfactual_analysis)
+                window.get_elem(self.counterfactual_output_text_box.text_box_name).update_text(window.win_dim, self.counterfactual_explanations[self.output_format])
+                glob.get_tag(self.__COUNTERFACTUAL_OUTPUT).display = True
+                
+            elif message_type == CounterfactualWorker.ERROR:
+                glob.get_tag(self.__LOADING_BAR).display = False
+                
+                window.get_elem(self.counterfactual_summary_text_box.text_box_name).update_text(window.win_dim, self.__COUNTERFACTUAL_ERROR_TEXT.format(error=data))
+                glob.get_tag(self.__COUNTERFACTUAL_OUTPUT).display = True
+        
+        if self.analysis_text_changed and self.analysis_text_timer.is_end():
+            window.get_elem(self.counterfactual_analysis_text_box.text_box_name).update_text(window.win_dim, self.counterfactual_analysis)
+            self.analysis_text_changed = False
+            self.analysis_text_timer.start(self.__ANALYSIS_TEXT_UPDATE_TIME_IN_SEC)
+        
+        ## Re-rendering text every frame is costly, so progress is throttled.
+        if self.counterfactual_worker.is_running() and self.loading_text_timer.is_end():
+            window.get_elem(self.__LOADING_BAR_TEXT).update_text(
+                window.win_dim, 
+                self.__LOADING_TEXT_PROGRESS.format(
+                    progress_text=self.progress_text, 
+                    num_of_counterfactuals=self.num_of_counterfactuals))
+            
+            self.loading_text_timer.start(self.__LOADING_TEXT_UPDATE_TIME_IN_SEC)
+        
+        ## Rendering happens on this thread, so it is added to the run's cost here.
+        if self.cost_report is not None and (len(messages) > 0 or self.counterfactual_worker.is_running()):
+            self.cost_report.add_seconds(CostReport.UI_STAGE, time.perf_counter() - start_time)
+    
+    
     def handle_inputs(self, window: WindowUI, run_first_time: bool):
     
         set_dim_based_on_win_dim(
@@ -543,13 +674,29 @@ class MainUI:
             self.__handel_settings_menu(window)
         
         else:
-            if window.is_pressed(self.UPLOAD):
+            ## The running worker holds the current model, so it cannot be
+            ## swapped or closed until the run ends.
+            if window.is_pressed(self.UPLOAD) and not self.counterfactual_worker.is_running():
                 folder_path = MainUI.select_folder()
                 window.get_elem(self.UPLOAD_TEXT).update_text(window.win_dim, self.LOADED_UPLOAD_TEXT.format(llm_file_path=folder_path))
-                self.llm.set_model_folder_path(folder_path)
+                ModelRegistry.release_model(self.llm)
+                self.llm = ModelRegistry.get_model(folder_path, self.MODEL_TYPE, quantization=self.QUANTIZATION, backend=self.BACKEND, pin=True)
+                self.llm.set_prediction_cache(self.prediction_cache)
+                self.llm.set_label_vocabulary(self.LABEL_VOCABULARY_PATH)
+                self.previous_results = None
+                
+                if isinstance(self.counterfactual_llm, ShardedLLM):
+                    self.counterfactual_llm.close()
+                
+                if self.NUM_OF_SHARDS > 1:
+                    self.counterfactual_llm = ShardedLLM(self.llm, self.NUM_OF_SHARDS)
+                else:
+                    self.counterfactual_llm = self.llm
         
         
-        if self.input_text_box.handle_inputs(window, run_first_time) and self.llm.model != None:
+        if (self.input_text_box.handle_inputs(window, run_first_time) and 
+            self.llm.model != None and 
+            not self.counterfactual_worker.is_running()):
             window.get_elem(self.__LOADING_BAR_TEXT).update_text(window.win_dim, self.__LOADING_TEXT_GENERATING_OUTPUT)
             glob.get_tag(self.__LOADING_BAR).display = True
             window.events()
@@ -572,21 +719,28 @@ class MainUI:
             
         if (window.is_pressed(self.__COUNTERFACTUAL_SUBMIT_BUTTON) and 
             (self.llm_output != None  and self.llm_output != "") and
-            (self.llm_input != None and self.llm_input != "")):
+            (self.llm_input != None and self.llm_input != "") and
+            not self.counterfactual_worker.is_running()):
             
+            self.progress_text = self.LOADING_TEXT
+            self.num_of_counterfactuals = 0
+            self.counterfactual_analysis = ""
+            self.analysis_text_changed = False
+            self.cost_report = CostReport()
             window.get_elem(self.__LOADING_BAR_TEXT).update_text(window.win_dim, self.LOADING_TEXT)
             glob.get_tag(self.__LOADING_BAR).display = True
-            window.events()
-            window.draw()
-            
-            summary, counterfactual_analysis, self.counterfactual_explanations = CounterfactualGenerator.get_output(window, self.llm_input, self.llm_output, self.llm)
             
-            glob.get_tag(self.__LOADING_BAR).display = False
+            self.counterfactual_worker.start(
+                self.llm_input, 
+                self.llm_output, 
+                self.counterfactual_llm, 
+                CounterfactualBudget(self.COUNTERFACTUAL_MAX_SECONDS, self.COUNTERFACTUAL_MAX_INFERENCES),
+                self.cost_report,
+                self.result_store,
+                self.previous_results)
+            self.loading_text_timer.start(self.__LOADING_TEXT_UPDATE_TIME_IN_SEC)
             
-            window.get_elem(self.counterfactual_summary_text_box.text_box_name).update_text(window.win_dim, summary)
-            window.get_elem(self.counterfactual_analysis_text_box.text_box_name).update_text(window.win_dim, counterfactual_analysis)
-            window.get_elem(self.counterfactual_output_text_box.text_box_name).update_text(window.win_dim, self.counterfactual_explanations[self.output_format])
-            glob.get_tag(self.__COUNTERFACTUAL_OUTPUT).display = True
+        self.__handle_counterfactual_worker(window)
             
         self.output_text_box.handle_inputs(window, run_first_time)
         
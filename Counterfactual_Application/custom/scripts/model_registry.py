@@ -0,0 +1,207 @@
+import gc, os, threading, time, torch
+from collections import OrderedDict
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from scripts.utility.logger import Logger
+
+class ModelRegistry:
+    """Process-wide store of loaded models. Models are loaded lazily on first
+    use, kept resident between calls and evicted least-recently-used first
+    once the resident size would exceed `max_resident_bytes`.
+
+    Callers that keep a model for longer than one call pin it, and pinned
+    models are never evicted until they are released.
+    """
+
+    DEFAULT_MAX_RESIDENT_BYTES = 24 * 1024 ** 3
+    WEIGHT_FILE_EXTENSIONS = (".safetensors", ".bin", ".pt", ".pth")
+
+    max_resident_bytes = DEFAULT_MAX_RESIDENT_BYTES
+
+    __models: OrderedDict[tuple[str, int, str, str], PreTrainedLLM] = OrderedDict()
+    __resident_bytes: dict[tuple[str, int, str, str], int] = {}
+    __load_seconds: dict[tuple[str, int, str, str], float] = {}
+    __folder_stamps: dict[tuple[str, int, str, str], str] = {}
+    __pins: dict[tuple[str, int, str, str], int] = {}
+    __lock = threading.RLock()
+
+
+    def __get_key(model_folder_path: str, model_type: int, quantization: str, backend: str) -> tuple[str, int, str, str]:
+        return (os.path.abspath(model_folder_path), model_type, quantization, backend)
+
+
+    def get_model_size(llm: PreTrainedLLM) -> int:
+
+        if llm.model is None:
+            return 0
+
+        ## Quantized layers keep their weights in packed state entries rather
+        ## than parameters, so the state dict is measured instead.
+        tensors = []
+
+        for value in llm.model.state_dict().values():
+            if isinstance(value, torch.Tensor):
+                tensors.append(value)
+            elif isinstance(value, tuple):
+                tensors += [item for item in value if isinstance(item, torch.Tensor)]
+
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+    def get_weight_file_size(model_folder_path: str) -> int:
+
+        if not os.path.isdir(model_folder_path):
+            return 0
+
+        return sum(
+            os.path.getsize(os.path.join(model_folder_path, file_name))
+            for file_name in os.listdir(model_folder_path)
+            if file_name.endswith(ModelRegistry.WEIGHT_FILE_EXTENSIONS))
+
+
+    def get_resident_bytes() -> int:
+        return sum(ModelRegistry.__resident_bytes.values())
+
+
+    def __forget(key: tuple[str, int, str, str]) -> tuple[PreTrainedLLM, int]:
+
+        ModelRegistry.__load_seconds.pop(key)
+        ModelRegistry.__folder_stamps.pop(key)
+        ModelRegistry.__pins.pop(key)
+
+        return ModelRegistry.__models.pop(key), ModelRegistry.__resident_bytes.pop(key)
+
+
+    def __evict(key: tuple[str, int, str, str]):
+
+        if ModelRegistry.__pins[key] > 0:
+            Logger.log_warning(f"Model '{key[0]}' is in use and was not evicted.")
+            return
+
+        llm, resident_bytes = ModelRegistry.__forget(key)
+
+        llm.model = None
+        llm.backend = None
+        llm.tokenizer = None
+        gc.collect()
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        Logger.log_info(f"Evicted model '{key[0]}' freeing {resident_bytes / 1024 ** 2:.1f} MB.")
+
+
+    def __make_room(required_bytes: int):
+
+        for key in list(ModelRegistry.__models):
+            if ModelRegistry.get_resident_bytes() + required_bytes <= ModelRegistry.max_resident_bytes:
+                return
+
+            if ModelRegistry.__pins[key] == 0:
+                ModelRegistry.__evict(key)
+
+        if ModelRegistry.get_resident_bytes() + required_bytes > ModelRegistry.max_resident_bytes:
+            Logger.log_warning("Models in use keep the registry over its memory budget.")
+
+
+    def get_model(model_folder_path: str, 
+                  model_type: int = PreTrainedLLM.BERT, 
+                  quantization: str = None, 
+                  backend: str = PreTrainedLLM.EAGER_BACKEND,
+                  pin: bool = False) -> PreTrainedLLM:
+
+        key = ModelRegistry.__get_key(model_folder_path, model_type, quantization, backend)
+        folder_stamp = PreTrainedLLM.get_folder_stamp(model_folder_path) if os.path.isdir(model_folder_path) else ""
+
+        with ModelRegistry.__lock:
+
+            ## A checkpoint retrained into the same folder must not be served
+            ## from the copy loaded before it changed.
+            if key in ModelRegistry.__models and ModelRegistry.__folder_stamps[key] != folder_stamp:
+                Logger.log_info(f"Model '{model_folder_path}' changed on disk and will be reloaded.")
+
+                ## Callers still holding the old copy keep a working model.
+                if ModelRegistry.__pins[key] > 0:
+                    ModelRegistry.__forget(key)
+                else:
+                    ModelRegistry.__evict(key)
+
+            if key in ModelRegistry.__models:
+                ModelRegistry.__models.move_to_end(key)
+                ModelRegistry.__pins[key] += int(pin)
+                return ModelRegistry.__models[key]
+
+            ## Weight files are a good estimate of the loaded size, so room is
+            ## made before loading rather than after.
+            ModelRegistry.__make_room(ModelRegistry.get_weight_file_size(model_folder_path))
+
+            start_time = time.perf_counter()
+
+            llm = PreTrainedLLM(model_type=model_type, quantization=quantization, backend=backend)
+            llm.set_model_folder_path(model_folder_path)
+
+            load_seconds = time.perf_counter() - start_time
+            resident_bytes = ModelRegistry.get_model_size(llm)
+
+            ModelRegistry.__make_room(resident_bytes)
+
+            if resident_bytes > ModelRegistry.max_resident_bytes:
+                Logger.log_warning(f"Model '{model_folder_path}' is larger than the registry memory budget.")
+
+            ModelRegistry.__models[key] = llm
+            ModelRegistry.__resident_bytes[key] = resident_bytes
+            ModelRegistry.__load_seconds[key] = load_seconds
+            ModelRegistry.__folder_stamps[key] = folder_stamp
+            ModelRegistry.__pins[key] = int(pin)
+
+            Logger.log_info(f"Loaded model '{model_folder_path}' in {load_seconds:.2f}s ({resident_bytes / 1024 ** 2:.1f} MB resident).")
+
+            return llm
+
+
+    def release_model(llm: PreTrainedLLM):
+
+        with ModelRegistry.__lock:
+            for key, model in ModelRegistry.__models.items():
+                if model is llm and ModelRegistry.__pins[key] > 0:
+                    ModelRegistry.__pins[key] -= 1
+                    return
+
+
+    def evict_model(model_folder_path: str, 
+                    model_type: int = PreTrainedLLM.BERT, 
+                    quantization: str = None, 
+                    backend: str = PreTrainedLLM.EAGER_BACKEND):
+
+        key = ModelRegistry.__get_key(model_folder_path, model_type, quantization, backend)
+
+        with ModelRegistry.__lock:
+            if key in ModelRegistry.__models:
+                ModelRegistry.__evict(key)
+
+
+    def evict_all():
+
+        with ModelRegistry.__lock:
+            for key in list(ModelRegistry.__models):
+                ModelRegistry.__evict(key)
+
+
+    def set_max_resident_bytes(max_resident_bytes: int):
+
+        with ModelRegistry.__lock:
+            ModelRegistry.max_resident_bytes = max_resident_bytes
+            ModelRegistry.__make_room(0)
+
+
+    def get_stats() -> list[dict]:
+
+        with ModelRegistry.__lock:
+            return [{
+                "model_folder_path": key[0],
+                "model_type": key[1],
+                "quantization": key[2],
+                "backend": key[3],
+                "resident_bytes": ModelRegistry.__resident_bytes[key],
+                "pins": ModelRegistry.__pins[key],
+                "load_seconds": ModelRegistry.__load_seconds[key]
+            } for key in ModelRegistry.__models]
@@ -0,0 +1,149 @@
+import bisect, difflib, re
+
+class PerturbationCandidate:
+
+    def __init__(self,
+                 word: str,
+                 start: int,
+                 end: int,
+                 occurrence: int,
+                 replacement: str,
+                 mode: int,
+                 text_index: int):
+
+        self.word = word
+        self.start = start
+        self.end = end
+        self.occurrence = occurrence
+        self.replacement = replacement
+        self.mode = mode
+        self.text_index = text_index
+
+
+class PerturbationPlan:
+
+    def __init__(self, input: str):
+        self.input = input
+        self.candidates: list[PerturbationCandidate] = []
+        self.texts: list[str] = []
+        self.text_candidates: list[list[PerturbationCandidate]] = []
+
+        self.__text_indexes: dict[str, int] = {}
+
+
+    def add_candidate(self,
+                      word: str,
+                      start: int,
+                      end: int,
+                      occurrence: int,
+                      replacement: str,
+                      mode: int):
+
+        text = self.input[:start] + replacement + self.input[end:]
+
+        ## Identical perturbed strings share one inference, whichever word or
+        ## mode produced them.
+        text_index = self.__text_indexes.get(text)
+
+        if text_index is None:
+            text_index = len(self.texts)
+            self.__text_indexes[text] = text_index
+            self.texts.append(text)
+            self.text_candidates.append([])
+
+        candidate = PerturbationCandidate(word, start, end, occurrence, replacement, mode, text_index)
+
+        self.candidates.append(candidate)
+        self.text_candidates[text_index].append(candidate)
+
+
+    def get_num_of_candidates(self) -> int:
+        return len(self.candidates)
+
+
+    def get_num_of_inferences(self) -> int:
+        return len(self.texts)
+
+
+class PerturbationPlanner:
+
+    WORD_PATTERN = re.compile(r"[A-Za-z]+")
+
+    def get_word_spans(input: str) -> list[tuple[str, int, int]]:
+
+        return [(match.group(), match.start(), match.end()) for match in PerturbationPlanner.WORD_PATTERN.finditer(input)]
+
+
+    def get_unchanged_spans(previous_input: str, input: str, context_words: int = 0) -> list[tuple[int, int, int]]:
+        """Spans of `input` that are unchanged from `previous_input` and more
+        than `context_words` words away from any edit, as (start, end,
+        previous start) tuples.
+        """
+
+        matcher = difflib.SequenceMatcher(None, previous_input, input, autojunk=False)
+        opcodes = matcher.get_opcodes()
+
+        word_spans = PerturbationPlanner.get_word_spans(input)
+        word_starts = [start for _, start, _ in word_spans]
+        word_ends = [end for _, _, end in word_spans]
+
+        edited_spans = []
+
+        for tag, _, _, start, end in opcodes:
+            if tag == "equal":
+                continue
+
+            ## Words touching an edit are changed too, as are the words of
+            ## the context window either side of it.
+            first_word = max(bisect.bisect_left(word_ends, start) - context_words, 0)
+            last_word = min(bisect.bisect_right(word_starts, end) - 1 + context_words, len(word_spans) - 1)
+
+            if first_word < len(word_spans):
+                start = min(start, word_starts[first_word])
+
+            if last_word >= 0:
+                end = max(end, word_ends[last_word])
+
+            edited_spans.append((start, end))
+
+        unchanged_spans = []
+
+        for tag, previous_start, _, start, end in opcodes:
+            if tag != "equal":
+                continue
+
+            offset = previous_start - start
+
+            for edited_start, edited_end in edited_spans:
+                if edited_start < end and edited_end > start:
+                    if start < edited_start:
+                        unchanged_spans.append((start, edited_start, start + offset))
+
+                    start = max(start, edited_end)
+
+            if start < end:
+                unchanged_spans.append((start, end, start + offset))
+
+        return unchanged_spans
+
+
+    def plan(input: str,
+             modes: list[int],
+             get_replacements,
+             min_word_len: int = 0) -> PerturbationPlan:
+
+        perturbation_plan = PerturbationPlan(input)
+        occurrences: dict[str, int] = {}
+
+        for word, start, end in PerturbationPlanner.get_word_spans(input):
+
+            occurrences[word] = occurrences.get(word, 0) + 1
+
+            if len(word) <= min_word_len:
+                continue
+
+            for mode in modes:
+                for replacement in get_replacements(word, mode):
+                    perturbation_plan.add_candidate(word, start, end, occurrences[word], replacement, mode)
+
+        return perturbation_plan
@@ -1,31 +1,106 @@
-import torch
-from transformers import T5Tokenizer, T5ForConditionalGeneration, AutoTokenizer, AutoModelForCausalLM
+import torch, os, threading, time, hashlib, json, transformers
+from bisect import bisect_left
+from transformers import T5Tokenizer, T5TokenizerFast, T5ForConditionalGeneration, AutoTokenizer, AutoModelForCausalLM, AutoModelForSequenceClassification, TextIteratorStreamer
 from scripts.utility.logger import Logger
+from custom.scripts.prediction_cache import PredictionCache
+from custom.scripts.label_trie import LabelTrie
+from custom.scripts.inference_backends import BACKENDS, EagerBackend, CompiledBackend, OnnxBackend
 
 class PreTrainedLLM:
     
     BERT = 0
     QWEN = 1
+    CLASSIFIER = 2
 
     CPU_DEVICE_NAME = "cpu"
     GPU_DEVICE_NAME = "cuda"
 
     DEFAULT_MAX_INPUT_LENGTH = 512
     DEFAULT_MAX_OUTPUT_LENGTH = 128
+    DEFAULT_BATCH_SIZE = 16
+    
+    INT8_QUANTIZATION = "int8"
+    QUANTIZATIONS = (INT8_QUANTIZATION,)
+    QUANTIZED_CACHE_FOLDER_PATH = os.path.join("cache", "quantized")
+    
+    EAGER_BACKEND = EagerBackend.NAME
+    COMPILED_BACKEND = CompiledBackend.NAME
+    ONNX_BACKEND = OnnxBackend.NAME
+    BACKENDS = tuple(BACKENDS)
+    ONNX_CACHE_FOLDER_PATH = os.path.join("cache", "onnx")
+    
+    USE_FAST_TOKENIZER = True
+    FAST_TOKENIZER_FILE_NAME = "tokenizer.json"
+    TOKENIZER_CACHE_FOLDER_PATH = os.path.join("cache", "tokenizers")
+    
+    WEIGHTS_HASH_CHUNK_BYTES = 1024 ** 2
+    
+    TOKENISATION_STAGE = "tokenisation"
+    GENERATION_STAGE = "generation"
+    DECODING_STAGE = "decoding"
+    STAGES = (TOKENISATION_STAGE, GENERATION_STAGE, DECODING_STAGE)
+    
+    __MATCH = "1"
+    __NO_MATCH = "0"
+    __WORD_BOUNDARY_PIECE = "\u2581"
 
-    def __init__(self, model_type = BERT):
+    def __init__(self, 
+                 model_type = BERT, 
+                 prediction_cache: PredictionCache = None, 
+                 quantization: str = None, 
+                 backend: str = EAGER_BACKEND):
         self.__device = self.__setup_device()
         self.__model_folder_path = None
         self.__input_text = None
 
         self.tokenizer = None
         self.model = None
+        self.backend = None
         self.tokenised_input = None
         
         self.max_input_length = self.DEFAULT_MAX_INPUT_LENGTH
         self.max_output_length = self.DEFAULT_MAX_OUTPUT_LENGTH
+        self.batch_size = self.DEFAULT_BATCH_SIZE
+        self.time_to_first_token = None
+        
+        self.__splice_source = None
+        self.__weights_hash = None
+        self.__weights_stamp = None
+        self.label_trie = None
+        self.label_vocabulary_path = None
+        self.class_labels = None
+        self.__label_key = None
+        self.num_of_spliced = 0
+        self.num_of_tokenised = 0
+        
+        self.stage_seconds: dict[str, float] = dict.fromkeys(self.STAGES, 0.0)
+        self.batch_timings: list[tuple[int, float]] = []
+        self.num_of_input_tokens = 0
+        self.num_of_output_tokens = 0
         
         self.model_type = model_type
+        self.quantization = quantization
+        
+        if quantization is not None and quantization not in self.QUANTIZATIONS:
+            Logger.raise_exception(f"Unknown quantization '{quantization}'.")
+        
+        if quantization is not None and model_type != self.BERT:
+            Logger.log_warning("Quantization is only supported for the BERT model type and will be ignored.")
+        
+        if self.is_quantized() and self.__device == self.GPU_DEVICE_NAME:
+            Logger.log_warning("Quantized models only run on the CPU.")
+            self.__device = self.CPU_DEVICE_NAME
+        
+        if backend not in self.BACKENDS:
+            Logger.raise_exception(f"Unknown inference backend '{backend}'.")
+        
+        self.backend_name = backend
+        
+        if backend != self.EAGER_BACKEND and (model_type != self.BERT or self.is_quantized()):
+            Logger.log_warning(f"The '{backend}' backend only supports the unquantized BERT model type. Using the eager backend.")
+            self.backend_name = self.EAGER_BACKEND
+        
+        self.prediction_cache = prediction_cache if prediction_cache is not None else PredictionCache()
 
 
     def __setup_device(self) -> str:
@@ -50,8 +125,12 @@ class PreTrainedLLM:
             Logger.raise_exception("Model folder path is empty.")
 
         if self.model_type == self.BERT:
-            self.tokenizer = T5Tokenizer.from_pretrained(self.__model_folder_path)
-            self.model = T5ForConditionalGeneration.from_pretrained(self.__model_folder_path).to(self.__device)
+            self.tokenizer = self.__load_tokenizer()
+            
+            if self.is_quantized():
+                self.model = self.__load_quantized_model()
+            else:
+                self.model = T5ForConditionalGeneration.from_pretrained(self.__model_folder_path).to(self.__device)
             
         elif self.model_type == self.QWEN:
             self.tokenizer = AutoTokenizer.from_pretrained(self.__model_folder_path)
@@ -60,6 +139,149 @@ class PreTrainedLLM:
                 torch_dtype=torch.float16,
                 device_map="auto"
             )
+            
+            ## Decoder-only models must be left padded for batched generation.
+            self.tokenizer.padding_side = "left"
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+        
+        elif self.model_type == self.CLASSIFIER:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.__model_folder_path)
+            self.model = AutoModelForSequenceClassification.from_pretrained(self.__model_folder_path).to(self.__device)
+            self.model.eval()
+        
+        self.backend = self.__create_backend()
+
+
+    def __load_tokenizer(self):
+        
+        if not self.USE_FAST_TOKENIZER:
+            return T5Tokenizer.from_pretrained(self.__model_folder_path)
+        
+        if os.path.exists(os.path.join(self.__model_folder_path, self.FAST_TOKENIZER_FILE_NAME)):
+            return T5TokenizerFast.from_pretrained(self.__model_folder_path)
+        
+        ## Converting the SentencePiece model to a fast tokenizer takes seconds,
+        ## so the result is saved and reused on the next start.
+        tokenizer_cache_path = os.path.join(self.TOKENIZER_CACHE_FOLDER_PATH, self.__get_model_cache_key("fast_tokenizer"))
+        
+        if os.path.exists(os.path.join(tokenizer_cache_path, self.FAST_TOKENIZER_FILE_NAME)):
+            PreTrainedLLM.__remove_add_prefix_space(tokenizer_cache_path)
+            return T5TokenizerFast.from_pretrained(tokenizer_cache_path)
+        
+        try:
+            tokenizer = T5TokenizerFast.from_pretrained(self.__model_folder_path)
+        except Exception as error:
+            Logger.log_warning(f"Fast tokenizer could not be converted, using the slow tokenizer: {error}")
+            return T5Tokenizer.from_pretrained(self.__model_folder_path)
+        
+        tokenizer.save_pretrained(tokenizer_cache_path)
+        PreTrainedLLM.__remove_add_prefix_space(tokenizer_cache_path)
+        Logger.log_info(f"Fast tokenizer cached at: '{tokenizer_cache_path}'")
+        
+        return tokenizer
+    
+    
+    def __remove_add_prefix_space(tokenizer_folder_path: str):
+        
+        ## save_pretrained always writes add_prefix_space, and T5TokenizerFast
+        ## converts from the slow tokenizer again whenever it is set. The saved
+        ## tokenizer.json already holds the pre-tokenizer it configures.
+        config_path = os.path.join(tokenizer_folder_path, "tokenizer_config.json")
+        
+        if not os.path.exists(config_path):
+            return
+        
+        with open(config_path, "r", encoding="utf-8") as file:
+            config = json.load(file)
+        
+        if "add_prefix_space" not in config:
+            return
+        
+        del config["add_prefix_space"]
+        
+        with open(config_path, "w", encoding="utf-8") as file:
+            json.dump(config, file, indent=2, ensure_ascii=False)
+    
+    
+    def __create_backend(self):
+        
+        if self.backend_name == self.ONNX_BACKEND:
+            return OnnxBackend(
+                self.model, 
+                self.__device, 
+                os.path.join(self.ONNX_CACHE_FOLDER_PATH, self.__get_model_cache_key(self.ONNX_BACKEND)))
+        
+        return BACKENDS[self.backend_name](self.model, self.__device)
+    
+    
+    def get_folder_stamp(model_folder_path: str) -> str:
+        
+        ## File sizes and modification times, so a checkpoint retrained into
+        ## the same folder is told apart without reading the weights.
+        file_stamps = []
+        
+        for file_name in sorted(os.listdir(model_folder_path)):
+            file_path = os.path.join(model_folder_path, file_name)
+            
+            if os.path.isfile(file_path):
+                file_stamps.append(f"{file_name}:{os.path.getsize(file_path)}:{os.path.getmtime(file_path)}")
+        
+        return "|".join(file_stamps)
+    
+    
+    def __get_weights_stamp(self) -> str:
+        
+        if self.__weights_stamp is None:
+            self.__weights_stamp = PreTrainedLLM.get_folder_stamp(self.__model_folder_path)
+        
+        return self.__weights_stamp
+    
+    
+    def __get_model_cache_key(self, variant: str) -> str:
+        
+        ## Any change to the weights or library versions invalidates the cache.
+        key_parts = [os.path.abspath(self.__model_folder_path), variant, torch.__version__, transformers.__version__, self.__get_weights_stamp()]
+        
+        return hashlib.sha256("|".join(key_parts).encode("utf-8")).hexdigest()
+    
+    
+    def __load_quantized_model(self):
+        
+        quantized_cache_path = os.path.join(self.QUANTIZED_CACHE_FOLDER_PATH, f"{self.__get_model_cache_key(self.quantization)}.pt")
+        
+        if os.path.exists(quantized_cache_path):
+            Logger.log_info(f"Loading quantized model from cache: '{quantized_cache_path}'")
+            
+            try:
+                return torch.load(quantized_cache_path, weights_only=False)
+            except Exception as error:
+                Logger.log_warning(f"Quantized model cache could not be loaded, quantizing again: {error}")
+        
+        model = T5ForConditionalGeneration.from_pretrained(self.__model_folder_path)
+        
+        ## Dynamic int8 kernels only exist for the CPU, so linear layers are
+        ## quantized there and activations are quantized per batch at runtime.
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        model.eval()
+        
+        os.makedirs(self.QUANTIZED_CACHE_FOLDER_PATH, exist_ok=True)
+        torch.save(model, quantized_cache_path)
+        
+        Logger.log_info(f"Quantized model cached at: '{quantized_cache_path}'")
+        
+        return model
+    
+    
+    def is_quantized(self) -> bool:
+        return self.quantization is not None and self.model_type == self.BERT
+    
+    
+    def __check_model_loaded(self):
+        
+        if self.model is None or self.tokenizer is None or self.backend is None:
+            Logger.log_info("Model or tokenizer is not loaded. Model and tokenizer will be loaded.")
+            self.__load_model()
 
 
     def __tokenise_input(self):
@@ -67,25 +289,653 @@ class PreTrainedLLM:
         if self.__input_text is None:
             Logger.raise_exception("Input text is empty.")
 
-        if self.model is None or self.tokenizer is None:
-            Logger.log_info("Model or tokenizer is not loaded. Model and tokenizer will be loaded.")
-            self.__load_model()
+        self.__check_model_loaded()
 
         self.tokenised_input = self.tokenizer(self.__input_text, return_tensors="pt", max_length=self.max_input_length, truncation=True).to(self.__device)
+        
+        
+    def __get_common_prefix_length(text: str, other_text: str) -> int:
+        
+        ## Binary search over slice comparisons keeps the scan in C.
+        low, high = 0, min(len(text), len(other_text))
+        
+        while low < high:
+            middle = (low + high + 1) // 2
+            
+            if text[:middle] == other_text[:middle]:
+                low = middle
+            else:
+                high = middle - 1
+        
+        return low
+    
+    
+    def __get_common_suffix_length(text: str, other_text: str, max_length: int) -> int:
+        
+        low, high = 0, max_length
+        
+        while low < high:
+            middle = (low + high + 1) // 2
+            
+            if text[len(text) - middle:] == other_text[len(other_text) - middle:]:
+                low = middle
+            else:
+                high = middle - 1
+        
+        return low
+    
+    
+    def __splice(self, input_text: str) -> list[int]:
+        
+        source_text, source_ids, source_offsets, source_starts = self.__splice_source
+        
+        if input_text == source_text:
+            return list(source_ids)
+        
+        prefix_length = PreTrainedLLM.__get_common_prefix_length(input_text, source_text)
+        suffix_length = PreTrainedLLM.__get_common_suffix_length(
+            input_text, 
+            source_text, 
+            min(len(input_text), len(source_text)) - prefix_length)
+        
+        ## SentencePiece splits on whitespace before anything else, so a span
+        ## widened to whitespace on both sides tokenises the same on its own.
+        start = prefix_length
+        while start > 0 and not source_text[start - 1].isspace():
+            start -= 1
+        
+        source_end = len(source_text) - suffix_length
+        while source_end < len(source_text) and not source_text[source_end].isspace():
+            source_end += 1
+        
+        input_end = source_end + len(input_text) - len(source_text)
+        
+        first_index = bisect_left(source_starts, start)
+        end_index = bisect_left(source_starts, source_end)
+        
+        ## Tokens must start and end on the span's edges to be swapped out.
+        if ((first_index > 0 and source_offsets[first_index - 1][1] > start) or 
+            (end_index > first_index and source_offsets[end_index - 1][1] > source_end)):
+            return None
+        
+        span_ids = self.tokenizer(input_text[start:input_end], add_special_tokens=False)["input_ids"]
+        content_length = len(source_offsets)
+        input_ids = source_ids[:first_index] + span_ids + source_ids[end_index:content_length] + source_ids[content_length:]
+
+        ## A longer word can push the candidate past the limit, where the
+        ## tokenizer would truncate it, so it is tokenised in full instead.
+        if len(input_ids) > self.max_input_length:
+            return None
+
+        return input_ids
+    
+    
+    def __encode_batch(self, input_texts: list[str]) -> list[list[int]]:
+        
+        start_time = time.perf_counter()
+        input_ids_list = [None] * len(input_texts)
+        
+        if self.__splice_source is not None:
+            for index, input_text in enumerate(input_texts):
+                input_ids_list[index] = self.__splice(input_text)
+        
+        tokenise_indexes = [index for index, input_ids in enumerate(input_ids_list) if input_ids is None]
+        
+        if len(tokenise_indexes) > 0:
+            tokenised_ids_list = self.tokenizer(
+                [input_texts[index] for index in tokenise_indexes], 
+                max_length=self.max_input_length, 
+                truncation=True)["input_ids"]
+            
+            for index, input_ids in zip(tokenise_indexes, tokenised_ids_list):
+                input_ids_list[index] = input_ids
+        
+        self.num_of_spliced += len(input_texts) - len(tokenise_indexes)
+        self.num_of_tokenised += len(tokenise_indexes)
+        self.stage_seconds[self.TOKENISATION_STAGE] += time.perf_counter() - start_time
+        
+        return input_ids_list
+        
+        
+    def __pad_batch(self, input_ids_list: list[list[int]]):
+        
+        return self.tokenizer.pad(
+            {"input_ids": input_ids_list}, 
+            padding=True, 
+            return_tensors="pt").to(self.__device)
+        
+        
+    def __get_batches(self, items: list) -> list[list]:
+        
+        if self.batch_size < 1:
+            Logger.raise_exception("Batch size must be at least 1.")
+        
+        return [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+
+    def __get_model_identity(self) -> str:
+        
+        if self.__model_folder_path is None:
+            return f"{self.model_type}||{self.max_output_length}|{self.quantization}|{self.__label_key}"
+        
+        ## The prediction database outlives the session, so predictions of a
+        ## replaced checkpoint must not be served for the new one.
+        weights_stamp = hashlib.sha256(self.__get_weights_stamp().encode("utf-8")).hexdigest()
+        
+        return f"{self.model_type}|{os.path.abspath(self.__model_folder_path)}|{weights_stamp}|{self.max_output_length}|{self.quantization}|{self.__label_key}"
+    
+    
+    def __generate_batch(self, input_ids_list: list[list[int]]) -> list[str]:
+        
+        tokenised_batch = self.__pad_batch(input_ids_list)
+        max_new_tokens = self.max_output_length
+        
+        ## No label is longer than the deepest path through the trie.
+        if self.label_trie is not None:
+            max_new_tokens = min(max_new_tokens, self.label_trie.max_length)
+        
+        output = self.backend.generate(
+            tokenised_batch["input_ids"], 
+            tokenised_batch["attention_mask"], 
+            max_new_tokens, 
+            self.label_trie)
+        
+        ## Decoder-only models return the prompt before the new tokens. Only
+        ## the new tokens are decoded, as the output stream does.
+        if self.model_type == self.QWEN:
+            output = output[:, tokenised_batch["input_ids"].shape[1]:]
+        
+        ## The decoder start token is padding, so it is not counted.
+        self.num_of_output_tokens += int((output != self.tokenizer.pad_token_id).sum())
+        
+        start_time = time.perf_counter()
+        outputs = self.decode_batch(output)
+        self.stage_seconds[self.DECODING_STAGE] += time.perf_counter() - start_time
+        
+        return outputs
+    
+    
+    def __get_cached_results(self, 
+                             input_ids_list: list[list[int]], 
+                             model_identity: str,
+                             get_batch_results,
+                             to_cache_value = str,
+                             from_cache_value = str) -> list:
+        
+        results = [None] * len(input_ids_list)
+        
+        ## Maps each uncached key to every index sharing that input.
+        missing: dict[str, list[int]] = {}
+        
+        for index, input_ids in enumerate(input_ids_list):
+            key = PredictionCache.get_key(model_identity, input_ids)
+            
+            if key in missing:
+                missing[key].append(index)
+                continue
+            
+            cached_value = self.prediction_cache.get(key) if self.prediction_cache is not None else None
+            
+            if cached_value is not None:
+                results[index] = from_cache_value(cached_value)
+            else:
+                missing[key] = [index]
+                
+        for batch_keys in self.__get_batches(list(missing)):
+            batch_input_ids_list = [input_ids_list[missing[key][0]] for key in batch_keys]
+            decoding_seconds = self.stage_seconds[self.DECODING_STAGE]
+            
+            start_time = time.perf_counter()
+            batch_results = get_batch_results(batch_input_ids_list)
+            batch_seconds = time.perf_counter() - start_time
+            
+            ## Decoding is timed on its own inside the batch.
+            self.stage_seconds[self.GENERATION_STAGE] += batch_seconds - (self.stage_seconds[self.DECODING_STAGE] - decoding_seconds)
+            self.batch_timings.append((len(batch_keys), batch_seconds))
+            self.num_of_input_tokens += sum(len(input_ids) for input_ids in batch_input_ids_list)
+            
+            for key, result in zip(batch_keys, batch_results):
+                for index in missing[key]:
+                    results[index] = result
+            
+            if self.prediction_cache is not None:
+                self.prediction_cache.put_many([(key, to_cache_value(result)) for key, result in zip(batch_keys, batch_results)])
+                
+        return results
+    
+    
+    def __get_outputs_from_ids(self, input_ids_list: list[list[int]]) -> list[str]:
+        
+        return self.__get_cached_results(
+            input_ids_list, 
+            self.__get_model_identity(), 
+            self.__classify_batch if self.model_type == self.CLASSIFIER else self.__generate_batch)
+    
+    
+    def __get_class_labels(self) -> list[str]:
+        
+        if self.class_labels is not None:
+            return self.class_labels
+        
+        return [self.model.config.id2label[index] for index in range(self.model.config.num_labels)]
+    
+    
+    def __get_class_index(self, target_text: str) -> int:
+        
+        class_labels = self.__get_class_labels()
+        
+        if target_text not in class_labels:
+            Logger.raise_exception(f"'{target_text}' is not one of the classifier's labels.")
+        
+        return class_labels.index(target_text)
+    
+    
+    def __get_batch_log_probs(self, input_ids_list: list[list[int]]) -> torch.Tensor:
+        
+        tokenised_batch = self.__pad_batch(input_ids_list)
+        logits = self.backend.get_class_logits(tokenised_batch["input_ids"], tokenised_batch["attention_mask"])
+        
+        return torch.log_softmax(logits, dim=-1)
+    
+    
+    def __classify_batch(self, input_ids_list: list[list[int]]) -> list[str]:
+        
+        class_labels = self.__get_class_labels()
+        
+        return [class_labels[index] for index in self.__get_batch_log_probs(input_ids_list).argmax(dim=-1).tolist()]
+    
+    
+    def __get_batch_class_scores(self, input_ids_list: list[list[int]], class_index: int) -> list[tuple[float, bool]]:
+        
+        ## One forward pass gives every class probability, so the target's 
+        ## log-probability and whether it is still the argmax come together.
+        log_probs = self.__get_batch_log_probs(input_ids_list)
+        
+        return list(zip(log_probs[:, class_index].tolist(), (log_probs.argmax(dim=-1) == class_index).tolist()))
+    
+    
+    def __get_target_ids(self, target_text: str) -> list[int]:
+        
+        return self.tokenizer(target_text)["input_ids"][:self.max_output_length]
+    
+    
+    def __get_batch_matches(self, input_ids_list: list[list[int]], target_ids: list[int]) -> list[bool]:
+        
+        tokenised_batch = self.__pad_batch(input_ids_list)
+        
+        return self.backend.get_matches(tokenised_batch["input_ids"], tokenised_batch["attention_mask"], target_ids, self.label_trie)
+
+
+    def __get_batch_scores(self, input_ids_list: list[list[int]], target_ids: list[int]) -> list[tuple[float, bool]]:
+        
+        tokenised_batch = self.__pad_batch(input_ids_list)
+        labels = torch.tensor([target_ids] * len(input_ids_list), device=self.__device)
+        
+        ## A single teacher-forced pass gives the log-probability of the target 
+        ## and whether greedy decoding would reproduce it.
+        logits = self.backend.get_logits(tokenised_batch["input_ids"], tokenised_batch["attention_mask"], labels)
+        
+        target_log_probs = torch.log_softmax(logits, dim=-1).gather(-1, labels.unsqueeze(-1)).squeeze(-1)
+        scores = target_log_probs.sum(dim=-1)
+        
+        ## With a label vocabulary, greedy decoding only picks among the
+        ## tokens the trie allows, so the match is judged the same way.
+        if self.label_trie is not None:
+            logits = logits + self.backend.get_label_mask(self.label_trie, target_ids, logits.shape[-1])
+        
+        matches = (logits.argmax(dim=-1) == labels).all(dim=-1)
+        
+        return list(zip(scores.tolist(), matches.tolist()))
+
+
+    def __get_token_offsets(self, input_text: str, input_ids: list[int]) -> list[tuple[int, int]]:
+        
+        if self.tokenizer.is_fast:
+            return [tuple(offset) for offset in self.tokenizer(
+                input_text, 
+                max_length=self.max_input_length, 
+                truncation=True, 
+                return_offsets_mapping=True)["offset_mapping"]]
+        
+        ## Slow SentencePiece tokenizers have no offset mapping, so each piece
+        ## is located by walking the text.
+        offsets = []
+        cursor = 0
+        
+        for token in self.tokenizer.convert_ids_to_tokens(input_ids):
+            piece = token.replace("\u2581", "")
+            start = input_text.find(piece, cursor) if piece != "" and token not in self.tokenizer.all_special_tokens else -1
+            
+            if start == -1 or input_text[cursor:start].strip() != "":
+                offsets.append((cursor, cursor))
+            else:
+                offsets.append((start, start + len(piece)))
+                cursor = start + len(piece)
+                
+        return offsets
+
 
     def set_model_folder_path(self, model_folder_path: str):
         self.__model_folder_path = model_folder_path
+        self.__weights_hash = None
+        self.__weights_stamp = None
         self.__load_model()
 
+    def set_splice_source(self, input_text: str):
+        
+        if self.__splice_source is not None and self.__splice_source[0] == input_text:
+            return
+        
+        self.__splice_source = None
+        
+        if input_text is None or self.model_type != self.BERT:
+            return
+        
+        self.__check_model_loaded()
+        
+        source_ids = self.__encode_batch([input_text])[0]
+        num_of_special_tokens = self.tokenizer.num_special_tokens_to_add(pair=False)
+        source_offsets = self.__get_token_offsets(input_text, source_ids)[:len(source_ids) - num_of_special_tokens]
+        source_tokens = self.tokenizer.convert_ids_to_tokens(source_ids[:len(source_offsets)])
+        
+        ## Fast tokenizers count the space a piece replaces as part of it.
+        for index, (start, end) in enumerate(source_offsets):
+            while start < end and input_text[start].isspace():
+                start += 1
+            source_offsets[index] = (start, end)
+        
+        ## A truncated report hides text past the limit, and tokens without a 
+        ## position cannot be swapped, so those are always tokenised in full.
+        if (len(source_ids) >= self.max_input_length or 
+            any(start == end and token != self.__WORD_BOUNDARY_PIECE for (start, end), token in zip(source_offsets, source_tokens))):
+            Logger.log_info("Report cannot be spliced, candidates will be tokenised in full.")
+            return
+        
+        ## A lone word boundary piece comes before pieces SentencePiece could
+        ## not merge it with, so it belongs to the word that follows.
+        for index in reversed(range(len(source_offsets) - 1)):
+            if source_tokens[index] == self.__WORD_BOUNDARY_PIECE:
+                next_start = source_offsets[index + 1][0]
+                source_offsets[index] = (next_start, next_start)
+        
+        self.__splice_source = (input_text, source_ids, source_offsets, [start for start, _ in source_offsets])
+    
+    def set_label_vocabulary(self, label_vocabulary_path: str):
+        
+        self.label_vocabulary_path = label_vocabulary_path
+        self.label_trie = None
+        self.class_labels = None
+        self.__label_key = None
+        
+        if label_vocabulary_path is None:
+            return
+        
+        if self.model_type == self.QWEN:
+            Logger.raise_exception("Label vocabularies are not supported for the QWEN model type.")
+        
+        self.__check_model_loaded()
+        
+        labels = LabelTrie.read_labels(label_vocabulary_path)
+        self.__label_key = LabelTrie.get_key(labels)
+        
+        ## Classifiers trained by the notebook only store generic label names, 
+        ## and its classes are the sorted labels, as in the vocabulary file.
+        if self.model_type == self.CLASSIFIER:
+            if len(labels) != self.model.config.num_labels:
+                Logger.raise_exception(f"Label vocabulary has {len(labels)} labels but the classifier has {self.model.config.num_labels}.")
+            
+            self.class_labels = labels
+            Logger.log_info(f"Classifier labels read from '{label_vocabulary_path}'.")
+            return
+        
+        self.label_trie = LabelTrie(labels, self.tokenizer)
+        
+        Logger.log_info(f"Decoding constrained to {len(self.label_trie.labels)} labels from '{label_vocabulary_path}'.")
+    
+    def encode_batch(self, input_texts: list[str]) -> list[list[int]]:
+        
+        self.__check_model_loaded()
+        
+        return self.__encode_batch(input_texts)
+    
+    def decode_batch(self, output_ids_list) -> list[str]:
+        
+        self.__check_model_loaded()
+        
+        return self.tokenizer.batch_decode(output_ids_list, skip_special_tokens=True)
+    
+    def get_model_folder_path(self) -> str:
+        return self.__model_folder_path
+    
+    
+    def get_weights_hash(self) -> str:
+        
+        if self.__model_folder_path is None:
+            Logger.raise_exception("Model folder path is empty.")
+        
+        ## Hashes the contents rather than file stats, so a copied or moved 
+        ## model keeps its hash. Computed once per loaded model.
+        if self.__weights_hash is None:
+            weights_hash = hashlib.sha256()
+            
+            for file_name in sorted(os.listdir(self.__model_folder_path)):
+                file_path = os.path.join(self.__model_folder_path, file_name)
+                
+                if not os.path.isfile(file_path):
+                    continue
+                
+                weights_hash.update(file_name.encode("utf-8"))
+                
+                with open(file_path, "rb") as file:
+                    while chunk := file.read(self.WEIGHTS_HASH_CHUNK_BYTES):
+                        weights_hash.update(chunk)
+            
+            self.__weights_hash = weights_hash.hexdigest()
+        
+        return self.__weights_hash
+    
+    
+    def get_result_identity(self) -> str:
+        
+        return f"{self.get_weights_hash()}|{self.model_type}|{self.max_input_length}|{self.max_output_length}|{self.quantization}|{self.backend_name}|{self.__label_key}"
+
     def set_input_text(self, input_text: str):
         self.__input_text = input_text
         self.__tokenise_input()
+        
+    def set_prediction_cache(self, prediction_cache: PredictionCache):
+        self.prediction_cache = prediction_cache
 
     def get_output(self) -> str:
         if self.tokenised_input is None:
             Logger.raise_exception("Input has not been tokenised.")
 
-        with torch.no_grad():
-            output = self.model.generate(**self.tokenised_input, max_new_tokens=self.max_output_length)
-
-        return self.tokenizer.decode(output[0], skip_special_tokens=True)
\ No newline at end of file
+        return self.__get_outputs_from_ids([self.tokenised_input["input_ids"][0].tolist()])[0]
+    
+    def get_output_stream(self):
+        
+        if self.tokenised_input is None:
+            Logger.raise_exception("Input has not been tokenised.")
+        
+        self.__check_model_loaded()
+        
+        ## Shares the key of get_output, which decodes the same tokens.
+        input_ids = self.tokenised_input["input_ids"][0].tolist()
+        key = PredictionCache.get_key(self.__get_model_identity(), input_ids)
+        cached_output = self.prediction_cache.get(key) if self.prediction_cache is not None else None
+        
+        if cached_output is not None:
+            self.time_to_first_token = 0.0
+            yield cached_output
+            return
+        
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+        
+        def generate():
+            try:
+                with torch.no_grad():
+                    self.model.generate(**self.tokenised_input, max_new_tokens=self.max_output_length, streamer=streamer)
+            
+            ## The streamer is only ended by generate on success, so it is
+            ## ended here on failure to stop the consumer blocking forever.
+            except Exception as error:
+                errors.append(error)
+                streamer.end()
+        
+        start_time = time.perf_counter()
+        self.time_to_first_token = None
+        
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        
+        output = ""
+        
+        for delta in streamer:
+            if delta == "":
+                continue
+            
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.perf_counter() - start_time
+                Logger.log_info(f"Time to first token: {self.time_to_first_token:.2f}s")
+            
+            output += delta
+            yield delta
+        
+        thread.join()
+        
+        if len(errors) > 0:
+            raise errors[0]
+        
+        if self.prediction_cache is not None:
+            self.prediction_cache.put(key, output)
+    
+    
+    def get_outputs(self, input_texts: list[str]) -> list[str]:
+        
+        if len(input_texts) == 0:
+            return []
+        
+        self.__check_model_loaded()
+        
+        return self.__get_outputs_from_ids(self.__encode_batch(input_texts))
+    
+    def get_matches(self, input_texts: list[str], target_text: str) -> list[bool]:
+        
+        if self.model_type == self.QWEN:
+            Logger.raise_exception("Match only decoding is not supported for the QWEN model type.")
+        
+        if len(input_texts) == 0:
+            return []
+        
+        self.__check_model_loaded()
+        
+        if self.model_type == self.CLASSIFIER:
+            return [match for _, match in self.get_scores_and_matches(input_texts, target_text)]
+        
+        target_ids = self.__get_target_ids(target_text)
+        
+        return self.__get_cached_results(
+            self.__encode_batch(input_texts),
+            self.__get_model_identity() + "|match|" + ",".join(str(i) for i in target_ids),
+            lambda input_ids_list: self.__get_batch_matches(input_ids_list, target_ids),
+            lambda match: self.__MATCH if match else self.__NO_MATCH,
+            lambda cached_value: cached_value == self.__MATCH)
+    
+    def get_scores_and_matches(self, input_texts: list[str], target_text: str) -> list[tuple[float, bool]]:
+        
+        if self.model_type == self.QWEN:
+            Logger.raise_exception("Likelihood scoring is not supported for the QWEN model type.")
+        
+        if len(input_texts) == 0:
+            return []
+        
+        self.__check_model_loaded()
+        
+        if self.model_type == self.CLASSIFIER:
+            class_index = self.__get_class_index(target_text)
+            
+            return self.__get_cached_results(
+                self.__encode_batch(input_texts),
+                self.__get_model_identity() + f"|score|class{class_index}",
+                lambda input_ids_list: self.__get_batch_class_scores(input_ids_list, class_index),
+                lambda result: f"{result[0]!r}|{int(result[1])}",
+                lambda cached_value: (float(cached_value.split("|")[0]), cached_value.split("|")[1] == self.__MATCH))
+        
+        target_ids = self.__get_target_ids(target_text)
+        
+        return self.__get_cached_results(
+            self.__encode_batch(input_texts),
+            self.__get_model_identity() + "|score|" + ",".join(str(i) for i in target_ids),
+            lambda input_ids_list: self.__get_batch_scores(input_ids_list, target_ids),
+            lambda result: f"{result[0]!r}|{int(result[1])}",
+            lambda cached_value: (float(cached_value.split("|")[0]), cached_value.split("|")[1] == self.__MATCH))
+    
+    def score(self, input_texts: list[str], target_text: str) -> list[float]:
+        
+        return [score for score, _ in self.get_scores_and_matches(input_texts, target_text)]
+    
+    def get_probabilities(self, input_texts: list[str]) -> list[dict[str, float]]:
+        
+        if self.model_type != self.CLASSIFIER:
+            Logger.raise_exception("Class probabilities are only available for the CLASSIFIER model type.")
+        
+        if len(input_texts) == 0:
+            return []
+        
+        self.__check_model_loaded()
+        
+        class_labels = self.__get_class_labels()
+        probabilities = []
+        
+        for batch in self.__get_batches(self.__encode_batch(input_texts)):
+            for row in self.__get_batch_log_probs(batch).exp().tolist():
+                probabilities.append(dict(zip(class_labels, row)))
+        
+        return probabilities
+    
+    
+    def get_token_saliency(self, input_text: str, target_text: str) -> list[tuple[int, int, float]]:
+        
+        if self.model_type == self.QWEN:
+            Logger.raise_exception("Token saliency is not supported for the QWEN model type.")
+        
+        if self.is_quantized():
+            Logger.raise_exception("Token saliency needs gradients, which quantized models do not support.")
+        
+        self.__check_model_loaded()
+        
+        input_ids = self.__encode_batch([input_text])[0]
+        tokenised_input = self.__pad_batch([input_ids])
+        
+        if self.model_type == self.CLASSIFIER:
+            labels = torch.tensor([self.__get_class_index(target_text)], device=self.__device)
+        else:
+            labels = torch.tensor([self.__get_target_ids(target_text)], device=self.__device)
+        
+        ## Gradient x input estimates how much the loss of the original output 
+        ## changes if a token is removed, from a single forward/backward pass.
+        with torch.enable_grad():
+            embeddings = self.model.get_input_embeddings()(tokenised_input["input_ids"]).detach().requires_grad_(True)
+            loss = self.model(
+                inputs_embeds=embeddings, 
+                attention_mask=tokenised_input["attention_mask"], 
+                labels=labels).loss
+            gradient = torch.autograd.grad(loss, embeddings)[0]
+        
+        saliency = (gradient * embeddings).sum(dim=-1).abs()[0].tolist()
+        
+        return [(start, end, token_saliency) 
+                for (start, end), token_saliency in zip(self.__get_token_offsets(input_text, input_ids), saliency)]
+    
+    def reset_timings(self):
+        
+        self.stage_seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.batch_timings = []
+    
+    
+    def get_cache_stats(self) -> dict[str, int]:
+        
+        if self.prediction_cache is None:
+            return {}
+        
+        return self.prediction_cache.get_stats()
@@ -0,0 +1,126 @@
+import hashlib, sqlite3, threading
+from collections import OrderedDict
+from scripts.utility.logger import Logger
+
+class PredictionCache:
+
+    DEFAULT_MAX_SIZE = 4096
+
+    __CREATE_TABLE = "CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, output TEXT NOT NULL)"
+    __SELECT_OUTPUT = "SELECT output FROM predictions WHERE key = ?"
+    __INSERT_OUTPUT = "INSERT OR REPLACE INTO predictions (key, output) VALUES (?, ?)"
+    __DELETE_ALL = "DELETE FROM predictions"
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, database_path: str = None):
+
+        if max_size < 0:
+            Logger.raise_exception("Prediction cache size must not be negative.")
+
+        self.max_size = max_size
+        self.database_path = database_path
+
+        self.__memory: OrderedDict[str, str] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__connection = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if database_path is not None:
+            self.__connection = sqlite3.connect(database_path, check_same_thread=False)
+            self.__connection.execute(self.__CREATE_TABLE)
+            self.__connection.commit()
+            Logger.log_info(f"Prediction cache database opened at: '{database_path}'")
+
+
+    def get_key(model_identity: str, input_ids: list[int]) -> str:
+
+        key_text = model_identity + "|" + ",".join(str(i) for i in input_ids)
+
+        return hashlib.sha256(key_text.encode("utf-8")).hexdigest()
+
+
+    def __add_to_memory(self, key: str, output: str):
+
+        if self.max_size == 0:
+            return
+
+        self.__memory[key] = output
+        self.__memory.move_to_end(key)
+
+        while len(self.__memory) > self.max_size:
+            self.__memory.popitem(last=False)
+
+
+    def get(self, key: str) -> str:
+
+        with self.__lock:
+
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.__memory[key]
+
+            if self.__connection is not None:
+                row = self.__connection.execute(self.__SELECT_OUTPUT, (key,)).fetchone()
+
+                if row is not None:
+                    self.__add_to_memory(key, row[0])
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+
+    def put(self, key: str, output: str):
+        self.put_many([(key, output)])
+
+
+    def put_many(self, items: list[tuple[str, str]]):
+
+        with self.__lock:
+            for key, output in items:
+                self.__add_to_memory(key, output)
+
+            ## One transaction per model batch rather than one per row.
+            if self.__connection is not None and len(items) > 0:
+                self.__connection.executemany(self.__INSERT_OUTPUT, items)
+                self.__connection.commit()
+
+
+    def get_stats(self) -> dict[str, int]:
+
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_size": len(self.__memory),
+            "max_size": self.max_size
+        }
+
+
+    def reset_stats(self):
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+
+    def clear(self):
+
+        with self.__lock:
+            self.__memory.clear()
+
+            if self.__connection is not None:
+                self.__connection.execute(self.__DELETE_ALL)
+                self.__connection.commit()
+
+
+    def close(self):
+
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
@@ -0,0 +1,129 @@
+import hashlib, json, sqlite3, threading, time, zlib
+from scripts.utility.logger import Logger
+
+class ResultStore:
+    """SQLite store of finished counterfactual runs, keyed by a hash of the
+    model weights, the generation settings and the report. Entries are kept
+    compressed and the least recently used are evicted once the store grows
+    past `max_bytes`.
+    """
+
+    DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+    
+    ## CLI workers share one store, so writers wait for each other's locks.
+    DATABASE_TIMEOUT_SECONDS = 60.0
+
+    __ENABLE_WAL = "PRAGMA journal_mode=WAL"
+    __CREATE_TABLE = "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, payload BLOB NOT NULL, size_bytes INTEGER NOT NULL, last_used REAL NOT NULL)"
+    __CREATE_INDEX = "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+    __SELECT_PAYLOAD = "SELECT payload FROM results WHERE key = ?"
+    __UPDATE_LAST_USED = "UPDATE results SET last_used = ? WHERE key = ?"
+    __INSERT_PAYLOAD = "INSERT OR REPLACE INTO results (key, payload, size_bytes, last_used) VALUES (?, ?, ?, ?)"
+    __SELECT_TOTAL_BYTES = "SELECT COALESCE(SUM(size_bytes), 0) FROM results"
+    __SELECT_OLDEST = "SELECT key, size_bytes FROM results ORDER BY last_used"
+    __DELETE_KEY = "DELETE FROM results WHERE key = ?"
+    __DELETE_ALL = "DELETE FROM results"
+
+    def __init__(self, database_path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+
+        if max_bytes < 0:
+            Logger.raise_exception("Result store size must not be negative.")
+
+        self.database_path = database_path
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(database_path, timeout=self.DATABASE_TIMEOUT_SECONDS, check_same_thread=False)
+        
+        ## Readers then never block the one writer, or each other.
+        self.__connection.execute(self.__ENABLE_WAL)
+        self.__connection.execute(self.__CREATE_TABLE)
+        self.__connection.execute(self.__CREATE_INDEX)
+        self.__connection.commit()
+
+        Logger.log_info(f"Result store opened at: '{database_path}'")
+
+
+    def get_key(*key_parts: str) -> str:
+        return hashlib.sha256("|".join(str(key_part) for key_part in key_parts).encode("utf-8")).hexdigest()
+
+
+    def get(self, key: str) -> dict:
+
+        with self.__lock:
+            row = self.__connection.execute(self.__SELECT_PAYLOAD, (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.__connection.execute(self.__UPDATE_LAST_USED, (time.time(), key))
+            self.__connection.commit()
+            self.hits += 1
+
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+
+    def __evict(self):
+
+        total_bytes = self.__connection.execute(self.__SELECT_TOTAL_BYTES).fetchone()[0]
+
+        if total_bytes <= self.max_bytes:
+            return
+
+        evicted_keys = []
+
+        for key, size_bytes in self.__connection.execute(self.__SELECT_OLDEST).fetchall():
+            if total_bytes <= self.max_bytes:
+                break
+
+            evicted_keys.append((key,))
+            total_bytes -= size_bytes
+
+        self.__connection.executemany(self.__DELETE_KEY, evicted_keys)
+        Logger.log_info(f"Evicted {len(evicted_keys)} results from the result store.")
+
+
+    def put(self, key: str, result: dict):
+
+        payload = zlib.compress(json.dumps(result).encode("utf-8"))
+
+        if len(payload) > self.max_bytes:
+            Logger.log_warning("Result is larger than the result store and was not stored.")
+            return
+
+        with self.__lock:
+            self.__connection.execute(self.__INSERT_PAYLOAD, (key, payload, len(payload), time.time()))
+            self.__evict()
+            self.__connection.commit()
+
+
+    def get_stats(self) -> dict[str, int]:
+
+        with self.__lock:
+            total_bytes = self.__connection.execute(self.__SELECT_TOTAL_BYTES).fetchone()[0]
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size_bytes": total_bytes,
+            "max_bytes": self.max_bytes
+        }
+
+
+    def clear(self):
+
+        with self.__lock:
+            self.__connection.execute(self.__DELETE_ALL)
+            self.__connection.commit()
+
+
+    def close(self):
+
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
@@ -0,0 +1,190 @@
+import os, torch, multiprocessing
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from custom.scripts.model_registry import ModelRegistry
+from custom.scripts.prediction_cache import PredictionCache
+from scripts.utility.logger import Logger
+
+class ShardedLLM:
+    """Splits batched candidate evaluation across worker processes, each with
+    its own copy of the model and a share of the CPU threads. Results are
+    merged back in candidate order. Single input calls such as saliency are
+    run by the wrapped PreTrainedLLM in this process.
+    """
+
+    shard_llm: PreTrainedLLM = None
+    
+    CACHE_STATS = ("memory_hits", "disk_hits", "misses")
+
+    def __init__(self, llm: PreTrainedLLM, num_of_shards: int, threads_per_shard: int = None):
+
+        if num_of_shards < 1:
+            Logger.raise_exception("Number of shards must be at least 1.")
+
+        if llm.get_model_folder_path() is None:
+            Logger.raise_exception("The model must be loaded before it can be sharded.")
+
+        self.llm = llm
+        self.model_type = llm.model_type
+        self.num_of_shards = num_of_shards
+
+        ## Callers hand over one batch per shard at a time.
+        self.batch_size = llm.batch_size * num_of_shards
+        self.splice_source = None
+        
+        ## Summed over every shard, so stage times can exceed the wall time.
+        self.stage_seconds: dict[str, float] = dict.fromkeys(PreTrainedLLM.STAGES, 0.0)
+        self.batch_timings: list[tuple[int, float]] = []
+        self.num_of_input_tokens = 0
+        self.num_of_output_tokens = 0
+        self.__shard_cache_stats: dict[str, int] = dict.fromkeys(self.CACHE_STATS, 0)
+        
+        self.threads_per_shard = threads_per_shard if threads_per_shard is not None else max(1, (os.cpu_count() or 1) // num_of_shards)
+
+        Logger.log_info(f"Starting {num_of_shards} model shards with {self.threads_per_shard} thread(s) each.")
+
+        ## Forking a process that has already run torch is unsafe, so each
+        ## shard starts a fresh interpreter and loads its own model.
+        self.__pool = multiprocessing.get_context("spawn").Pool(
+            num_of_shards,
+            initializer=ShardedLLM.init_shard,
+            initargs=(
+                llm.get_model_folder_path(),
+                llm.model_type,
+                llm.quantization,
+                llm.backend_name,
+                llm.batch_size,
+                llm.max_input_length,
+                llm.max_output_length,
+                llm.label_vocabulary_path,
+                self.threads_per_shard,
+                llm.prediction_cache.max_size if llm.prediction_cache is not None else None))
+
+
+    def init_shard(model_folder_path: str,
+                   model_type: int,
+                   quantization: str,
+                   backend: str,
+                   batch_size: int,
+                   max_input_length: int,
+                   max_output_length: int,
+                   label_vocabulary_path: str,
+                   num_of_threads: int,
+                   cache_max_size: int = None):
+
+        torch.set_num_threads(num_of_threads)
+
+        ShardedLLM.shard_llm = ModelRegistry.get_model(model_folder_path, model_type, quantization, backend, pin=True)
+        ShardedLLM.shard_llm.batch_size = batch_size
+        ShardedLLM.shard_llm.max_input_length = max_input_length
+        ShardedLLM.shard_llm.max_output_length = max_output_length
+        ShardedLLM.shard_llm.set_label_vocabulary(label_vocabulary_path)
+        
+        ## Shards keep their own in-memory cache the size of the parent's, so
+        ## a parent with caching disabled is not sped up by its shards'. The
+        ## parent's database is not shared between processes.
+        ShardedLLM.shard_llm.set_prediction_cache(PredictionCache(cache_max_size) if cache_max_size is not None else None)
+
+
+    def run_shard(method_name: str, input_texts: list[str], args: tuple, splice_source: str) -> tuple[list, dict]:
+
+        llm = ShardedLLM.shard_llm
+        stage_seconds = dict(llm.stage_seconds)
+        num_of_batches = len(llm.batch_timings)
+        num_of_input_tokens = llm.num_of_input_tokens
+        num_of_output_tokens = llm.num_of_output_tokens
+        cache_stats = llm.get_cache_stats()
+
+        llm.set_splice_source(splice_source)
+        results = getattr(llm, method_name)(input_texts, *args)
+
+        ## Only this call's costs are sent back, to be added up by the parent.
+        return results, {
+            "stage_seconds": {stage: llm.stage_seconds[stage] - stage_seconds[stage] for stage in stage_seconds},
+            "batch_timings": llm.batch_timings[num_of_batches:],
+            "num_of_input_tokens": llm.num_of_input_tokens - num_of_input_tokens,
+            "num_of_output_tokens": llm.num_of_output_tokens - num_of_output_tokens,
+            "cache_stats": {name: llm.get_cache_stats().get(name, 0) - cache_stats.get(name, 0) for name in ShardedLLM.CACHE_STATS}
+        }
+
+
+    def __map(self, method_name: str, input_texts: list[str], *args) -> list:
+
+        ## Shards get contiguous slices, so concatenating them keeps the order.
+        shard_size = -(-len(input_texts) // self.num_of_shards)
+        shards = [input_texts[start:start + shard_size] for start in range(0, len(input_texts), max(shard_size, 1))]
+
+        results = []
+
+        for shard_results, shard_costs in self.__pool.starmap(ShardedLLM.run_shard, [(method_name, shard, args, self.splice_source) for shard in shards]):
+            results += shard_results
+
+            for stage, seconds in shard_costs["stage_seconds"].items():
+                self.stage_seconds[stage] += seconds
+
+            self.batch_timings += shard_costs["batch_timings"]
+            self.num_of_input_tokens += shard_costs["num_of_input_tokens"]
+            self.num_of_output_tokens += shard_costs["num_of_output_tokens"]
+
+            for name, value in shard_costs["cache_stats"].items():
+                self.__shard_cache_stats[name] += value
+
+        return results
+
+
+    def get_outputs(self, input_texts: list[str]) -> list[str]:
+        return self.__map("get_outputs", input_texts)
+
+
+    def get_matches(self, input_texts: list[str], target_text: str) -> list[bool]:
+        return self.__map("get_matches", input_texts, target_text)
+
+
+    def get_scores_and_matches(self, input_texts: list[str], target_text: str) -> list[tuple[float, bool]]:
+        return self.__map("get_scores_and_matches", input_texts, target_text)
+
+
+    def score(self, input_texts: list[str], target_text: str) -> list[float]:
+        return self.__map("score", input_texts, target_text)
+
+
+    def set_splice_source(self, input_text: str):
+
+        ## Shards cannot be addressed individually, so the source is sent with
+        ## every call and only re-tokenised by a shard when it changes.
+        self.splice_source = input_text
+        self.llm.set_splice_source(input_text)
+
+
+    def get_token_saliency(self, input_text: str, target_text: str) -> list[tuple[int, int, float]]:
+        return self.llm.get_token_saliency(input_text, target_text)
+
+
+    def is_quantized(self) -> bool:
+        return self.llm.is_quantized()
+
+
+    def get_result_identity(self) -> str:
+        return self.llm.get_result_identity()
+
+
+    def get_cache_stats(self) -> dict[str, int]:
+
+        ## Lookups made by the shards are added to the parent's own.
+        cache_stats = dict(self.llm.get_cache_stats())
+
+        for name, value in self.__shard_cache_stats.items():
+            cache_stats[name] = cache_stats.get(name, 0) + value
+
+        return cache_stats
+
+
+    def reset_timings(self):
+
+        self.stage_seconds = dict.fromkeys(PreTrainedLLM.STAGES, 0.0)
+        self.batch_timings = []
+
+
+    def close(self):
+
+        self.__pool.close()
+        self.__pool.join()
@@ -0,0 +1,218 @@
+import mmap, os, sys
+from functools import lru_cache
+from nltk.corpus import wordnet
+from scripts.utility.logger import Logger
+
+class WordNetIndex:
+    """Sorted, tab separated string table of lowercase word -> (synonyms,
+    antonyms). Lookups binary search the memory-mapped file, so only the
+    pages that are touched are ever read.
+
+    Build it once with:
+        python -m custom.scripts.wordnet_index [index path]
+    """
+
+    DEFAULT_INDEX_PATH = r"cache/wordnet_index.tsv"
+    DEFAULT_LRU_SIZE = 8192
+
+    __FIELD_SEPARATOR = "\t"
+    __WORD_SEPARATOR = "|"
+
+    ## The detachment rules WordNet's morphy uses, applied when an inflected
+    ## word is not a key in the index.
+    __MORPHOLOGICAL_SUBSTITUTIONS = [
+        ("s", ""), ("ses", "s"), ("xes", "x"), ("zes", "z"), ("ches", "ch"),
+        ("shes", "sh"), ("men", "man"), ("ies", "y"), ("es", "e"), ("es", ""),
+        ("ed", "e"), ("ed", ""), ("ing", "e"), ("ing", ""), ("er", ""),
+        ("est", ""), ("er", "e"), ("est", "e")
+    ]
+
+    def __init__(self, index_path: str = DEFAULT_INDEX_PATH, lru_size: int = DEFAULT_LRU_SIZE):
+        self.index_path = index_path
+
+        self.__file = None
+        self.__map = None
+
+        self.get = lru_cache(maxsize=lru_size)(self.__lookup)
+
+
+    def get_live_synonyms(word: str) -> list[str]:
+        synonyms = set()
+
+        for synset in wordnet.synsets(word):
+            for lemma in synset.lemmas():
+                synonym = lemma.name().replace("_", " ")  # Replace underscores with spaces
+                if synonym.lower() != word.lower():  # Exclude the original word
+                    synonyms.add(synonym)
+
+        return list(synonyms)
+
+
+    def get_live_antonyms(word: str) -> list[str]:
+        antonyms = set()
+
+        for syn in wordnet.synsets(word):
+            for lemma in syn.lemmas():
+                if lemma.antonyms():  # Check if antonyms exist
+                    for antonym in lemma.antonyms():
+                        antonyms.add(antonym.name().replace("_", " "))  # Replace underscores with spaces
+
+        return list(antonyms)
+
+
+    def build(index_path: str = DEFAULT_INDEX_PATH):
+
+        Logger.log_info(f"Building WordNet index at: '{index_path}'")
+
+        words = set(wordnet.all_lemma_names())
+
+        ## Irregular forms such as "feet" are only reachable via the exception lists.
+        for exceptions in getattr(wordnet, "_exception_map", {}).values():
+            words.update(exceptions)
+
+        lines = []
+
+        for word in words:
+            key = word.lower()
+
+            if not key.isalpha():
+                continue
+
+            synonyms = WordNetIndex.get_live_synonyms(key)
+            antonyms = WordNetIndex.get_live_antonyms(key)
+
+            if synonyms == [] and antonyms == []:
+                continue
+
+            line = WordNetIndex.__FIELD_SEPARATOR.join([
+                key,
+                WordNetIndex.__WORD_SEPARATOR.join(sorted(synonyms)),
+                WordNetIndex.__WORD_SEPARATOR.join(sorted(antonyms))])
+
+            lines.append(line.encode("utf-8"))
+
+        ## Byte order is what the binary search compares against.
+        lines = sorted(set(lines))
+
+        index_folder_path = os.path.dirname(index_path)
+        if index_folder_path != "":
+            os.makedirs(index_folder_path, exist_ok=True)
+
+        temp_path = index_path + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(b"\n".join(lines) + b"\n")
+
+        os.replace(temp_path, index_path)
+
+        Logger.log_info(f"WordNet index built with {len(lines)} words.")
+
+
+    def __open(self):
+
+        if self.__map is not None:
+            return
+
+        if not os.path.exists(self.index_path):
+            Logger.raise_exception(f"WordNet index not found at: '{self.index_path}'")
+
+        self.__file = open(self.index_path, "rb")
+
+        if os.path.getsize(self.index_path) > 0:
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.__map = b""
+
+        Logger.log_info(f"WordNet index loaded from: '{self.index_path}'")
+
+
+    def __find_line(self, key: str) -> bytes:
+
+        key_bytes = key.encode("utf-8")
+        low = 0
+        high = len(self.__map)
+
+        ## Both bounds always sit on line starts, so each step discards the
+        ## whole line containing the midpoint.
+        while low < high:
+            middle = (low + high) // 2
+            line_start = self.__map.rfind(b"\n", 0, middle) + 1
+            line_end = self.__map.find(b"\n", line_start)
+
+            if line_end == -1:
+                line_end = len(self.__map)
+
+            line = self.__map[line_start:line_end]
+            line_key = line.split(b"\t", 1)[0]
+
+            if line_key < key_bytes:
+                low = line_end + 1
+            elif line_key > key_bytes:
+                high = line_start
+            else:
+                return line
+
+        return None
+
+
+    def __parse_line(line: bytes) -> tuple[list[str], list[str]]:
+
+        _, synonyms, antonyms = line.decode("utf-8").split(WordNetIndex.__FIELD_SEPARATOR)
+
+        return (synonyms.split(WordNetIndex.__WORD_SEPARATOR) if synonyms != "" else [],
+                antonyms.split(WordNetIndex.__WORD_SEPARATOR) if antonyms != "" else [])
+
+
+    def __lookup(self, word: str) -> tuple[tuple[str], tuple[str]]:
+
+        self.__open()
+
+        key = word.lower()
+        line = self.__find_line(key)
+
+        if line is not None:
+            synonyms, antonyms = WordNetIndex.__parse_line(line)
+            return tuple(synonyms), tuple(antonyms)
+
+        synonyms = set()
+        antonyms = set()
+
+        for suffix, replacement in self.__MORPHOLOGICAL_SUBSTITUTIONS:
+            if key.endswith(suffix) and len(key) > len(suffix):
+                base = key[:-len(suffix)] + replacement
+                line = self.__find_line(base)
+
+                if line is not None:
+                    base_synonyms, base_antonyms = WordNetIndex.__parse_line(line)
+                    synonyms.update(base_synonyms)
+                    synonyms.add(base)
+                    antonyms.update(base_antonyms)
+
+        return (tuple(sorted(synonym for synonym in synonyms if synonym.lower() != key)),
+                tuple(sorted(antonyms)))
+
+
+    def get_synonyms(self, word: str) -> list[str]:
+
+        return list(self.get(word.lower())[0])
+
+
+    def get_antonyms(self, word: str) -> list[str]:
+
+        return list(self.get(word.lower())[1])
+
+
+    def close(self):
+
+        if isinstance(self.__map, mmap.mmap):
+            self.__map.close()
+
+        if self.__file is not None:
+            self.__file.close()
+
+        self.__map = None
+        self.__file = None
+        self.get.cache_clear()
+
+
+if __name__ == "__main__":
+    WordNetIndex.build(sys.argv[1] if len(sys.argv) > 1 else WordNetIndex.DEFAULT_INDEX_PATH)
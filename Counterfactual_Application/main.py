@@ -30,43 +30,51 @@ from scripts.utility.logger import Logger
 from scripts.ui.ui import WindowUI
 from custom.scripts.main_ui import MainUI
 
-## Loading Logger and initialising.
-Logger(r"logs/Counterfactual_Application")  
-pygame.init()
-glob.init()
-
-## Loading window UI.
-window = WindowUI(
-    (1920 , 1080),
-    "LLM Counterfactual Explanation",
-    b_colour=MainUI.BG_COLOUR,
-    framerate=9999)
-
-main_ui = MainUI(window)
-
-### Main Loop -----------------------------
-glob.audio.setVolume(0)
-
-run_first_time = True
-
-run = True
-while run:
-    
-    if window.keyboard.is_pressed("zoom_in") and glob.scale < 3:
-        window.set_scale(glob.scale + 0.1)
-    
-    if window.keyboard.is_pressed("zoom_out") and glob.scale > 0.5:
-        window.set_scale(glob.scale - 0.1)
-        
-    main_ui.handle_inputs(window, run_first_time)
-        
-    if not window.events():
-        run = False
-    
-    window.draw()
-    
-    if run_first_time:
-        run_first_time = False
-
-pygame.quit()
-### -----------------------------------------
\ No newline at end of file
+def main():
+
+    ## Loading Logger and initialising.
+    Logger(r"logs/Counterfactual_Application")  
+    pygame.init()
+    glob.init()
+
+    ## Loading window UI.
+    window = WindowUI(
+        (1920 , 1080),
+        "LLM Counterfactual Explanation",
+        b_colour=MainUI.BG_COLOUR,
+        framerate=9999)
+
+    main_ui = MainUI(window)
+
+    ### Main Loop -----------------------------
+    glob.audio.setVolume(0)
+
+    run_first_time = True
+
+    run = True
+    while run:
+
+        if window.keyboard.is_pressed("zoom_in") and glob.scale < 3:
+            window.set_scale(glob.scale + 0.1)
+
+        if window.keyboard.is_pressed("zoom_out") and glob.scale > 0.5:
+            window.set_scale(glob.scale - 0.1)
+
+        main_ui.handle_inputs(window, run_first_time)
+
+        if not window.events():
+            run = False
+
+        window.draw()
+
+        if run_first_time:
+            run_first_time = False
+
+    pygame.quit()
+    ### -----------------------------------------
+
+
+## Shard processes are spawned and re-import this file, so they must not
+## start the UI.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+__author__ = "Kaya Arkin"
+__copyright__ = "Copyright Kaya Arkin, Swansea University"
+__email__ = "2105361@swansea.ac.uk, karkin2002@gmail.com"
+
+"""
+--- Description
+This file benchmarks the counterfactual pipeline end to end, so a change to
+CounterfactualGenerator or PreTrainedLLM can be checked for speed before it
+is merged. Unless --model is given, a tiny randomly initialised T5 model is
+built locally with a SentencePiece tokenizer trained on the input reports,
+so nothing is downloaded and the numbers only reflect pipeline overhead and
+small matrix work. Candidate synonyms come from the WordNet index, or from
+WordNet itself when no index has been built.
+
+For each run the candidate throughput, the p50/p95/p99 per-candidate
+latency (each model batch's time divided by its size), the share of time
+spent tokenising and generating, and the peak resident memory are logged
+and written to a JSON file. Pass a previous file as --baseline to log the
+change against it.
+
+Example:
+    python pipeline_benchmark.py --input ../LLM_Training/airline_incidents_small.csv --limit 5 --output benchmark.json
+    python pipeline_benchmark.py --input ../LLM_Training/airline_incidents_small.csv --limit 5 --baseline benchmark.json
+"""
+
+import argparse, csv, json, os, subprocess, sys, time, torch
+from scripts.utility.logger import Logger
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from custom.scripts.prediction_cache import PredictionCache
+from custom.scripts.counterfactual_generator import CounterfactualGenerator
+from cli import read_reports, get_percentile, LOG_FOLDER_PATH, DECODING_MODES, REPORT_COLUMN, PART_FAILURE_COLUMN
+
+TINY_MODEL_FOLDER_PATH = os.path.join("cache", "benchmark_model")
+TINY_VOCAB_SIZE = 800
+TINY_MAX_OUTPUT_LENGTH = 8
+PERCENTILES = (50, 95, 99)
+
+
+def build_tiny_model(csv_path: str, model_folder_path: str, seed: int):
+
+    import sentencepiece
+    from transformers import T5Config, T5ForConditionalGeneration, T5Tokenizer
+
+    Logger.log_info(f"Building tiny T5 model at: '{model_folder_path}'")
+
+    os.makedirs(model_folder_path, exist_ok=True)
+    corpus_path = os.path.join(model_folder_path, "corpus.txt")
+
+    with open(csv_path, "r", encoding="utf-8", newline="") as file:
+        rows = list(csv.DictReader(file))
+
+    with open(corpus_path, "w", encoding="utf-8") as file:
+        for row in rows:
+            file.write(row[REPORT_COLUMN] + "\n" + (row.get(PART_FAILURE_COLUMN) or "") + "\n")
+
+    ## T5 ids: padding is also the decoder start token, no beginning token.
+    sentencepiece.SentencePieceTrainer.train(
+        input=corpus_path,
+        model_prefix=os.path.join(model_folder_path, "spiece"),
+        vocab_size=TINY_VOCAB_SIZE,
+        model_type="unigram",
+        pad_id=0,
+        eos_id=1,
+        unk_id=2,
+        bos_id=-1,
+        minloglevel=2)
+
+    tokenizer = T5Tokenizer(os.path.join(model_folder_path, "spiece.model"), extra_ids=0)
+
+    torch.manual_seed(seed)
+
+    model = T5ForConditionalGeneration(T5Config(
+        vocab_size=len(tokenizer),
+        d_model=32,
+        d_ff=64,
+        d_kv=16,
+        num_layers=2,
+        num_heads=2,
+        decoder_start_token_id=0,
+        pad_token_id=0,
+        eos_token_id=1))
+
+    model.save_pretrained(model_folder_path)
+    tokenizer.save_pretrained(model_folder_path)
+
+
+def get_peak_rss_bytes() -> int:
+
+    try:
+        import resource
+    except ImportError:
+        Logger.log_warning("Peak memory is only measured on Unix-like systems.")
+        return None
+
+    ## Linux reports kilobytes, macOS bytes.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def get_commit() -> str:
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def log_comparison(result: dict, baseline_path: str):
+
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = json.load(file)
+
+    for metric in ("candidates_per_second", "p50_latency_seconds", "p95_latency_seconds", "peak_rss_bytes"):
+        if result.get(metric) is None or not baseline.get(metric):
+            continue
+
+        Logger.log_info(f"{metric}: {baseline[metric]:.6g} -> {result[metric]:.6g} ({result[metric] / baseline[metric] - 1:+.1%}).")
+
+
+def get_arguments() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(description="Benchmark the counterfactual pipeline end to end.")
+    parser.add_argument("--input", required=True, help="CSV file with a 'report' column.")
+    parser.add_argument("--model", default=None, help="Folder of a T5 model. A tiny random model is built locally if omitted.")
+    parser.add_argument("--output", default="pipeline_benchmark.json", help="JSON file the results are written to.")
+    parser.add_argument("--baseline", default=None, help="Results of an earlier run to compare against.")
+    parser.add_argument("--batch-size", type=int, default=PreTrainedLLM.DEFAULT_BATCH_SIZE, help="Candidates per model batch.")
+    parser.add_argument("--decoding", choices=list(DECODING_MODES), default="full", help="How candidate outputs are decoded.")
+    parser.add_argument("--wordnet-index", default=CounterfactualGenerator.WORDNET_INDEX_PATH, help="Precomputed WordNet index used to plan candidates.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the tiny model's weights.")
+    parser.add_argument("--limit", type=int, default=5, help="Number of reports to run.")
+
+    return parser.parse_args()
+
+
+def main():
+
+    arguments = get_arguments()
+
+    os.makedirs(LOG_FOLDER_PATH, exist_ok=True)
+    Logger(os.path.join(LOG_FOLDER_PATH, "Pipeline_Benchmark"))
+
+    CounterfactualGenerator.DECODING_MODE = DECODING_MODES[arguments.decoding]
+    CounterfactualGenerator.WORDNET_INDEX_PATH = arguments.wordnet_index
+
+    model_folder_path = arguments.model
+
+    if model_folder_path is None:
+        model_folder_path = TINY_MODEL_FOLDER_PATH
+        build_tiny_model(arguments.input, model_folder_path, arguments.seed)
+
+    reports = [report for _, report, _ in read_reports(arguments.input, arguments.limit)]
+
+    ## An empty cache makes every candidate reach the model.
+    llm = PreTrainedLLM(prediction_cache=PredictionCache(max_size=0))
+    llm.batch_size = arguments.batch_size
+    llm.set_model_folder_path(model_folder_path)
+
+    ## Random weights rarely produce the end token, so outputs are capped to
+    ## keep the work per candidate the same between runs.
+    if arguments.model is None:
+        llm.max_output_length = TINY_MAX_OUTPUT_LENGTH
+
+    ## Predicting the reports also loads the model and warms up its kernels.
+    predictions = llm.get_outputs(reports)
+    llm.reset_timings()
+
+    num_of_candidates = 0
+    start_time = time.perf_counter()
+
+    for report, prediction in zip(reports, predictions):
+        num_of_candidates += len(CounterfactualGenerator.get_counterfactuals(report, prediction, llm))
+
+    seconds = time.perf_counter() - start_time
+    num_of_inferences = sum(batch_size for batch_size, _ in llm.batch_timings)
+
+    if num_of_inferences == 0:
+        Logger.raise_exception("The reports produced no counterfactual candidates; check the WordNet index.")
+
+    latencies = []
+    for batch_size, batch_seconds in llm.batch_timings:
+        latencies += [batch_seconds / batch_size] * batch_size
+
+    result = {
+        "commit": get_commit(),
+        "model": arguments.model,
+        "decoding": arguments.decoding,
+        "batch_size": arguments.batch_size,
+        "num_of_reports": len(reports),
+        "num_of_candidates": num_of_candidates,
+        "num_of_inferences": num_of_inferences,
+        "seconds": seconds,
+        "candidates_per_second": num_of_candidates / seconds,
+        "inferences_per_second": num_of_inferences / seconds,
+        **{f"p{percentile}_latency_seconds": get_percentile(latencies, percentile) for percentile in PERCENTILES},
+        **{f"{stage}_share": llm.stage_seconds[stage] / seconds for stage in PreTrainedLLM.STAGES},
+        "peak_rss_bytes": get_peak_rss_bytes(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "torch_version": torch.__version__
+    }
+
+    Logger.log_info(
+        f"{result['candidates_per_second']:.1f} candidates/s over {num_of_candidates} candidates, "
+        f"latency p50 {result['p50_latency_seconds'] * 1000:.2f}ms, p95 {result['p95_latency_seconds'] * 1000:.2f}ms, "
+        f"p99 {result['p99_latency_seconds'] * 1000:.2f}ms.")
+    Logger.log_info(
+        f"Tokenisation {result['tokenisation_share']:.1%} and generation {result['generation_share']:.1%} of the run time.")
+
+    if result["peak_rss_bytes"] is not None:
+        Logger.log_info(f"Peak resident memory {result['peak_rss_bytes'] / 1024 ** 2:.1f} MB.")
+
+    if arguments.baseline is not None:
+        log_comparison(result, arguments.baseline)
+
+    with open(arguments.output, "w", encoding="utf-8") as file:
+        json.dump(result, file, indent=4)
+
+    Logger.log_info(f"Results written to '{arguments.output}'.")
+
+
+if __name__ == "__main__":
+    main()
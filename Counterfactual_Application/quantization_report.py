@@ -0,0 +1,113 @@
+__author__ = "Kaya Arkin"
+__copyright__ = "Copyright Kaya Arkin, Swansea University"
+__email__ = "2105361@swansea.ac.uk, karkin2002@gmail.com"
+
+"""
+--- Description
+This file measures the accuracy and latency of the fine-tuned T5 model with and
+without int8 quantization. Each report in the CSV is predicted one at a time
+(the UI's case) and then as a single batched sweep (the counterfactual case).
+Accuracy is measured against the "part failure" column and label drift as the
+share of reports where the quantized prediction differs from the full
+precision one. The report is logged and written to a JSON file.
+
+Example:
+    python quantization_report.py --model <model folder> --input ../LLM_Training/airline_incidents_small.csv --output quantization_report.json
+"""
+
+import argparse, json, os, statistics, time
+from scripts.utility.logger import Logger
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from custom.scripts.prediction_cache import PredictionCache
+from cli import read_reports, get_percentile, LOG_FOLDER_PATH
+
+FULL_PRECISION = "fp32"
+
+
+def measure(model_folder_path: str, quantization: str, reports: list[str], batch_size: int) -> dict:
+
+    ## An empty cache keeps repeated reports from being served from memory.
+    start_time = time.perf_counter()
+    llm = PreTrainedLLM(prediction_cache=PredictionCache(max_size=0), quantization=quantization)
+    llm.batch_size = batch_size
+    llm.set_model_folder_path(model_folder_path)
+    load_seconds = time.perf_counter() - start_time
+
+    predictions = []
+    latencies = []
+
+    for report in reports:
+        start_time = time.perf_counter()
+        predictions.append(llm.get_outputs([report])[0])
+        latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    llm.get_outputs(reports)
+    batch_seconds = time.perf_counter() - start_time
+
+    return {
+        "load_seconds": load_seconds,
+        "mean_latency_seconds": statistics.mean(latencies),
+        "p50_latency_seconds": get_percentile(latencies, 50),
+        "p95_latency_seconds": get_percentile(latencies, 95),
+        "batch_reports_per_second": len(reports) / batch_seconds,
+        "predictions": predictions
+    }
+
+
+def get_arguments() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(description="Compare the accuracy and latency of quantized and full precision inference.")
+    parser.add_argument("--model", required=True, help="Folder of the fine-tuned T5 model.")
+    parser.add_argument("--input", required=True, help="CSV file with 'report' and 'part failure' columns.")
+    parser.add_argument("--output", default="quantization_report.json", help="JSON file the report is written to.")
+    parser.add_argument("--batch-size", type=int, default=PreTrainedLLM.DEFAULT_BATCH_SIZE, help="Reports per model batch in the batched sweep.")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N reports.")
+
+    return parser.parse_args()
+
+
+def main():
+
+    arguments = get_arguments()
+
+    os.makedirs(LOG_FOLDER_PATH, exist_ok=True)
+    Logger(os.path.join(LOG_FOLDER_PATH, "Quantization_Report"))
+
+    rows = read_reports(arguments.input, arguments.limit)
+    reports = [report for _, report, _ in rows]
+    part_failures = [part_failure for _, _, part_failure in rows]
+
+    if len(reports) == 0:
+        Logger.raise_exception(f"CSV file '{arguments.input}' has no reports.")
+
+    results = {}
+
+    for quantization in (None, *PreTrainedLLM.QUANTIZATIONS):
+        name = quantization if quantization is not None else FULL_PRECISION
+        Logger.log_info(f"Measuring {name} inference over {len(reports)} reports.")
+
+        results[name] = measure(arguments.model, quantization, reports, arguments.batch_size)
+
+    full_precision_predictions = results[FULL_PRECISION]["predictions"]
+
+    for name, result in results.items():
+        predictions = result.pop("predictions")
+
+        result["accuracy"] = sum(prediction == part_failure for prediction, part_failure in zip(predictions, part_failures)) / len(reports)
+        result["label_drift"] = sum(prediction != original for prediction, original in zip(predictions, full_precision_predictions)) / len(reports)
+        result["speedup"] = results[FULL_PRECISION]["mean_latency_seconds"] / result["mean_latency_seconds"]
+
+        Logger.log_info(
+            f"{name}: accuracy {result['accuracy']:.3f}, label drift {result['label_drift']:.3f}, "
+            f"p50 {result['p50_latency_seconds'] * 1000:.1f}ms, p95 {result['p95_latency_seconds'] * 1000:.1f}ms, "
+            f"{result['batch_reports_per_second']:.2f} reports/s batched, {result['speedup']:.2f}x speedup.")
+
+    with open(arguments.output, "w", encoding="utf-8") as file:
+        json.dump({"model": arguments.model, "num_of_reports": len(reports), "results": results}, file, indent=4)
+
+    Logger.log_info(f"Report written to '{arguments.output}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+__author__ = "Kaya Arkin"
+__copyright__ = "Copyright Kaya Arkin, Swansea University"
+__email__ = "2105361@swansea.ac.uk, karkin2002@gmail.com"
+
+"""
+--- Description
+This file measures how counterfactual generation scales with the number of
+model shards (see ShardedLLM). The same reports are run with 1, 2, 4, ... up
+to --max-shards processes, the CPU threads being split evenly between them.
+For each shard count the candidate throughput, speedup and parallel
+efficiency (speedup / shards) are logged and written to a JSON file, along
+with the largest shard count that still scales efficiently. Past that point
+the shards are competing for memory bandwidth rather than cores.
+
+Example:
+    python scaling_benchmark.py --model <model folder> --input ../LLM_Training/airline_incidents_small.csv --limit 5 --max-shards 64
+"""
+
+import argparse, json, os, time, torch
+from scripts.utility.logger import Logger
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from custom.scripts.prediction_cache import PredictionCache
+from custom.scripts.sharded_llm import ShardedLLM
+from custom.scripts.counterfactual_generator import CounterfactualGenerator
+from cli import read_reports, LOG_FOLDER_PATH, DECODING_MODES
+
+EFFICIENCY_THRESHOLD = 0.8
+
+
+def get_shard_counts(max_shards: int) -> list[int]:
+
+    shard_counts = []
+    num_of_shards = 1
+
+    while num_of_shards < max_shards:
+        shard_counts.append(num_of_shards)
+        num_of_shards *= 2
+
+    return shard_counts + [max_shards]
+
+
+def run(llm: PreTrainedLLM | ShardedLLM, reports: list[str], predictions: list[str]) -> float:
+
+    start_time = time.perf_counter()
+
+    for report, prediction in zip(reports, predictions):
+        CounterfactualGenerator.get_counterfactuals(report, prediction, llm)
+
+    return time.perf_counter() - start_time
+
+
+def get_arguments() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(description="Measure how counterfactual generation scales with the number of model shards.")
+    parser.add_argument("--model", required=True, help="Folder of the fine-tuned T5 model.")
+    parser.add_argument("--input", required=True, help="CSV file with a 'report' column.")
+    parser.add_argument("--output", default="scaling_benchmark.json", help="JSON file the results are written to.")
+    parser.add_argument("--max-shards", type=int, default=os.cpu_count() or 1, help="Largest number of shards to try.")
+    parser.add_argument("--batch-size", type=int, default=PreTrainedLLM.DEFAULT_BATCH_SIZE, help="Candidates per model batch in each shard.")
+    parser.add_argument("--decoding", choices=list(DECODING_MODES), default="full", help="How candidate outputs are decoded.")
+    parser.add_argument("--wordnet-index", default=CounterfactualGenerator.WORDNET_INDEX_PATH, help="Precomputed WordNet index used to plan candidates.")
+    parser.add_argument("--limit", type=int, default=5, help="Number of reports to run at each shard count.")
+
+    return parser.parse_args()
+
+
+def main():
+
+    arguments = get_arguments()
+
+    os.makedirs(LOG_FOLDER_PATH, exist_ok=True)
+    Logger(os.path.join(LOG_FOLDER_PATH, "Scaling_Benchmark"))
+
+    CounterfactualGenerator.DECODING_MODE = DECODING_MODES[arguments.decoding]
+    CounterfactualGenerator.WORDNET_INDEX_PATH = arguments.wordnet_index
+
+    reports = [report for _, report, _ in read_reports(arguments.input, arguments.limit)]
+
+    ## An empty cache stops later runs being served from earlier ones.
+    llm = PreTrainedLLM(prediction_cache=PredictionCache(max_size=0))
+    llm.batch_size = arguments.batch_size
+    llm.set_model_folder_path(arguments.model)
+
+    predictions = llm.get_outputs(reports)
+    num_of_inferences = sum(CounterfactualGenerator.get_plan(report, llm=llm).get_num_of_inferences() for report in reports)
+
+    if num_of_inferences == 0:
+        Logger.raise_exception("The reports produced no counterfactual candidates; check the WordNet index.")
+
+    Logger.log_info(f"Benchmarking {num_of_inferences} candidate inferences over {len(reports)} reports.")
+
+    results = []
+
+    for num_of_shards in get_shard_counts(arguments.max_shards):
+
+        if num_of_shards == 1:
+            torch.set_num_threads(os.cpu_count() or 1)
+            seconds = run(llm, reports, predictions)
+
+        else:
+            sharded_llm = ShardedLLM(llm, num_of_shards)
+
+            ## The first calls into fresh shard processes are slow, so a warm up
+            ## is not timed. The shards mirror the parent's disabled cache, so
+            ## the warm up report is not served from it in the timed run.
+            run(sharded_llm, reports[:1], predictions[:1])
+            seconds = run(sharded_llm, reports, predictions)
+
+            sharded_llm.close()
+
+        speedup = results[0]["seconds"] / seconds if len(results) > 0 else 1.0
+
+        results.append({
+            "shards": num_of_shards,
+            "seconds": seconds,
+            "inferences_per_second": num_of_inferences / seconds,
+            "speedup": speedup,
+            "efficiency": speedup / num_of_shards
+        })
+
+        Logger.log_info(
+            f"{num_of_shards} shard(s): {num_of_inferences / seconds:.1f} inferences/s, "
+            f"{speedup:.2f}x speedup, {speedup / num_of_shards:.0%} efficiency.")
+
+    efficient_results = [result for result in results if result["efficiency"] >= EFFICIENCY_THRESHOLD]
+    saturation_shards = max(result["shards"] for result in efficient_results) if len(efficient_results) > 0 else 1
+
+    Logger.log_info(f"Scaling stays above {EFFICIENCY_THRESHOLD:.0%} efficiency up to {saturation_shards} shard(s).")
+
+    with open(arguments.output, "w", encoding="utf-8") as file:
+        json.dump({
+            "model": arguments.model,
+            "num_of_reports": len(reports),
+            "num_of_inferences": num_of_inferences,
+            "cpu_count": os.cpu_count(),
+            "saturation_shards": saturation_shards,
+            "results": results
+        }, file, indent=4)
+
+    Logger.log_info(f"Results written to '{arguments.output}'.")
+
+
+if __name__ == "__main__":
+    main()
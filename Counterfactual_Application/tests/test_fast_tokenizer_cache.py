@@ -0,0 +1,53 @@
+import os, shutil, tempfile, unittest
+from unittest import mock
+import transformers.tokenization_utils_fast as tokenization_utils_fast
+from custom.scripts.pre_treained_llm import PreTrainedLLM
+from pipeline_benchmark import build_tiny_model
+
+CSV_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "LLM_Training", "airline_incidents_small.csv")
+
+
+class FastTokenizerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.folder_path = tempfile.mkdtemp()
+        self.model_folder_path = os.path.join(self.folder_path, "model")
+
+        ## Saved with only the SentencePiece model, like the fine-tuned checkpoint.
+        build_tiny_model(CSV_PATH, self.model_folder_path, 0)
+
+        self.cache_folder_patch = mock.patch.object(PreTrainedLLM, "TOKENIZER_CACHE_FOLDER_PATH", os.path.join(self.folder_path, "tokenizers"))
+        self.cache_folder_patch.start()
+
+
+    def tearDown(self):
+
+        self.cache_folder_patch.stop()
+        shutil.rmtree(self.folder_path, ignore_errors=True)
+
+
+    def __load_counting_conversions(self) -> tuple[PreTrainedLLM, int]:
+
+        with mock.patch.object(tokenization_utils_fast, "convert_slow_tokenizer", wraps=tokenization_utils_fast.convert_slow_tokenizer) as convert:
+            llm = PreTrainedLLM()
+            llm.set_model_folder_path(self.model_folder_path)
+
+        return llm, convert.call_count
+
+
+    def test_cached_load_skips_conversion(self):
+
+        converted_llm, num_of_conversions = self.__load_counting_conversions()
+        self.assertEqual(num_of_conversions, 1)
+
+        cached_llm, num_of_conversions = self.__load_counting_conversions()
+        self.assertEqual(num_of_conversions, 0)
+        self.assertTrue(cached_llm.tokenizer.is_fast)
+
+        text = "LH MLG BRAKE TEMP INDICATION  FAULTY. REPLACED IAW AMM 32-42-27."
+        self.assertEqual(cached_llm.tokenizer(text)["input_ids"], converted_llm.tokenizer(text)["input_ids"])
+
+
+if __name__ == "__main__":
+    unittest.main()